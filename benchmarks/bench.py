@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Microbenchmarks for the hot paths of monitorlib: alert dispatch, metric
+    formatting, cloudkick parsing/aggregation, and the pagerduty key stores.
+
+    Usage:
+    python benchmarks/bench.py                        # run everything, print a table
+    python benchmarks/bench.py -o before.json         # ... and save the results
+    python benchmarks/bench.py -c before.json         # compare against saved results
+    python benchmarks/bench.py -k cloudkick --sizes 10000,1000000
+
+    Every sink is patched to an in-process fake, so nothing leaves the machine, and
+    state lives in a temporary directory. Each benchmark is run --repeat times, and
+    the best time per operation is reported (the median is saved too); best-of-N is
+    the least noisy measure on a shared machine. With -c, any benchmark slower than
+    the saved one by more than --threshold (default 20%) is reported as a regression,
+    and the exit status is 1.
+
+    Results are only comparable between runs on the same machine and interpreter;
+    the JSON records both, along with the git commit.
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import argparse
+import subprocess
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### set before the Client is created, so dispatch_alert doesn't print.
+os.environ.setdefault('COLLECTD_HOSTNAME', 'bench.example.com')
+
+import monitorlib.collectd as collectd
+import monitorlib.cloudkick as cloudkick
+import monitorlib.pagerduty as pagerduty
+
+# name: (function(ops) returning a callable that runs ops operations, default ops)
+BENCHMARKS = []
+STATE_DIR = None
+
+
+def benchmark(name, ops):
+    def register(func):
+        BENCHMARKS.append((name, func, ops))
+        return func
+    return register
+
+
+### collectd.Client
+
+def make_client(caller):
+    """
+    Returns a Client with every sink enabled, and patched to do nothing.
+    """
+    cd = collectd.Client(page=True, email='bench@example.com', url='http://localhost/',
+                         riemann={'host': 'localhost', 'port': 5555})
+    cd.set_state_dir(STATE_DIR)
+    cd.set_caller(caller)
+    cd.set_pagerduty_key('bench')
+    cd.send_to_pagerduty = lambda message, key=None: None
+    cd._send_to_email = lambda address, message: None
+    cd._post_to_url = lambda message, url: None
+    cd._send_to_riemann = lambda riemann, message: None
+    return cd
+
+
+def dispatch(caller, alerts, store=False):
+    """
+    Returns a benchmark that sends alerts (a list of (method, message)), in turn.
+    """
+    def setup(ops):
+        cd = make_client(caller)
+        if store:
+            cd.set_state_store()
+        calls = [(getattr(cd, method), message) for method, message in alerts]
+
+        def run():
+            for i in xrange(ops):
+                method, message = calls[i % len(calls)]
+                method(message)
+        return run
+    return setup
+
+
+def first_run(ops):
+    cd = make_client('first')
+
+    def run():
+        # a new check name each time: no state yet
+        for i in xrange(ops):
+            cd.set_caller('first-%d-%f' % (i, time.time()))
+            cd.failure('something is broken')
+    return run
+
+benchmark('dispatch.first_run', 500)(first_run)
+benchmark('dispatch.steady_ok', 500)(dispatch('steady_ok', [('ok', 'fine')]))
+benchmark('dispatch.steady_failure', 500)(dispatch('steady_failure', [('failure', 'broken')]))
+benchmark('dispatch.severity_change', 500)(dispatch('severity_change', [('failure', 'broken'), ('ok', 'fine')]))
+benchmark('dispatch.message_change', 500)(dispatch('message_change', [('failure', 'broken: %d' % i) for i in range(2)]))
+benchmark('dispatch.steady_ok.state_store', 500)(dispatch('steady_ok', [('ok', 'fine')], store=True))
+benchmark('dispatch.severity_change.state_store', 500)(
+    dispatch('severity_change', [('failure', 'broken'), ('ok', 'fine')], store=True))
+
+
+@benchmark('dispatch.many.500', 20)
+def dispatch_many(ops):
+    cd = make_client('many')
+    cd._send_many_to_riemann = lambda riemann, messages: None
+    results = [('disk-%d' % i, 'ok', 'fine') for i in range(500)]
+
+    def run():
+        for i in xrange(ops):
+            cd.dispatch_many(results)
+    return run
+
+
+@benchmark('metric.format', 100000)
+def metric_format(ops):
+    cd = collectd.Client()
+
+    def run():
+        for i in xrange(ops):
+            cd.metric('testing/gauge-foo', i)
+    return run
+
+
+@benchmark('metric.writer', 100000)
+def metric_writer(ops):
+    stream = open(os.devnull, 'w')
+    writer = collectd.MetricWriter('bench', 60, stream)
+
+    def run():
+        for i in xrange(ops):
+            writer.add('testing/gauge-foo', i)
+        writer.flush()
+    return run
+
+
+@benchmark('metric.aggregate', 100000)
+def metric_aggregate(ops):
+    cd = collectd.Client()
+
+    def run():
+        for i in xrange(ops):
+            cd.timing('app-web/gauge-latency', i % 100)
+            cd.incr('app-web/gauge-requests')
+        cd.flush_aggregates()
+    return run
+
+
+### cloudkick; ops is the number of lines
+
+def cloudkick_lines(count):
+    lines = []
+    for i in xrange(count):
+        if i % 10 == 0:
+            lines.append('status %s check %d says hello\n' % (('ok', 'warn', 'err')[i % 3], i))
+        else:
+            lines.append('metric metric_%d int %d\n' % (i % 1000, i))
+    return lines
+
+
+def cloudkick_benchmarks(sizes):
+    for size in sizes:
+        def parse(ops):
+            lines = cloudkick_lines(ops)
+
+            def run():
+                for record in cloudkick.parse(lines):
+                    pass
+            return run
+
+        def aggregate(ops):
+            lines = cloudkick_lines(ops)
+
+            def run():
+                cloudkick.Aggregator().add(lines).lines()
+            return run
+
+        benchmark('cloudkick.parse.%d' % size, size)(parse)
+        benchmark('cloudkick.aggregate.%d' % size, size)(aggregate)
+
+
+### pagerduty key stores, with STORED_KEYS keys in them already
+
+STORED_KEYS = 10000
+
+
+class FakeRedis:
+    """
+    A dict standing in for the redis server, with the commands the key store uses.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hdel(self, key, *fields):
+        return len([self.data.get(key, {}).pop(field) for field in fields if field in self.data.get(key, {})])
+
+    def zadd(self, key, member, score):
+        self.data.setdefault(key, {})[member] = score
+
+    def zrem(self, key, *members):
+        return self.hdel(key, *members)
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.data.get(key, {}).items() if score <= high]
+
+    def expire(self, key, ttl):
+        pass
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.redis, name), args))
+
+    def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+def key_store(kind, ops):
+    if 'redis' in kind:
+        conn = FakeRedis()
+        pagerduty.redispool.get_connection = lambda *args, **kwargs: conn
+        pagerduty.set_datastore('redis', {'reader': 'localhost', 'reader_port': 6379, 'writer': 'localhost',
+                                          'writer_port': 6379, 'db': 'db0', 'passwd': None})
+    else:
+        # a new store for each run (open sqlite connections are cached by path)
+        path = os.path.join(tempfile.mkdtemp(dir=STATE_DIR), 'incident_keys')
+        if 'sqlite' in kind:
+            path += '.db'
+        pagerduty.set_datastore(kind, path)
+
+    if 'sqlite' in kind:
+        with pagerduty.sqlitedb.transaction(pagerduty.sqlite_conn()) as conn:
+            conn.executemany('INSERT INTO incident_keys (store_key, incident_key) VALUES (?, ?)',
+                             [('stored-%d' % i, 'key-%d' % i) for i in xrange(STORED_KEYS)])
+    elif 'file' in kind:
+        with open(pagerduty.STORAGE_CONFIG, 'w') as fh:
+            pagerduty.pickle.dump(dict([('stored-%d' % i, 'key-%d' % i) for i in xrange(STORED_KEYS)]), fh)
+    else:
+        for i in xrange(STORED_KEYS):
+            pagerduty.add_incident_key('stored-%d' % i, 'key-%d' % i)
+
+    def run():
+        # one op: add a key, read it back, and delete it
+        for i in xrange(ops):
+            store_key = 'bench-%d' % i
+            pagerduty.add_incident_key(store_key, 'key')
+            pagerduty.get_incident_key(store_key)
+            pagerduty.del_incident_key(store_key)
+    return run
+
+for kind, ops in [('sqlite', 500), ('file', 50), ('redis', 10000), ('local', 10000)]:
+    benchmark('pagerduty.keys.%s' % kind, ops)(lambda ops, kind=kind: key_store(kind, ops))
+
+
+### running, saving, comparing
+
+def measure(setup, ops, repeat):
+    times = []
+    for i in range(repeat):
+        run = setup(ops)
+        start = time.time()
+        run()
+        times.append((time.time() - start) / ops)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2], 'ops': ops, 'repeat': repeat}
+
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'),
+                                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+    except OSError:
+        return None
+
+
+def format_time(seconds):
+    for unit, scale in [('s', 1), ('ms', 1e3), ('us', 1e6)]:
+        if seconds * scale >= 1:
+            return '%.2f%s' % (seconds * scale, unit)
+    return '%.0fns' % (seconds * 1e9)
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each benchmark against the baseline, and returns the names that regressed.
+    """
+    regressed = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['best'] / baseline[name]['best']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print '%-45s %10s -> %10s  %5.2fx%s' % (name, format_time(baseline[name]['best']),
+                                                format_time(results[name]['best']), ratio, flag)
+    return regressed
+
+
+def main():
+    global STATE_DIR
+
+    parser = argparse.ArgumentParser(description='monitorlib microbenchmarks')
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per benchmark (default 5)')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='cloudkick input sizes, in lines (default 10000,100000; try 1000000)')
+    parser.add_argument('-o', '--output', help='save the results as JSON to this file')
+    parser.add_argument('-c', '--compare', help='compare against results saved with -o')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='slowdown that counts as a regression (default 0.2, i.e. 20%%)')
+    args = parser.parse_args()
+
+    cloudkick_benchmarks([int(size) for size in args.sizes.split(',')])
+
+    STATE_DIR = tempfile.mkdtemp(prefix='monitorlib-bench-')
+    results = {}
+    try:
+        for name, setup, ops in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            results[name] = measure(setup, ops, args.repeat)
+            if not args.compare:
+                print '%-45s %10s/op  (median %s, %d ops)' % (name, format_time(results[name]['best']),
+                                                             format_time(results[name]['median']), ops)
+    finally:
+        shutil.rmtree(STATE_DIR)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(),
+                       'host': socket.gethostname(), 'time': time.time(), 'results': results},
+                      fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            saved = json.load(fh)
+        print 'against %s (python %s, %s):' % (saved.get('commit'), saved.get('python'), saved.get('host'))
+        if compare(results, saved['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
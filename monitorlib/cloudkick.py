@@ -6,6 +6,13 @@
 
 """
 Functions for creating Cloudkick plugins.
+
+parse() tokenizes plugin output a line at a time (each line is split
+exactly once) and yields Status and Metric records; the line-based
+functions below are thin wrappers around the same tokenizers.
+
+run_plugins() runs several plugins at once, and combines their output
+into one result with an Aggregator.
 """
 
 
@@ -34,11 +41,46 @@ METRIC_FIELD_COUNT = 4
 METRIC_TYPE_FIELD = 2
 
 
+class Status(tuple):
+    """
+    A parsed status line: a tuple ('status', status, message).
+    """
+    __slots__ = ()
+
+    status = property(itemgetter(1))
+
+    @property
+    def message(self):
+        return self[2] if len(self) > 2 else ''
+
+    @property
+    def priority(self):
+        return STATUS_PRIORITY[self[1]]
+
+
+class Metric(tuple):
+    """
+    A parsed metric line: a tuple ('metric', name, type, value).
+    """
+    __slots__ = ()
+
+    name = property(itemgetter(1))
+    type = property(itemgetter(2))
+
+    @property
+    def value(self):
+        return self[3] if len(self) > 3 else ''
+
+
 def valid_status_type(status):
     """
     Return True if status is a valid Cloudkick status.
     """
-    return status in STATUS_PRIORITY.iterkeys()
+    try:
+        return status in STATUS_PRIORITY
+    except TypeError:
+        ### unhashable, so certainly not a status
+        return False
 
 
 def valid_metric_type(metric_type):
@@ -81,15 +123,61 @@ def get_field(field, line, splits):
     return line.split(None, splits)[field]
 
 
+def parse_status(line):
+    """
+    Given an output line, return a Status record if it is a
+    Cloudkick-formatted status line, False otherwise. Splits the line
+    once.
+    """
+    if not line.startswith('status '):
+        return False
+    fields = line.split(None, (STATUS_FIELD_COUNT - 1))
+    return valid_status_type(fields[STATUS_TYPE_FIELD]) and Status(fields)
+
+
+def parse_metric(line):
+    """
+    Given an output line, return a Metric record if it is a
+    Cloudkick-formatted metric line, False otherwise. Splits the line
+    once.
+    """
+    if not line.startswith('metric '):
+        return False
+    fields = line.split(None, (METRIC_FIELD_COUNT - 1))
+    return valid_metric_type(fields[METRIC_TYPE_FIELD]) and Metric(fields)
+
+
+def parse_line(line):
+    """
+    Given an output line, return its Status or Metric record, or None
+    if it is neither.
+    """
+    return parse_status(line) or parse_metric(line) or None
+
+
+def parse(lines):
+    """
+    Given an iterable of output lines (a list, a generator, a file
+    object...), yield a Status or Metric record for each status or
+    metric line, in order. Trailing newlines are ignored, and so are
+    any other lines, including truncated ones. Holds one line at a
+    time, so runs in constant memory.
+    """
+    for line in lines:
+        try:
+            record = parse_line(line.rstrip('\r\n'))
+        except IndexError:
+            continue
+        if record:
+            yield record
+
+
 def is_status_line(line):
     """
     Given an output line, return True if it is a Cloudkick-formatted
     status line, False otherwise.
     """
-    return all([line.startswith('status '),
-                valid_status_type(get_field(STATUS_TYPE_FIELD,
-                                            line,
-                                            STATUS_FIELD_COUNT))])
+    return bool(parse_status(line))
 
 
 def is_metric_line(line):
@@ -97,10 +185,7 @@ def is_metric_line(line):
     Given an output line, return True if it is a Cloudkick-formatted
     metric line, False otherwise.
     """
-    return all([line.startswith('metric '),
-                valid_metric_type(get_field(METRIC_TYPE_FIELD,
-                                            line,
-                                            METRIC_FIELD_COUNT))])
+    return bool(parse_metric(line))
 
 
 def get_status_type(line):
@@ -109,9 +194,8 @@ def get_status_type(line):
     specified by that line. Return False if line is not a
     Cloudkick-formatted status line.
     """
-    return is_status_line(line) and get_field(STATUS_TYPE_FIELD,
-                                              line,
-                                              STATUS_FIELD_COUNT)
+    record = parse_status(line)
+    return record and record.status
 
 
 def get_metric_type(line):
@@ -120,9 +204,8 @@ def get_metric_type(line):
     specified by that line. Return False if line is not a
     Cloudkick-formatted metric line.
     """
-    return is_metric_line(line) and get_field(METRIC_TYPE_FIELD,
-                                              line,
-                                              METRIC_FIELD_COUNT)
+    record = parse_metric(line)
+    return record and record.type
 
 
 def status_tuple(line):
@@ -130,7 +213,7 @@ def status_tuple(line):
     Given a Cloudkick-formatted status line, return a tuple ('status',
     status, message).
     """
-    return is_status_line(line) and tuple(line.split(None, (STATUS_FIELD_COUNT - 1)))
+    return parse_status(line)
 
 
 def status_line(tpl):
@@ -171,7 +254,7 @@ def metric_tuple(line):
     Given a Cloudkick-formatted metric line, return a tuple ('metric',
     name, type, value).
     """
-    return is_metric_line(line) and tuple(line.split(None, (METRIC_FIELD_COUNT - 1)))
+    return parse_metric(line)
 
 
 def metric_line(tpl):
@@ -205,11 +288,9 @@ def sort_by_priority(lines):
     priority. If any line in lines is not a status line, it will be
     filtered out of the results.
     """
-    return list(reversed([status_line(tpl) for tpl in
-                          sorted([status_tuple(line) for line in
-                                  get_status_lines(lines)],
-                                 cmp=compare_priority,
-                                 key=itemgetter(1))]))
+    records = [record for record in (parse_status(line) for line in lines) if record]
+    return list(reversed([' '.join(record) for record in
+                          sorted(records, key=lambda record: record.priority)]))
 
 
 def highest_priority(lines):
@@ -217,7 +298,10 @@ def highest_priority(lines):
     Given a list of lines, return the status line with the highest
     priority.
     """
-    return sort_by_priority(get_status_lines(lines))[0]
+    status = Aggregator(lines).status
+    if status is None:
+        raise IndexError('no status lines')
+    return ' '.join(status)
 
 
 def add_lines(lines, output_lines):
@@ -227,10 +311,93 @@ def add_lines(lines, output_lines):
     status lines. For each new metric line, add the line. Ignore any
     other line.
     """
-    status = highest_priority([line for line in (lines + output_lines)
-                               if is_status_line(line)])
-    return [status] + [line for line in (lines + output_lines)
-                       if is_metric_line(line)]
+    aggregator = Aggregator(lines).add(output_lines)
+    if aggregator.status is None:
+        raise IndexError('no status lines')
+    return aggregator.lines()
+
+
+class Aggregator(object):
+    """
+    Combines the output of any number of plugins, incrementally: keeps
+    the highest priority Status seen so far (of equal priorities, the
+    last one wins) and every metric line. add() costs O(k) for k new
+    lines, however much has been added before.
+    """
+
+    def __init__(self, lines=None):
+        self.status = None
+        self.metrics = []
+        if lines is not None:
+            self.add(lines)
+
+    def add(self, lines):
+        """
+        Given an iterable of output lines, add its status and metric
+        lines. Returns the Aggregator.
+        """
+        status = self.status
+        metrics = self.metrics
+        for line in lines:
+            line = line.rstrip('\r\n')
+            try:
+                record = parse_line(line)
+            except IndexError:
+                continue
+            if record is None:
+                continue
+            if type(record) is Status:
+                if status is None or record.priority >= status.priority:
+                    status = record
+            else:
+                metrics.append(line)
+        self.status = status
+        return self
+
+    def merge(self, other):
+        """
+        Add the status and metric lines of another Aggregator. Returns
+        the Aggregator.
+        """
+        if other.status is not None and (self.status is None or
+                                         other.status.priority >= self.status.priority):
+            self.status = other.status
+        self.metrics.extend(other.metrics)
+        return self
+
+    def lines(self):
+        """
+        Return the combined output: the status line (if any), then the
+        metric lines.
+        """
+        if self.status is None:
+            return list(self.metrics)
+        return [' '.join(self.status)] + self.metrics
+
+
+def run_plugins(commands, workers=4, timeout=30):
+    """
+    Given a list of plugin commands, run them (at most workers at a
+    time, each for at most timeout seconds) and return their combined
+    output lines: the highest priority status line, then every metric
+    line. A plugin that times out, can't be run, or prints no status
+    line, counts as an 'err' status.
+    """
+    import monitorlib.runner as runner
+
+    aggregator = Aggregator()
+    for result in runner.run_many(commands, workers, timeout):
+        if result.timed_out:
+            aggregator.add([err("%s timed out after %ss" % (result.command, timeout))])
+            continue
+        if result.error is not None:
+            aggregator.add([err("%s failed to run: %s" % (result.command, result.error))])
+            continue
+        output = Aggregator(result.stdout.splitlines())
+        if output.status is None:
+            aggregator.add([err("%s printed no status (exit code %s)" % (result.command, result.returncode))])
+        aggregator.merge(output)
+    return aggregator.lines()
 
 
 if __name__ == '__main__':
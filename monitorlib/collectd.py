@@ -34,15 +34,70 @@
   url: URL to HTTP POST the JSON alert to
   riemann: send event to riemann. must call configure_riemann() first.
 
+  The sinks are sent to concurrently, each with a deadline (see set_sink_deadlines()).
+  Returns a dict of {sink: report}, also kept in cd.dispatch_report (see fan_out()).
+  Sink errors are re-raised after all sinks are done, unless cd.raise_sink_errors is False.
+
   == optional configuration (required to enable some options):
     === set_pagerduty_key("12309423enfjsdjfosiejfoiw") to set pagerduty auth
-    === set_pagerduty_store([file|redis], [path])
+    === set_pagerduty_store([sqlite|file|redis|local], [path])
         Location to store state information on outstanding alerts.
         To use redis: call set_redis_config() (see below)
-        Default is: set_pagerduty_store('file', '/tmp/incident_keys')
-    === set_redis_config(writer_host, reader_host, writer_port, reader_port, password, [db])
+        Default is: set_pagerduty_store('sqlite', '/tmp/incident_keys.db'), which imports
+        the keys from an old-style '/tmp/incident_keys' pickle, if there is one.
+        'local' stores nothing: incident keys are a hash of the service key, host and
+        check, so no key lookup is done, and resolves are only sent on recovery (and
+        on the ok runs after it, until one gets through).
+    === set_pagerduty_spool([path])
+        Spool pagerduty events on disk (default: state_dir/pagerduty_spool) and deliver
+        them in the background, retrying while pagerduty is unreachable, instead of
+        blocking on (and losing events to) the pagerduty API. See pagerduty.py.
+    === set_state_store([sqlite|file], [path])
+        Keep check state in one sqlite database (default: state_dir/monitorlib-state.db)
+        shared by every check, instead of a JSON file per check. Either way, state is
+        only written when the severity, message or time changed.
+    === set_email_digest([window], [path])
+        Instead of one email per alert, collect alerts for window seconds (default 60)
+        and send one digest per set of recipients, over one SMTP session. Alerts are
+        spooled on disk (default: state_dir/email_spool) and shared by every check on
+        the host; due digests are sent by the next dispatch of any check. If sending
+        them fails, no check retries for a while (EMAIL_BACKOFF_MIN, doubling up to
+        EMAIL_BACKOFF_MAX seconds); meanwhile alerts keep being spooled.
+    === set_redis_config(writer_host, reader_host, writer_port, reader_port, password, [db], [ack_cache_ttl])
         to enable checking with redis for disabled alerts, and pagerduty incident_keys.
-    === configure_riemann(host, port) of the riemann server
+        Connections are pooled per process, and the disabled-alert lists are cached
+        for ack_cache_ttl seconds (default: 10, 0 disables the cache).
+    === configure_riemann(host, port, [proto]) of the riemann server
+        proto is 'tcp' (default) or 'udp' (fire-and-forget). The connection is kept
+        open and reused for every event sent by this process.
+    === set_flap_detection([history], [high], [low], [hold_down], [min_duration])
+        Damp alert storms: page and email notifications are held back while the check
+        is flapping (changed severity in more than high of its last history runs, until
+        that drops below low), until a new severity has lasted min_duration seconds, and
+        for hold_down seconds after the last notification. url and riemann still get
+        every alert. The history is kept next to the check's state. Off by default.
+    === set_metric_transport([unixsock|network|stdout], [path], [host], [port], [notify])
+        Write buffered metrics (add_metric()) straight to collectd's unixsock socket
+        (default /var/run/collectd-unixsock), or as binary network protocol packets over
+        UDP (default localhost:25826), instead of to stdout; for checks not run by the
+        Exec plugin. With notify, alerts are also sent to collectd as notifications.
+        See collectdnet.py.
+    === set_self_monitoring([interval])
+        Every interval seconds (default: the collectd interval), flush_metrics() also
+        writes monitorlib's own numbers, under the 'monitorlib' plugin: how long each
+        dispatch stage (state read, redis check, state write, each sink) took, and how
+        many sends failed or timed out per sink. See emit_stats().
+    === set_sink_deadlines([default], [overall], [pagerduty=N], [email=N], [url=N], [riemann=N])
+        seconds each sink may take (default 10), and all sinks together (default 30).
+
+  == dispatch_many([(resource, severity, message), ...], [page], [email], [url], [riemann], [prune])
+
+  For checks that look at many things (disks, queues) at once: each resource has its
+  own state and alerts as "<check>/<resource>", but state is read and written once,
+  suppression is checked once, and riemann, email and url each get a single batch;
+  pagerduty gets one event per page, with the incident keys looked up at once. With
+  prune, resources missing from the results are forgotten (and resolved, if they
+  weren't ok).
 
   == metric("testing/records", int)
 
@@ -54,6 +109,53 @@
           To get stats.$env.ops.collectd.$host.plugin.instance.foo, use "plugin-instance/gauge-foo".
   value: integer value
 
+  == add_metric("testing/records", value, [timestamp]) and flush_metrics()
+
+  Buffered alternative to metric(): values are collected in cd.writer (a MetricWriter),
+  and flush_metrics() writes them all to stdout with a single write. value may be a
+  list/tuple, for types with more than one data source (e.g. "disk-sda/disk_octets").
+  timestamp defaults to "now" (N). run_forever() flushes after every run.
+
+  == set_riemann_metrics([enabled], [ttl])
+
+  Also send metric values (metric() and add_metric()) to riemann, as metric_f events
+  with service "plugin-instance/type-instance", tagged with riemann_tags, with a TTL of
+  twice the collectd interval (or ttl). They're sent in batches by flush_metrics(), over
+  the persistent riemann connection: call configure_riemann() first, and flush_metrics()
+  at the end of a check that uses metric().
+
+  == incr("path", [count]), timing("path", ms), histogram("path", value)
+
+  statsd-style aggregation, for checks (or daemons) that see many events: values are
+  kept in memory, and flush_metrics() sends one value per series instead of one per
+  event; in run_forever() (and scheduler.py), once per interval (COLLECTD_INTERVAL). incr() sends the count for the interval;
+  timing() and histogram() send path_count, path_min, path_max, path_mean and
+  path_p50/_p95/_p99 (see PERCENTILES), appended to the type instance:
+  timing("app-web/gauge-latency", 12) -> "app-web/gauge-latency_p95", ...
+
+  == cmd("command", [timeout], [max_output]), cmds([commands]), cmd_lines("command")
+
+  Run shell commands: cmd() returns (stdout, stderr), like it always has; cmds() runs
+  several at once and returns runner.Results; cmd_lines() yields output lines as they
+  come. Commands are killed (with everything they started) after timeout seconds, and
+  only max_output bytes of each stream are kept. Set cd.cmd_timeout and
+  cd.cmd_max_output for defaults.
+
+  == set_caller("name") and for_check("name")
+
+  Alerts are sent as, and state is kept under, the script's name. set_caller() changes
+  that; for_check() returns a copy of the Client for another check name, sharing its
+  configuration and connections. scheduler.py uses this to run many checks in one
+  process.
+
+  == run_forever(check, [interval], [iterations])
+
+  Long-running mode, for use as a collectd Exec plugin that never exits:
+  calls check(client) every interval seconds (default: COLLECTD_INTERVAL),
+  reusing the same Client, connections and imports between runs. Per-run
+  state (riemann tags added during the run, alert_message, cur_state) is
+  cleared before each run with reset().
+
  = Thoughts:
   You can use this to send to pagerduty or elsewhere directly through your service
   check plugins. But, that's old-school nagios style.
@@ -66,33 +168,49 @@
 import socket
 import os
 import sys
-import subprocess
-import inspect
+import copy
 import logging
-import urllib2
-import smtplib
 import time
+import array
+import threading
 from time import gmtime, strftime
-from optparse import OptionParser
-from email.MIMEMultipart import MIMEMultipart
-from email.MIMEText import MIMEText
 try:
     import simplejson as json
 except ImportError:
     import json
 
-# if these imports fail, using those components won't work, but they aren't required deps:
-try:
-    import redis
-except ImportError:
-    pass
+# Everything else (subprocess, smtplib, email, redis, bernhard, pagerduty, sqlite, ...) is
+# imported by the method that first needs it, so that a check only pays for importing
+# the sinks it actually uses. Keep it that way: test_collectd.test_import_time_budget
+# fails if the plain import pulls in a sink's deps, or (with MONITORLIB_IMPORT_BUDGET=1
+# in the environment) gets slower than IMPORT_BUDGET.
 
-try:
-    import bernhard
-except ImportError:
-    pass
+# seconds a cold "import monitorlib.collectd" may take, on top of the stdlib modules above
+IMPORT_BUDGET = 0.075
+
+# (reader, reader_port, db, host): (expires, global_acks, host_acks), see check_redis_alerts_disabled()
+ACK_CACHE = {}
+
+# default seconds each sink may take, and all of them together, see Client.set_sink_deadlines()
+SINK_DEADLINE = 10
+DISPATCH_DEADLINE = 30
+
+# plugin name monitorlib's own metrics are sent under (see emit_stats())
+STATS_PLUGIN = 'monitorlib'
 
-import monitorlib.pagerduty as pagerduty
+# metric events per riemann message (see set_riemann_metrics()); over UDP, riemann.py
+# splits them further, to fit in a datagram
+RIEMANN_METRIC_BATCH = 500
+
+# seconds to wait before retrying digests after SMTP failed: doubling from min to max
+EMAIL_BACKOFF_MIN = 30
+EMAIL_BACKOFF_MAX = 600
+
+# percentiles timing() and histogram() series report (see MetricAggregator)
+PERCENTILES = (50, 95, 99)
+
+# values MetricWriter keeps while its transport is failing; the oldest go first
+METRIC_BUFFER_MAX = 100000
 
 class Client:
 
@@ -102,21 +220,46 @@ class Client:
         self.url = url
         self.riemann = riemann
         self.riemann_tags = []
+        self.base_riemann_tags = []
         self.redis_config = None
         self.datastore = 'file'
         self.pagerduty_configured = None
+        self.pagerduty_store = None
         self.pagerduty_key = None
         self.fqdn = os.environ.get('COLLECTD_HOSTNAME', socket.gethostname())
         self.interval = os.environ.get('COLLECTD_INTERVAL', "60")
-        # CALLER = os.path.basename(inspect.stack()[-1][1])
         self.caller = os.path.basename(sys.argv[0])
         self.time = int(time.mktime(time.gmtime()))
         self.state_dir = '/tmp'
         self.state_file = self.state_dir + "/%s" % self.caller
+        self.state_store = None
         self.cur_state = None
         self.alert_message = None
         self.alert_on_status_string_changes = True
         self.no_alerts = disable_alerts
+        self.writer = MetricWriter(self.fqdn, self.interval)
+        self.aggregator = MetricAggregator()
+        self.aggregated_at = time.time()
+        self.sink_deadline = SINK_DEADLINE
+        self.sink_deadlines = {}
+        self.dispatch_deadline = DISPATCH_DEADLINE
+        self.dispatch_report = None
+        self.raise_sink_errors = True
+        self.email_digest_window = None
+        self.email_spool = None
+        self.cmd_timeout = None
+        self.cmd_max_output = None
+        self.damper = None
+        self.flapping = False
+        self.collectd_notify = False
+        self.riemann_metrics = None
+        self.riemann_metric_ttl = None
+        # shared by for_check() copies, so they're per process
+        self.stats_lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.stats_interval = None
+        self.stats_emitted_at = time.time()
 
     def failure(self, string, page=None, email=None, url=None, riemann=None):
         if page is None:
@@ -130,7 +273,7 @@ class Client:
         if riemann is None or riemann is True:
             riemann = self.riemann
 
-        self.dispatch_alert('failure', string, page, email, url, riemann)
+        return self.dispatch_alert('failure', string, page, email, url, riemann)
 
     def warning(self, string, page=None, email=None, url=None, riemann=None):
         if page is None:
@@ -144,7 +287,7 @@ class Client:
         if riemann is None or riemann is True:
             riemann = self.riemann
 
-        self.dispatch_alert('warning', string, page, email, url, riemann)
+        return self.dispatch_alert('warning', string, page, email, url, riemann)
 
     def ok(self, string, page=None, email=None, url=None, riemann=None):
         if page is None:
@@ -158,18 +301,319 @@ class Client:
         if riemann is None or riemann is True:
             riemann = self.riemann
 
-        self.dispatch_alert('okay', string, page, email, url, riemann)
+        return self.dispatch_alert('okay', string, page, email, url, riemann)
 
     def metric(self, path, value):
         ''' formats and returns a collectd metric value (str) '''
-        return "PUTVAL %s/%s interval=%s N:%s" % (self.fqdn, path, self.interval, value)
+        if self.riemann_metrics is not None:
+            self.riemann_metrics.append((path, value, None))
+        return format_putval(self.fqdn, path, self.interval, value)
+
+    def add_metric(self, path, value, timestamp=None):
+        """
+        Buffers a metric value, to be written by flush_metrics().
+        """
+        self.writer.add(path, value, timestamp)
+
+    def incr(self, path, count=1):
+        """
+        Counts count events for path; the total per interval is sent as one value.
+        """
+        self.aggregator.incr(path, count)
+
+    def timing(self, path, ms):
+        """
+        Records a duration for path; sent per interval as path_count, _min, _max, _mean
+        and one path_p<N> per PERCENTILES.
+        """
+        self.aggregator.add(path, ms)
+
+    def histogram(self, path, value):
+        """
+        Records a value for path, summarized per interval like timing().
+        """
+        self.aggregator.add(path, value)
 
-    def cmd(self, command):
+    def flush_aggregates(self):
+        """
+        Adds the values aggregated by incr(), timing() and histogram() since the last
+        call to the metric buffer, and starts over. Returns the number of values added.
+        """
+        self.aggregated_at = time.time()
+        values = self.aggregator.flush()
+        for path, value in values:
+            self.writer.add(path, value)
+        return len(values)
+
+    def flush_metrics(self, wait_interval=False):
+        """
+        Writes all buffered metric values, returns the number written. Aggregated values
+        (see flush_aggregates()) are added too; with wait_interval (for callers that
+        flush more often, like run_forever()), only once an interval has passed since
+        the last time. With set_self_monitoring(), monitorlib's own metrics are added
+        every stats_interval.
+        """
+        if not wait_interval or time.time() - self.aggregated_at >= float(self.interval):
+            self.flush_aggregates()
+        if self.stats_interval is not None and time.time() - self.stats_emitted_at >= self.stats_interval:
+            self.emit_stats()
+
+        values = self.writer.take()
+        errors = self.writer.errors
+        written = self.writer.write(values)
+        if self.writer.errors > errors:
+            self.count('metric_write_errors')
+
+        # after collectd: riemann is the extra copy, it mustn't cost collectd anything
+        if self.riemann_metrics is not None:
+            # metric() values too, which are printed by the caller, not buffered
+            # emptied in place: for_check() copies share the list
+            with self.stats_lock:
+                pending = self.riemann_metrics[:]
+                del self.riemann_metrics[:]
+            self._send_metrics_to_riemann(pending + values)
+        return written
+
+    def set_riemann_metrics(self, enabled=True, ttl=None):
+        """
+        Also sends metric values (metric() and add_metric()) to riemann, as metric_f
+        events, batched per flush_metrics(), over the riemann connection (call
+        configure_riemann() first). Events are tagged with riemann_tags, and expire
+        after ttl seconds (default: twice the collectd interval).
+        """
+        if enabled:
+            self.riemann_metrics = []
+            self.riemann_metric_ttl = ttl
+        else:
+            self.riemann_metrics = None
+
+    def _send_metrics_to_riemann(self, values):
+        """
+        Sends (path, value, timestamp) values to riemann, RIEMANN_METRIC_BATCH events per
+        message. Values that aren't numbers (e.g. collectd's 'U' for unknown) are
+        skipped. Failures are logged and counted, never raised.
+        """
+        if not values:
+            return 0
+        riemann = self.riemann
+        if not riemann or 'host' not in riemann or 'port' not in riemann:
+            logging.error("must call configure_riemann() first")
+            return 0
+
+        ttl = self.riemann_metric_ttl
+        if ttl is None:
+            ttl = 2 * float(self.interval)
+        host = self.fqdn.split('.')[0]
+        tags = list(self.riemann_tags)
+
+        events = []
+        try:
+            for path, value, timestamp in values:
+                if isinstance(value, (list, tuple)):
+                    named = [("%s/%d" % (path, i), v) for i, v in enumerate(value)]
+                else:
+                    named = [(path, value)]
+                for service, metric in named:
+                    try:
+                        metric = float(metric)
+                    except (TypeError, ValueError):
+                        continue
+                    event = {'host': host, 'service': service, 'metric_f': metric, 'ttl': ttl, 'tags': tags}
+                    if timestamp is not None:
+                        event['time'] = int(timestamp)
+                    events.append(event)
+
+            import monitorlib.riemann as riemann_conn
+            conn = riemann_conn.get_connection(riemann['host'], riemann['port'], riemann.get('proto', 'tcp'))
+            for i in range(0, len(events), RIEMANN_METRIC_BATCH):
+                batch = events[i:i + RIEMANN_METRIC_BATCH]
+                if not conn.send_many(batch):
+                    raise RiemannError("riemann didn't acknowledge %d metrics" % len(batch))
+        except Exception:
+            logging.exception("sending %d metrics to riemann failed" % len(events))
+            self.count('riemann_metric_errors')
+            return 0
+        return len(events)
+
+    def set_metric_transport(self, kind='unixsock', path='/var/run/collectd-unixsock', host='localhost',
+                             port=None, notify=False):
+        """
+        Sends buffered metrics (add_metric()) straight to collectd: over the unixsock
+        plugin's socket at path, or kind='network', as binary protocol packets to the
+        network plugin at host:port. kind='stdout' goes back to PUTVAL lines on stdout.
+        With notify, every alert is also sent to collectd as a notification. While
+        collectd can't be reached, values stay buffered (see MetricWriter).
+        """
+        import monitorlib.collectdnet as collectdnet
+        if 'unixsock' in kind:
+            self.writer.transport = collectdnet.UnixsockTransport(path)
+        elif 'network' in kind:
+            self.writer.transport = collectdnet.NetworkTransport(host, port or collectdnet.DEFAULT_PORT)
+        else:
+            self.writer.transport = None
+        self.collectd_notify = notify and self.writer.transport is not None
+
+    def _send_to_collectd(self, message):
+        self.writer.transport.notify(self.fqdn, message['plugin'], message['severity'],
+                                     message['message'])
+
+    def _send_many_to_collectd(self, messages):
+        for message in messages:
+            self._send_to_collectd(message)
+
+    def set_self_monitoring(self, interval=None):
+        """
+        Makes flush_metrics() add the dispatch timings and sink error counts (see
+        emit_stats()) every interval seconds (default: the collectd interval).
+        """
+        if interval is None:
+            interval = self.interval
+        self.stats_interval = float(interval)
+
+    def record_timing(self, name, seconds):
+        """
+        Records how long a dispatch stage (or sink) took.
+        """
+        with self.stats_lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def count(self, name, n=1):
+        with self.stats_lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def emit_stats(self):
+        """
+        Adds monitorlib's own metrics since the last call to the metric buffer, and
+        starts over. Returns the number of values added. Under STATS_PLUGIN:
+        monitorlib-timing/gauge-<stage>: average milliseconds per dispatch stage
+          (state_read, redis_check, state_write, dispatch) and per sink (sink_<name>)
+        monitorlib-timing/gauge-<stage>_max: the slowest one
+        monitorlib-sink/gauge-<name>_errors, <name>_timeouts: failed sends per sink
+        monitorlib-sink/gauge-metric_write_errors: failed metric sends to collectd
+        """
+        with self.stats_lock:
+            # cleared in place: for_check() copies share them
+            timings = dict(self.timings)
+            self.timings.clear()
+            counters = dict(self.counters)
+            self.counters.clear()
+            self.stats_emitted_at = time.time()
+
+        for name in [name[len('sink_'):] for name in timings if name.startswith('sink_')]:
+            counters.setdefault(name + '_errors', 0)
+            counters.setdefault(name + '_timeouts', 0)
+
+        for name, (count, total, slowest) in sorted(timings.items()):
+            self.add_metric('%s-timing/gauge-%s' % (STATS_PLUGIN, name), round(total / count * 1000, 3))
+            self.add_metric('%s-timing/gauge-%s_max' % (STATS_PLUGIN, name), round(slowest * 1000, 3))
+        for name, value in sorted(counters.items()):
+            self.add_metric('%s-sink/gauge-%s' % (STATS_PLUGIN, name), value)
+        return len(timings) * 2 + len(counters)
+
+    def cmd(self, command, timeout=None, max_output=None):
         """ Helper for running shell commands with subprocess().
+            Kills the command (and everything it started) after timeout seconds, and
+            keeps at most max_output bytes of each stream; both default to
+            cmd_timeout/cmd_max_output (None: unlimited). See runner.py.
             Returns: (stdout, stderr)
         """
-        process = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        return process.communicate()
+        result = self.run_cmd(command, timeout, max_output)
+        return result.stdout, result.stderr
+
+    def run_cmd(self, command, timeout=None, max_output=None):
+        """
+        Like cmd(), but returns the runner.Result: returncode, stdout, stderr, timed_out,
+        truncated, elapsed.
+        """
+        import monitorlib.runner as runner
+
+        if timeout is None:
+            timeout = self.cmd_timeout
+        if max_output is None:
+            max_output = self.cmd_max_output
+        return runner.run(command, timeout, max_output)
+
+    def cmds(self, commands, timeout=None, max_output=None, workers=8):
+        """
+        Runs commands concurrently (at most workers at a time), each as run_cmd() would.
+        Returns their runner.Results, in the same order.
+        """
+        import monitorlib.runner as runner
+
+        if timeout is None:
+            timeout = self.cmd_timeout
+        if max_output is None:
+            max_output = self.cmd_max_output
+        return runner.run_many(commands, workers, timeout, max_output)
+
+    def cmd_lines(self, command, timeout=None):
+        """
+        Yields the command's stdout a line at a time, as it's written. Raises
+        runner.CommandTimeout at the end if it was killed after timeout seconds.
+        """
+        import monitorlib.runner as runner
+
+        if timeout is None:
+            timeout = self.cmd_timeout
+        return runner.iter_lines(command, timeout)
+
+    def reset(self):
+        """
+        Clears per-run state, so the Client can be reused for another run of a check.
+        Riemann tags that were set before run_forever() started are kept.
+        """
+        self.riemann_tags = list(self.base_riemann_tags)
+        self.alert_message = None
+        self.cur_state = None
+        self.dispatch_report = None
+        self.flapping = False
+        self.time = int(time.mktime(time.gmtime()))
+
+    def run_forever(self, check, interval=None, iterations=None):
+        """
+        Calls check(self) every interval seconds, until iterations runs have been done
+        (forever, if None). Exceptions raised by check are logged, and don't stop the loop.
+        """
+        if interval is None:
+            interval = self.interval
+        interval = float(interval)
+
+        self.base_riemann_tags = list(self.riemann_tags)
+        next_run = time.time()
+        runs = 0
+
+        while iterations is None or runs < iterations:
+            self.reset()
+            try:
+                check(self)
+            except Exception:
+                logging.exception("check %s failed" % self.caller)
+
+            # collectd reads our stdout through a pipe, so don't leave output sitting in the buffer.
+            self.flush_metrics(wait_interval=True)
+            sys.stdout.flush()
+            runs += 1
+
+            if iterations is not None and runs >= iterations:
+                # what's been aggregated since the last interval
+                if self.flush_aggregates():
+                    self.flush_metrics()
+                    sys.stdout.flush()
+                break
+
+            # schedule off the previous start time, skipping runs we've fallen behind on.
+            next_run += interval
+            now = time.time()
+            if next_run < now:
+                next_run = now
+            time.sleep(next_run - now)
 
     def set_alert_on_status_string_changes(self, toggle=True):
         """
@@ -177,32 +621,151 @@ class Client:
         """
         self.alert_on_status_string_changes = toggle
 
-    def set_pagerduty_store(self, kind='file', config='/tmp/incident_keys'):
+    def set_pagerduty_store(self, kind='sqlite', config='/tmp/incident_keys.db'):
         """
         sets PD storage method, and stores a variable to indicate this has been done
         """
+        import monitorlib.pagerduty as pagerduty
+
         if pagerduty.set_datastore(kind, config):
             self.pagerduty_configured = True
+            self.pagerduty_store = kind
 
-    def configure_riemann(self, host, port):
+    def _resolves(self, severity, prev_state, pending=False):
         """
-        configures host, port for sending events to riemann.
+        Returns True if an ok alert should be sent to pagerduty. Normally every ok is,
+        since pagerduty.py only sends resolves it has an incident key for (and lost
+        ACKs get fixed that way). With local keys every resolve would be sent, so only
+        recoveries are, and the oks after one until it gets through (pending, see
+        _track_resolves()).
         """
-        self.riemann = {'host': host, 'port': port, }
+        if 'ok' not in severity:
+            return False
+        if self._local_keys():
+            return pending or (isinstance(prev_state, dict) and 'ok' not in prev_state.get('severity', 'okay'))
+        return True
+
+    def _local_keys(self):
+        return bool(self.pagerduty_store and 'local' in self.pagerduty_store)
+
+    def _pending_resolves(self):
+        """
+        Returns {plugin: since} of the resolves not delivered to pagerduty yet, kept
+        next to the check's state. Only tracked with local keys: otherwise every ok is
+        sent anyway.
+        """
+        if not self._local_keys():
+            return None
+        return self._read_json('.resolves')
 
-    def set_redis_config(self, writer_host, reader_host, writer_port, reader_port, password, db='db0'):
+    def _track_resolves(self, pending, resolves, messages, now):
+        """
+        Updates the pending resolves after a dispatch: resolves (the ok messages that
+        should have gone to pagerduty) stay pending until the pagerduty send succeeds
+        (flapping, or a failed or timed out send, hold them back), and a check that
+        fails again has nothing left to resolve.
+        """
+        if pending is None:
+            return
+        report = self.dispatch_report or {}
+        delivered = report.get('pagerduty', {}).get('status') == 'ok'
+
+        updated = dict(pending)
+        for message in messages:
+            if 'ok' not in message['severity']:
+                updated.pop(message['plugin'], None)
+        for message in resolves:
+            if delivered:
+                updated.pop(message['plugin'], None)
+            else:
+                updated.setdefault(message['plugin'], now)
+
+        if updated != pending:
+            self._write_json('.resolves', updated)
+
+    def set_pagerduty_spool(self, path=None):
+        """
+        Enables the pagerduty event spool, in path (default: state_dir/pagerduty_spool).
+        """
+        if path is None:
+            path = self.state_dir.rstrip('/') + "/pagerduty_spool"
+
+        import monitorlib.pagerduty as pagerduty
+        pagerduty.set_spool(path)
+
+    def configure_riemann(self, host, port, proto='tcp'):
+        """
+        configures host, port (and tcp or udp) for sending events to riemann.
+        """
+        self.riemann = {'host': host, 'port': port, 'proto': proto, }
+
+    def set_redis_config(self, writer_host, reader_host, writer_port, reader_port, password, db='db0',
+                         ack_cache_ttl=10):
         self.redis_config = {'writer': writer_host,
                              'reader': reader_host,
                              'writer_port': writer_port,
                              'reader_port': reader_port,
                              'passwd': password,
                              'db': db,
+                             'ack_cache_ttl': ack_cache_ttl,
                              }
         self.datastore = 'redis'
 
+    def set_caller(self, name):
+        """
+        Sets the check name alerts are sent as, and state is kept under (default: the
+        script name).
+        """
+        self.caller = name
+        self.state_file = self.state_dir + "/%s" % name
+
+    def for_check(self, name):
+        """
+        Returns a copy of this Client for the check name, with its own state and per-run
+        attributes, sharing configuration, metric buffer and connections with this one.
+        For running many checks in one process (see scheduler.py).
+        """
+        client = copy.copy(self)
+        client.set_caller(name)
+        client.riemann_tags = list(self.riemann_tags)
+        client.base_riemann_tags = list(self.riemann_tags)
+        client.alert_message = None
+        client.cur_state = None
+        client.flapping = False
+        client.dispatch_report = None
+        return client
+
     def set_state_dir(self, dir):
         self.state_dir = dir
         self.state_file = dir + "/%s" % self.caller
+        if self.state_store:
+            self.set_state_store()
+
+    def set_state_store(self, kind='sqlite', path=None):
+        """
+        Keeps check state in one sqlite database per state_dir (default:
+        state_dir/monitorlib-state.db), instead of a file per check. kind='file' goes
+        back to state files.
+        """
+        if 'sqlite' in kind:
+            if path is None:
+                path = self.state_dir.rstrip('/') + "/monitorlib-state.db"
+            import monitorlib.statestore as statestore
+            self.state_store = statestore.get_store(path)
+        else:
+            self.state_store = None
+
+    def set_flap_detection(self, history=20, high=0.5, low=0.25, hold_down=0, min_duration=0):
+        """
+        Holds back page and email notifications while the check is flapping, until a new
+        severity has lasted min_duration seconds, and for hold_down seconds after the
+        last notification (see flap.py). history=None turns it off again.
+        """
+        if history:
+            import monitorlib.flap as flap
+            self.damper = flap.Damper(history, high, low, hold_down, min_duration)
+        else:
+            self.damper = None
 
     def disable_alerts(self):
         self.no_alerts = True
@@ -210,24 +773,33 @@ class Client:
     def check_redis_alerts_disabled(self, message):
         """
         Check redis to see if alerts are disabled for this host - times out after 2 seconds,
-        to not block on an unreachable redis server.
+        to not block on an unreachable redis server. Both ack lists are fetched with one MGET,
+        and cached for ack_cache_ttl seconds (errors too, so a down redis isn't retried by
+        every dispatch).
         """
         conf = self.redis_config
+        ttl = conf.get('ack_cache_ttl', 0)
+        cache_key = (conf['reader'], conf['reader_port'], conf['db'], message['host'])
 
-        # key: host, value: list of plugins that are disabled (or '*' for all)
-        conn = redis.Redis(conf['reader'], conf['reader_port'], conf['db'], conf['passwd'], socket_timeout=2)
-
-        if not conn:
-            return False
+        cached = ACK_CACHE.get(cache_key)
+        if ttl and cached and cached[0] > time.time():
+            global_acks, result = cached[1:]
         else:
+            # key: host, value: list of plugins that are disabled (or '*' for all)
+            import redis
+            import monitorlib.redispool as redispool
+
+            conn = redispool.get_connection(conf['reader'], conf['reader_port'], conf['db'], conf['passwd'])
             try:
-                global_acks = conn.get('global')
-                if global_acks and ('*' in global_acks or message['plugin'] in global_acks):
-                    return True
-                else:
-                    result = conn.get(message['host'])
+                global_acks, result = conn.mget(['global', message['host']])
             except redis.exceptions.RedisError:
-                return False
+                global_acks, result = None, None
+
+            if ttl:
+                ACK_CACHE[cache_key] = (time.time() + ttl, global_acks, result)
+
+        if global_acks and ('*' in global_acks or message['plugin'] in global_acks):
+            return True
 
         if result and ('*' in result or message['plugin'] in result):
             return True
@@ -238,6 +810,8 @@ class Client:
         """
         Returns "new" if it can't open the state_file. Otherwise, returns the text in the file.
         """
+        if self.state_store:
+            return self.state_store.get(self.caller) or "new"
 
         if not os.path.exists(self.state_file):
             return "new"
@@ -245,37 +819,73 @@ class Client:
         with open(self.state_file, 'r') as fh:
             return fh.readline()
 
-    def dispatch_alert(self, severity, message, page, email, url, riemann):
+    def write_state(self, message):
         """
-        dispatch_alerts alerts based on params, and keep state, etc...
+        Writes message to the state_file (or state store), as the current state.
         """
+        if self.state_store:
+            self.state_store.put(self.caller, message)
+            return
 
-        now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
-        message = {"host": self.fqdn.split('.')[0], "plugin": self.caller, "severity": severity, "message": message}
+        with open(self.state_file, 'w') as fh:
+            fh.write(json.dumps(message))
 
-        # print the error, so when running plugins by hand we see the current state
-        if not os.environ.get('COLLECTD_HOSTNAME'):
-            print "Dispatching alert with severity %s: %s." % (severity, message)
+    def _read_json(self, suffix):
+        """
+        Returns the dict kept next to the check's state, under its name + suffix, or {}.
+        """
+        if self.state_store:
+            text = self.state_store.get(self.caller + suffix)
+        elif os.path.exists(self.state_file + suffix):
+            with open(self.state_file + suffix, 'r') as fh:
+                text = fh.read()
+        else:
+            text = None
 
-        # track this, to make it available to external users of the lib.
-        # e.g. they may want to call send_to_pagerduty() directly if RiemannError is raised.
-        self.alert_message = message
+        try:
+            return json.loads(text or '{}')
+        except ValueError:
+            return {}
 
-        # check if notifications for this host are disabled, and bail if so
-        if self.datastore and 'redis' in self.datastore:
-            if not self.redis_config:
-                logging.error("must call redis_config(), first")
-            elif self.check_redis_alerts_disabled(message):
-                logging.info("alerting disabled, supressing alert for: %s, %s" % (message['host'], message['plugin']))
-                return None
+    def _write_json(self, suffix, data):
+        if self.state_store:
+            self.state_store.put(self.caller + suffix, data)
+            return
 
-        # get last_state:
-        read_state = self.get_current_state()
-        try:
-            state = json.loads(read_state)
-        except ValueError as err:
-            # can't JSON decode it? May be old format, or had none existing. That's OK.
-            state = {}
+        with open(self.state_file + suffix, 'w') as fh:
+            fh.write(json.dumps(data))
+
+    def get_history(self):
+        """
+        Returns the flap detection history kept next to the check's state, or {}.
+        """
+        return self._read_json('.history')
+
+    def write_history(self, history):
+        self._write_json('.history', history)
+
+    def _damp(self, severity, transitioned):
+        """
+        Runs flap detection on this alert, and returns True if it should be notified.
+        The history is only written when it changed (it doesn't, while a check is steady).
+        """
+        history = self.get_history()
+        before = copy.deepcopy(history)
+        notify = self.damper.update(history, severity, transitioned, time.time())
+        self.flapping = history['flapping']
+        if history != before:
+            self.write_history(history)
+
+        if transitioned and not notify:
+            logging.info("damping notification for %s (flapping: %s)" % (self.caller, self.flapping))
+        return notify
+
+    def _transition(self, message, state, now):
+        """
+        Compares message to the last state, and returns 'transitioned' if it should be
+        alerted on, or the last state. Sets message['time'] to when the state started.
+        """
+        severity = message['severity']
 
         if state is None or state == {}:
             # state file didn't exist - first-run of this check, so don't alert if it's 'ok'
@@ -306,35 +916,262 @@ class Client:
         if 'time' not in message:
             message['time'] = state.get('time', now)
 
+        return state
+
+    def dispatch_alert(self, severity, message, page, email, url, riemann):
+        """
+        dispatch_alerts alerts based on params, and keep state, etc...
+        """
+
+        started = time.time()
+        now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+        message = {"host": self.fqdn.split('.')[0], "plugin": self.caller, "severity": severity, "message": message}
+
+        # print the error, so when running plugins by hand we see the current state
+        if not os.environ.get('COLLECTD_HOSTNAME'):
+            print "Dispatching alert with severity %s: %s." % (severity, message)
+
+        # track this, to make it available to external users of the lib.
+        # e.g. they may want to call send_to_pagerduty() directly if RiemannError is raised.
+        self.alert_message = message
+
+        # check if notifications for this host are disabled, and bail if so
+        if self.datastore and 'redis' in self.datastore:
+            if not self.redis_config:
+                logging.error("must call redis_config(), first")
+            else:
+                stage = time.time()
+                disabled = self.check_redis_alerts_disabled(message)
+                self.record_timing('redis_check', time.time() - stage)
+                if disabled:
+                    logging.info("alerting disabled, supressing alert for: %s, %s" % (message['host'], message['plugin']))
+                    return None
+
+        # get last_state:
+        stage = time.time()
+        read_state = self.get_current_state()
+        self.record_timing('state_read', time.time() - stage)
+        try:
+            state = json.loads(read_state)
+        except ValueError as err:
+            # can't JSON decode it? May be old format, or had none existing. That's OK.
+            state = {}
+
+        prev_state = state
+        state = self._transition(message, state, now)
+
         # make available externally
         self.cur_state = state
 
-        # write the current state (every time!):
-        with open(self.state_file, 'w') as fh:
-            fh.write(json.dumps(message))
+        # write the current state, if anything (severity, message or time) changed:
+        if message != prev_state:
+            stage = time.time()
+            self.write_state(message)
+            self.record_timing('state_write', time.time() - stage)
+
+        # with flap detection on, page and email wait until the check settles down
+        notify = 'transitioned' in state
+        if self.damper:
+            notify = self._damp(severity, notify)
+
+        pending = self._pending_resolves()
+        resolves = []
+        if self._resolves(severity, prev_state, bool(pending) and message['plugin'] in pending):
+            resolves.append(message)
+
+        # collect the sends, and do them all at once (see fan_out()):
+        sends = []
 
         # if paging was requested, do it, unless the state is the same as last time,
         # except, if we're in OK, send that to PD because the lib won't do it unless
         # there is an incident key. This is to make sure ACKs happen.. sometimes they
         # get lost.
-        if page and not self.no_alerts and ('ok' in message['severity'] or 'transitioned' in state):
+        if page and not self.no_alerts and ((resolves and not self.flapping) or notify):
             if not self.pagerduty_key:
                 logging.error("must call set_pagerduty_key(), first")
             else:
-                self.send_to_pagerduty(message)
+                sends.append(('pagerduty', self.send_to_pagerduty, (message,)))
 
         # only email if state is new since last time
-        if email and 'transitioned' in state and not self.no_alerts:
-            self._send_to_email(email, message)
+        if email and notify and not self.no_alerts:
+            sends.append(('email', self._send_to_email, (email, message)))
+        elif self.email_digest_window is not None:
+            # digests go out once their window has passed, whether or not this alert emails
+            sends.append(('email', self._flush_email_digest_quietly, ()))
 
         # if 'url' was requested, always post to it regardless of state
         if url:
-            self._post_to_url(message, url)
+            sends.append(('url', self._post_to_url, (message, url)))
 
         # if 'riemann' was requested, always send the event to riemann
         #
         if riemann:
-            self._send_to_riemann(riemann, message)
+            sends.append(('riemann', self._send_to_riemann, (riemann, message)))
+
+        if self.collectd_notify:
+            sends.append(('collectd', self._send_to_collectd, (message,)))
+
+        try:
+            return self._fan_out(sends)
+        finally:
+            # even if a sink error is raised
+            self._track_resolves(pending, resolves, [message], now)
+            self.record_timing('dispatch', time.time() - started)
+
+    def dispatch_many(self, results, page=None, email=None, url=None, riemann=None, prune=False):
+        """
+        Dispatches alerts for many sub-resources (disks, queues, ...) of this check at
+        once: results is a list of (resource, severity, message), with severity 'ok',
+        'warning' or 'failure'. Each resource has its own state, alerts as
+        "<check>/<resource>", and transitions like a separate check would, but state is
+        read and written once, suppression is looked up once, and most sinks get one
+        batch: one riemann message, one url POST (a JSON list), one email. Pagerduty
+        has no batch call: it gets one event per page, but the incident keys are
+        looked up at once. Flap detection isn't applied.
+
+        Resources missing from results keep their state, unless prune is set: then
+        they're dropped from it, and ones that weren't ok are sent as an 'okay' (so
+        their incidents resolve). Returns the fan_out() report, like ok() etc.
+        """
+        started = time.time()
+        now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+        host = self.fqdn.split('.')[0]
+        if page is None:
+            page = self.page
+        if email is None:
+            email = self.email
+        if url is None:
+            url = self.url
+        if riemann is None or riemann is True:
+            riemann = self.riemann
+
+        if self.datastore and 'redis' in self.datastore:
+            if not self.redis_config:
+                logging.error("must call redis_config(), first")
+            else:
+                stage = time.time()
+                disabled = self.check_redis_alerts_disabled({'host': host, 'plugin': self.caller})
+                self.record_timing('redis_check', time.time() - stage)
+                if disabled:
+                    logging.info("alerting disabled, supressing alerts for: %s, %s" % (host, self.caller))
+                    return None
+
+        stage = time.time()
+        states = self._read_json('.resources')
+        self.record_timing('state_read', time.time() - stage)
+
+        new_states = dict(states)
+        messages = []
+        transitioned = []
+        pages = []
+        pending = self._pending_resolves()
+        resolves = []
+        for resource, severity, text in results:
+            if severity == 'ok':
+                severity = 'okay'
+            message = {"host": host, "plugin": "%s/%s" % (self.caller, resource), "severity": severity,
+                       "message": text}
+            resolve = self._resolves(severity, states.get(resource), bool(pending) and message['plugin'] in pending)
+            if resolve:
+                resolves.append(message)
+            if 'transitioned' in self._transition(message, states.get(resource), now):
+                transitioned.append(message)
+                pages.append(message)
+            elif resolve:
+                # as in dispatch_alert(): page oks too, to make sure resolves happen
+                pages.append(message)
+            messages.append(message)
+            new_states[resource] = message
+
+        if prune:
+            reported = set([resource for resource, severity, text in results])
+            for resource, state in sorted(states.items()):
+                if resource in reported:
+                    continue
+                del new_states[resource]
+                plugin = "%s/%s" % (self.caller, resource)
+                recovered = 'okay' not in state.get('severity', 'okay')
+                if recovered or (pending and plugin in pending):
+                    message = {"host": host, "plugin": plugin, "severity": 'okay',
+                               "message": "no longer reported", "time": now}
+                    if recovered:
+                        transitioned.append(message)
+                    pages.append(message)
+                    resolves.append(message)
+                    messages.append(message)
+
+        self.alert_message = messages
+        self.cur_state = transitioned
+
+        if new_states != states:
+            stage = time.time()
+            self._write_json('.resources', new_states)
+            self.record_timing('state_write', time.time() - stage)
+
+        sends = []
+
+        if page and not self.no_alerts and pages:
+            if not self.pagerduty_key:
+                logging.error("must call set_pagerduty_key(), first")
+            else:
+                sends.append(('pagerduty', self._send_many_to_pagerduty, (pages,)))
+
+        if email and transitioned and not self.no_alerts:
+            sends.append(('email', self._send_many_to_email, (email, transitioned)))
+        elif self.email_digest_window is not None:
+            sends.append(('email', self._flush_email_digest_quietly, ()))
+
+        if url:
+            sends.append(('url', self._post_to_url, (messages, url)))
+
+        if riemann:
+            sends.append(('riemann', self._send_many_to_riemann, (riemann, messages)))
+
+        if self.collectd_notify:
+            sends.append(('collectd', self._send_many_to_collectd, (messages,)))
+
+        try:
+            return self._fan_out(sends)
+        finally:
+            self._track_resolves(pending, resolves, messages, now)
+            self.record_timing('dispatch', time.time() - started)
+
+    def set_sink_deadlines(self, default=None, overall=None, **sinks):
+        """
+        Sets how many seconds each sink (pagerduty, email, url, riemann) may take, and
+        how long dispatching may take overall. e.g. set_sink_deadlines(5, 20, email=15)
+        """
+        if default is not None:
+            self.sink_deadline = default
+        if overall is not None:
+            self.dispatch_deadline = overall
+        self.sink_deadlines.update(sinks)
+
+    def _fan_out(self, sends):
+        """
+        Runs the sends concurrently, and returns (and keeps in self.dispatch_report) the
+        per-sink report from fan_out(). If raise_sink_errors is set, the first error is
+        re-raised once every sink has finished or timed out.
+        """
+        deadlines = dict([(name, self.sink_deadlines.get(name, self.sink_deadline)) for name, _, _ in sends])
+        report = fan_out(sends, deadlines, self.dispatch_deadline)
+        self.dispatch_report = report
+
+        for name, _, _ in sends:
+            self.record_timing('sink_' + name, report[name]['elapsed'])
+            if report[name]['status'] == 'timeout':
+                logging.error("sending to %s timed out after %.1fs" % (name, report[name]['elapsed']))
+                self.count(name + '_timeouts')
+            elif report[name]['status'] == 'error':
+                self.count(name + '_errors')
+
+        if self.raise_sink_errors:
+            for name, _, _ in sends:
+                if report[name]['status'] == 'error':
+                    exc_info = report[name]['exc_info']
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+        return report
 
     def set_pagerduty_key(self, key):
         self.pagerduty_key = key
@@ -352,41 +1189,82 @@ class Client:
         if 'host' not in riemann or 'port' not in riemann:
             raise RiemannError("must call riemann_config() first")
         try:
-            riemann = bernhard.Client(host=riemann.get('host'), port=riemann.get('port'))
-            riemann.send({'host': message['host'],
-                          'service': message['plugin'],
-                          'state': message['severity'],
-                          'description': message['message'],
-                          'tags': self.riemann_tags,
-                          })
+            import monitorlib.riemann as riemann_conn
+            conn = riemann_conn.get_connection(riemann['host'], riemann['port'], riemann.get('proto', 'tcp'))
+            conn.send(self._riemann_event(message))
         except:
             e = sys.exc_info()[0]
             raise RiemannError(str(e) + str(message))
 
+    def _send_many_to_riemann(self, riemann, messages):
+        """
+        Sends the events to riemann in one message, raises RiemannError if it doesn't work.
+        """
+        if 'host' not in riemann or 'port' not in riemann:
+            raise RiemannError("must call riemann_config() first")
+        try:
+            import monitorlib.riemann as riemann_conn
+            conn = riemann_conn.get_connection(riemann['host'], riemann['port'], riemann.get('proto', 'tcp'))
+            conn.send_many([self._riemann_event(message) for message in messages])
+        except:
+            e = sys.exc_info()[0]
+            raise RiemannError("%s (%d events)" % (e, len(messages)))
+
+    def _riemann_event(self, message):
+        """
+        Returns the riemann event (dict) for an alert message.
+        """
+        return {'host': message['host'],
+                'service': message['plugin'],
+                'state': message['severity'],
+                'description': message['message'],
+                'tags': list(self.riemann_tags),
+                }
+
     def send_to_pagerduty(self, message, key=None):
         """
         Sends alert to pager duty - you must call authenticate() first
         """
+        pagerduty = self._pagerduty(key)
+        pagerduty.event(*self._pagerduty_event(message))
+
+    def _send_many_to_pagerduty(self, messages):
+        """
+        Sends the alerts to pager duty, looking up all their incident keys at once.
+        """
+        pagerduty = self._pagerduty()
+        pagerduty.events([self._pagerduty_event(message) for message in messages])
+
+    def _pagerduty(self, key=None):
+        """
+        Returns the pagerduty module, set up with this Client's key store, and
+        authenticated with key (default: the Client's pagerduty key).
+        """
+        import monitorlib.pagerduty as pagerduty
+
         # if not already done, call config function to set defaults
         if not self.pagerduty_configured:
             if self.redis_config:
                 self.set_pagerduty_store('redis', self.redis_config)
             elif self.state_dir:
-                self.set_pagerduty_store('file', self.state_dir.rstrip('/') + "/incident_keys")
+                self.set_pagerduty_store('sqlite', self.state_dir.rstrip('/') + "/incident_keys.db")
 
         # if we called this with a key=, we're wanting to use a different API key for this send.
         if key is not None:
             pagerduty.authenticate(key)
         else:
             pagerduty.authenticate(self.pagerduty_key)
+        return pagerduty
 
+    def _pagerduty_event(self, message):
+        """
+        Returns (event type, description) for an alert message.
+        """
         send_string = "%s: %s %s: %s" % (message['severity'].upper(), message['host'], message['plugin'], message['message'])
 
         if 'okay' in message['severity']:
-            pagerduty.event('resolve', send_string)
-
-        elif 'failure' or 'warning' in message['serverity']:
-            pagerduty.event('trigger', send_string)
+            return 'resolve', send_string
+        return 'trigger', send_string
 
     def _send_to_socket(self, message, host, port):
         """
@@ -402,36 +1280,369 @@ class Client:
         """
         HTTP POSTs message to url
         """
-        req = urllib2.Request(url, json.dumps(message), {'Content-Type': 'application/json'})
-        f = urllib2.urlopen(req)
-        resp = f.read()
-        f.close()
-
-        return resp
+        import monitorlib.httppool as httppool
+        return httppool.post_json(url, message)
 
     def _send_to_email(self, address, message):
         """
-        Sends alert via email
+        Sends alert via email, or adds it to the digest (see set_email_digest()).
         """
         print "emailing: ", address
 
+        if self.email_digest_window is not None:
+            self._email_spool().append({'to': address, 'message': message, 'time': time.time()})
+            return self.flush_email_digest()
+
         alert_subject = "%s %s: %s" % (message['host'], message['plugin'], message['message'])
+        subject = '[collectd] %s %s' % (message['severity'].upper(), alert_subject)
+        self._send_mails([(address, subject, str(message))])
 
-        me = 'collectd@krux.com'
-        you = [address.lstrip().rstrip() for address in address.split(',')]
+    def _send_many_to_email(self, address, messages):
+        """
+        Sends the alerts in one email, or adds them to the digest.
+        """
+        if self.email_digest_window is not None:
+            email_spool = self._email_spool()
+            for message in messages:
+                email_spool.append({'to': address, 'message': message, 'time': time.time()})
+            return self.flush_email_digest()
 
-        msg = MIMEMultipart()
-        msg['Subject'] = '[collectd] %s %s' % (message['severity'].upper(), alert_subject)
-        msg['From'] = me
-        # To: header must be a string, and there must be a whitespace after the comma.
-        msg['To'] = ", ".join(you)
-        body = MIMEText(str(message))
-        msg.attach(body)
+        self._send_email_digests([{'to': address, 'message': message} for message in messages])
+
+    def _send_mails(self, mails):
+        """
+        Sends (address, subject, body) mails over a single SMTP session.
+        """
+        import smtplib
+        from email.MIMEMultipart import MIMEMultipart
+        from email.MIMEText import MIMEText
+
+        me = 'collectd@krux.com'
 
         s = smtplib.SMTP('localhost')
-        # the call to sendmail, needs 'you' to be a list:
-        s.sendmail(me, you, msg.as_string())
-        s.quit()
+        try:
+            for address, subject, text in mails:
+                you = [address.lstrip().rstrip() for address in address.split(',')]
+
+                msg = MIMEMultipart()
+                msg['Subject'] = subject
+                msg['From'] = me
+                # To: header must be a string, and there must be a whitespace after the comma.
+                msg['To'] = ", ".join(you)
+                body = MIMEText(text)
+                msg.attach(body)
+
+                # the call to sendmail, needs 'you' to be a list:
+                s.sendmail(me, you, msg.as_string())
+        finally:
+            s.quit()
+
+    def set_email_digest(self, window=60, path=None):
+        """
+        Collects email alerts for window seconds, then sends one digest per set of
+        recipients. The alerts are spooled in path (default: state_dir/email_spool), so
+        every check on the host shares the same digests. None disables digests.
+        """
+        self.email_digest_window = window
+        self.email_spool = path
+
+    def _email_spool_path(self):
+        return self.email_spool or self.state_dir.rstrip('/') + "/email_spool"
+
+    def _email_spool(self):
+        import monitorlib.spool as spool
+
+        return spool.Spool(self._email_spool_path())
+
+    def flush_email_digest(self, force=False):
+        """
+        Sends the digests, if the oldest spooled alert is older than the digest window,
+        and no recent failure is being backed off from (or force is set). Returns the
+        number of alerts sent.
+        """
+        email_spool = self._email_spool()
+        oldest = email_spool.oldest()
+        if oldest is None:
+            return 0
+        if not force and time.time() - oldest['time'] < self.email_digest_window:
+            return 0
+
+        backoff = self._email_backoff()
+        if not force and time.time() < backoff.get('retry_at', 0):
+            return 0
+        try:
+            sent = email_spool.drain_all(self._send_email_digests) or 0
+        except Exception:
+            # shared by every check on the host, like the spool
+            delay = min(max(backoff.get('delay', 0) * 2, EMAIL_BACKOFF_MIN), EMAIL_BACKOFF_MAX)
+            self._write_email_backoff({'retry_at': time.time() + delay, 'delay': delay})
+            raise
+        if backoff:
+            self._write_email_backoff(None)
+        return sent
+
+    def _flush_email_digest_quietly(self):
+        """
+        flush_email_digest(), for dispatches that don't email themselves: failures are
+        logged and counted, not raised (the alerts stay spooled).
+        """
+        try:
+            return self.flush_email_digest()
+        except Exception:
+            logging.exception("sending email digests failed, retrying later")
+            self.count('email_digest_errors')
+            return 0
+
+    def _email_backoff(self):
+        """
+        Returns {'retry_at': .., 'delay': ..} after a failed digest send, or {}.
+        """
+        try:
+            with open(self._email_spool_path() + '.backoff', 'r') as fh:
+                return json.loads(fh.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _write_email_backoff(self, backoff):
+        import monitorlib.spool as spool
+
+        path = self._email_spool_path() + '.backoff'
+        if backoff is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            spool.write_atomic(path, json.dumps(backoff))
+
+    def _send_email_digests(self, records):
+        """
+        Groups spooled alerts by recipients, and sends one mail per group.
+        """
+        groups = {}
+        order = []
+        for record in records:
+            recipients = ", ".join(sorted([a.strip() for a in record['to'].split(',')]))
+            if recipients not in groups:
+                groups[recipients] = []
+                order.append(recipients)
+            groups[recipients].append(record['message'])
+
+        mails = []
+        for recipients in order:
+            messages = groups[recipients]
+            if len(messages) == 1:
+                message = messages[0]
+                subject = '[collectd] %s %s %s: %s' % (message['severity'].upper(), message['host'],
+                                                       message['plugin'], message['message'])
+            else:
+                hosts = sorted(set([message['host'] for message in messages]))
+                subject = '[collectd] %d alerts: %s' % (len(messages), ", ".join(hosts))
+            body = "\n".join(["%s %s %s %s: %s" % (message.get('time', ''), message['severity'].upper(),
+                                                     message['host'], message['plugin'], message['message'])
+                               for message in messages])
+            mails.append((recipients, subject, body))
+
+        self._send_mails(mails)
+
+def fan_out(sends, deadlines, overall):
+    """
+    Calls each func(*args) in sends, a list of (name, func, args), in its own thread.
+    Waits up to deadlines[name] seconds for each, and overall seconds in total.
+    Returns {name: report}, where report is a dict with 'status' ('ok', 'error' or
+    'timeout'), 'elapsed' seconds and 'result' (ok) or 'error' and 'exc_info' (error).
+    Sends that time out are left running in the background (threads can't be killed).
+    """
+    start = time.time()
+    running = []
+
+    for name, func, args in sends:
+        holder = {}
+        thread = threading.Thread(target=_run_send, args=(holder, start, func, args))
+        thread.daemon = True
+        thread.start()
+        running.append((name, thread, holder))
+
+    report = {}
+    for name, thread, holder in running:
+        deadline = min(start + deadlines.get(name, overall), start + overall)
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            report[name] = {'status': 'timeout', 'elapsed': time.time() - start}
+        else:
+            report[name] = holder
+    return report
+
+
+def _run_send(holder, start, func, args):
+    try:
+        holder['result'] = func(*args)
+        holder['status'] = 'ok'
+    except Exception as err:
+        holder['status'] = 'error'
+        holder['error'] = err
+        holder['exc_info'] = sys.exc_info()
+    holder['elapsed'] = time.time() - start
+
+
+def format_putval(host, path, interval, value, timestamp=None):
+    """
+    Returns a collectd PUTVAL line (without newline). value may be a single value,
+    or a list/tuple of values for multi-value types. timestamp defaults to N (now).
+    """
+    if isinstance(value, (list, tuple)):
+        value = ':'.join([str(v) for v in value])
+    if timestamp is None:
+        timestamp = 'N'
+    else:
+        timestamp = int(timestamp)
+    return "PUTVAL %s/%s interval=%s %s:%s" % (host, path, interval, timestamp, value)
+
+
+class MetricWriter:
+    """
+    Buffers metric values, and writes them as PUTVAL lines in one write() per flush(),
+    so lines are never interleaved or half-written. With a transport (see
+    collectdnet.py), flush() hands the values to it instead; if that fails (e.g.
+    collectd is restarting), the error is logged and counted in errors, and the values
+    stay buffered (up to max_values) for the next flush, which reconnects.
+    """
+
+    def __init__(self, host, interval, stream=None, transport=None, max_values=METRIC_BUFFER_MAX):
+        self.host = host
+        self.interval = interval
+        # None means sys.stdout, looked up at flush time.
+        self.stream = stream
+        self.transport = transport
+        self.max_values = max_values
+        self.values = []
+        self.errors = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, path, value, timestamp=None):
+        """
+        Buffers a value (or list of values) for path: "plugin-instance/type-instance"
+        """
+        self.values.append((path, value, timestamp))
+
+    def lines(self):
+        """
+        Returns the buffered values as PUTVAL lines.
+        """
+        host = self.host
+        interval = self.interval
+        return [format_putval(host, path, interval, value, timestamp)
+                for path, value, timestamp in self.values]
+
+    def flush(self):
+        """
+        Writes and clears the buffer, returns the number of values written.
+        """
+        if not self.values:
+            return 0
+
+        return self.write(self.take())
+
+    def take(self):
+        """
+        Returns and clears the buffered values.
+        """
+        # swap the buffer out, so values added by other threads meanwhile aren't lost.
+        values, self.values = self.values, []
+        return values
+
+    def write(self, values):
+        """
+        Writes values (from take()), returns the number written.
+        """
+        if not values:
+            return 0
+
+        host = self.host
+        interval = self.interval
+        count = len(values)
+        if self.transport is not None:
+            try:
+                self.transport.send(host, interval, values)
+            except EnvironmentError as err:
+                # socket errors included: collectd isn't there right now, try again next time
+                # (only what didn't get through, see UnixsockTransport.command())
+                sent = getattr(err, 'sent', 0)
+                self.errors += 1
+                logging.error("sending %d values to collectd failed, keeping them: %s" % (count - sent, err))
+                self.requeue(values[sent:])
+                return sent
+            except Exception:
+                # the values themselves are bad: sending them again won't help
+                self.errors += 1
+                logging.exception("sending %d values to collectd failed, dropping them" % count)
+                return 0
+            return count
+
+        data = '\n'.join([format_putval(host, path, interval, value, timestamp)
+                          for path, value, timestamp in values]) + '\n'
+
+        stream = self.stream or sys.stdout
+        stream.write(data)
+        stream.flush()
+        return count
+
+    def requeue(self, values):
+        """
+        Puts values (that couldn't be written) back in front of the buffer, dropping the
+        oldest if it's over max_values.
+        """
+        self.values[:0] = values
+        dropped = len(self.values) - self.max_values
+        if dropped > 0:
+            logging.error("metric buffer is full, dropping the %d oldest values" % dropped)
+            del self.values[:dropped]
+
+
+class MetricAggregator:
+    """
+    Accumulates counters and samples between flushes: a float per counter, and an
+    array of doubles per timing/histogram series (8 bytes a sample). Thread-safe.
+    """
+
+    def __init__(self, percentiles=PERCENTILES):
+        self.percentiles = percentiles
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.samples = {}
+
+    def incr(self, path, count=1):
+        with self.lock:
+            self.counters[path] = self.counters.get(path, 0) + count
+
+    def add(self, path, value):
+        with self.lock:
+            samples = self.samples.get(path)
+            if samples is None:
+                samples = self.samples[path] = array.array('d')
+            samples.append(value)
+
+    def flush(self):
+        """
+        Returns [(path, value)] for everything since the last flush, and starts over.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            samples, self.samples = self.samples, {}
+
+        values = sorted(counters.items())
+        for path, series in sorted(samples.items()):
+            series = sorted(series)
+            count = len(series)
+            values.extend([(path + '_count', count),
+                           (path + '_min', series[0]),
+                           (path + '_max', series[-1]),
+                           (path + '_mean', sum(series) / count)])
+            for percentile in self.percentiles:
+                # nearest rank: ceil(percentile% of count)
+                rank = max(int((percentile * count + 99) // 100), 1)
+                values.append((path + '_p%s' % percentile, series[rank - 1]))
+        return values
 
 
 class RiemannError(Exception):
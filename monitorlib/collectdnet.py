@@ -0,0 +1,330 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Sends metrics and notifications straight to collectd, instead of as text on the
+    Exec plugin's stdout: over the unixsock plugin's socket, or as binary network
+    protocol packets over UDP (to the network plugin).
+
+    Usage:
+    transport = collectdnet.UnixsockTransport('/var/run/collectd-unixsock')
+    transport = collectdnet.NetworkTransport('localhost', 25826)
+    transport.send(host, interval, [(path, value, timestamp), ...])
+    transport.notify(host, plugin, severity, message)
+
+    path is "plugin-instance/type-instance", as for collectd.Client.metric(); value is
+    a number, or a list of them for types with more than one data source; timestamp
+    is seconds since the epoch, or None for now.
+
+    UnixsockTransport writes the PUTVALs of a send() COMMAND_CHUNK at a time, reading
+    each chunk's replies before writing the next: a batch costs one round trip per
+    chunk, and collectd never blocks on replies we haven't read (which would block us
+    in turn). NetworkTransport packs as many values as fit in
+    a packet (MAX_PACKET bytes), and only repeats the host/plugin/type parts when
+    they change, as collectd itself does. The network protocol needs each value's data
+    source type: they are looked up by type name in TYPES, and default to gauge.
+"""
+
+import time
+import socket
+import struct
+import logging
+import threading
+
+# the part types of the network protocol
+TYPE_HOST = 0x0000
+TYPE_TIME = 0x0001
+TYPE_PLUGIN = 0x0002
+TYPE_PLUGIN_INSTANCE = 0x0003
+TYPE_TYPE = 0x0004
+TYPE_TYPE_INSTANCE = 0x0005
+TYPE_VALUES = 0x0006
+TYPE_INTERVAL = 0x0007
+TYPE_TIME_HR = 0x0008
+TYPE_MESSAGE = 0x0100
+TYPE_SEVERITY = 0x0101
+
+# data source types
+COUNTER = 0
+GAUGE = 1
+DERIVE = 2
+ABSOLUTE = 3
+
+# type name: data source types, from collectd's types.db; anything else is a gauge
+TYPES = {
+    'counter': [COUNTER],
+    'derive': [DERIVE],
+    'absolute': [ABSOLUTE],
+    'disk_octets': [DERIVE, DERIVE],
+    'disk_ops': [DERIVE, DERIVE],
+    'disk_time': [DERIVE, DERIVE],
+    'if_octets': [DERIVE, DERIVE],
+    'if_packets': [DERIVE, DERIVE],
+    'if_errors': [DERIVE, DERIVE],
+    'cpu': [DERIVE],
+    'total_requests': [DERIVE],
+}
+
+SEVERITIES = {'failure': 1, 'warning': 2, 'okay': 4}
+
+# the largest packet collectd's network plugin reads by default
+MAX_PACKET = 1452
+
+DEFAULT_PORT = 25826
+
+# unixsock commands written before reading their replies; their replies have to fit
+# in the socket buffer, or collectd (and then we) would block
+COMMAND_CHUNK = 200
+
+
+def split_path(path):
+    """
+    Returns (plugin, plugin instance, type, type instance) for "plugin-instance/type-instance".
+    """
+    plugin, type_ = path.split('/', 1)
+    plugin, _, plugin_instance = plugin.partition('-')
+    type_, _, type_instance = type_.partition('-')
+    return plugin, plugin_instance, type_, type_instance
+
+
+def string_part(part_type, value):
+    value = str(value)
+    return struct.pack('!HH', part_type, len(value) + 5) + value + '\0'
+
+
+def number_part(part_type, value):
+    return struct.pack('!HHQ', part_type, 12, value)
+
+
+def coerce(ds_type, value):
+    """
+    Returns value (a number, or a string of one, as for PUTVAL) as the data source
+    type needs it: a float for gauges ('U', unknown, is NaN), an int otherwise. Raises
+    ValueError if it can't be converted.
+    """
+    if ds_type == GAUGE:
+        if value == 'U':
+            return float('nan')
+        return float(value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return int(float(value))
+
+def values_part(type_, values):
+    """
+    Returns a values part for values (a number or a list) of type type_. Raises
+    ValueError for a value that isn't a number.
+    """
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    ds_types = TYPES.get(type_, [])
+    ds_types = [ds_types[i] if i < len(ds_types) else GAUGE for i in range(len(values))]
+
+    data = [struct.pack('!HHH', TYPE_VALUES, 6 + 9 * len(values), len(values)),
+            struct.pack('%dB' % len(values), *ds_types)]
+    for ds_type, value in zip(ds_types, values):
+        try:
+            value = coerce(ds_type, value)
+            if ds_type == GAUGE:
+                # the one little-endian field in the protocol
+                data.append(struct.pack('<d', value))
+            elif ds_type == DERIVE:
+                data.append(struct.pack('!q', value))
+            else:
+                data.append(struct.pack('!Q', value))
+        except (TypeError, ValueError, OverflowError, struct.error):
+            raise ValueError("not a valid %s value: %r" % (type_, value))
+    return ''.join(data)
+
+
+class PacketBuilder:
+    """
+    Packs values into as few network protocol packets as possible.
+    """
+
+    def __init__(self, max_packet=MAX_PACKET):
+        self.max_packet = max_packet
+        self.packets = []
+        self.parts = []
+        self.size = 0
+        self.last = {}
+
+    def add(self, fields, last_part):
+        """
+        Adds a value: fields are (part type, value) pairs of the identifying parts,
+        only sent if they differ from the previous value's in the packet; last_part is
+        the (already packed) values or message part.
+        """
+        parts = self._changed(fields) + [last_part]
+        size = sum(map(len, parts))
+        if self.size + size > self.max_packet and self.parts:
+            self._finish()
+            parts = self._changed(fields) + [last_part]
+            size = sum(map(len, parts))
+        if size > self.max_packet:
+            raise ValueError("value too large for one packet: %d bytes" % size)
+
+        for part_type, value in fields:
+            self.last[part_type] = value
+        self.parts.extend(parts)
+        self.size += size
+
+    def _changed(self, fields):
+        parts = []
+        for part_type, value in fields:
+            if self.last.get(part_type) != value:
+                if isinstance(value, basestring):
+                    parts.append(string_part(part_type, value))
+                else:
+                    parts.append(number_part(part_type, value))
+        return parts
+
+    def _finish(self):
+        self.packets.append(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+        self.last = {}
+
+    def finish(self):
+        """
+        Returns the packets.
+        """
+        if self.parts:
+            self._finish()
+        packets, self.packets = self.packets, []
+        return packets
+
+
+class NetworkTransport:
+
+    def __init__(self, host='localhost', port=DEFAULT_PORT, max_packet=MAX_PACKET):
+        self.address = (host, int(port))
+        self.max_packet = max_packet
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def packets(self, host, interval, values):
+        """
+        Returns the network protocol packets for values. Values that can't be
+        encoded are logged and skipped.
+        """
+        builder = PacketBuilder(self.max_packet)
+        interval = int(float(interval))
+        now = time.time()
+        for path, value, timestamp in values:
+            plugin, plugin_instance, type_, type_instance = split_path(path)
+            try:
+                part = values_part(type_, value)
+            except ValueError as err:
+                logging.error("skipping %s: %s" % (path, err))
+                continue
+            if timestamp is None:
+                timestamp = now
+            builder.add([(TYPE_HOST, host), (TYPE_TIME_HR, int(timestamp * 2 ** 30)), (TYPE_INTERVAL, interval),
+                         (TYPE_PLUGIN, plugin), (TYPE_PLUGIN_INSTANCE, plugin_instance),
+                         (TYPE_TYPE, type_), (TYPE_TYPE_INSTANCE, type_instance)],
+                        part)
+        return builder.finish()
+
+    def send(self, host, interval, values):
+        """
+        Sends values in as few packets as they fit in. Returns the number of packets.
+        """
+        packets = self.packets(host, interval, values)
+        for packet in packets:
+            self.sock.sendto(packet, self.address)
+        return len(packets)
+
+    def notify(self, host, plugin, severity, message, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        builder = PacketBuilder(self.max_packet)
+        builder.add([(TYPE_HOST, host), (TYPE_TIME_HR, int(timestamp * 2 ** 30)), (TYPE_PLUGIN, plugin),
+                     (TYPE_SEVERITY, SEVERITIES.get(severity, 2))],
+                    string_part(TYPE_MESSAGE, message[:self.max_packet // 2]))
+        for packet in builder.finish():
+            self.sock.sendto(packet, self.address)
+
+    def close(self):
+        self.sock.close()
+
+
+class UnixsockTransport:
+
+    def __init__(self, path='/var/run/collectd-unixsock', timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = sock.makefile('r')
+
+    def command(self, lines):
+        """
+        Sends lines (commands), COMMAND_CHUNK at a time, reading the replies to each
+        chunk before sending the next. Returns the number of commands collectd
+        accepted; rejected ones are logged. Reconnects once per chunk if the connection
+        was closed. If a chunk fails anyway, the socket.error raised has the number of
+        lines that did get through in its 'sent' attribute.
+        """
+        replies = []
+        with self.lock:
+            for start in range(0, len(lines), COMMAND_CHUNK):
+                chunk = lines[start:start + COMMAND_CHUNK]
+                for attempt in range(2):
+                    try:
+                        if self.sock is None:
+                            self.connect()
+                        self.sock.sendall(''.join([line + '\n' for line in chunk]))
+                        chunk_replies = [self.reader.readline() for line in chunk]
+                        if chunk_replies and not chunk_replies[-1]:
+                            raise socket.error('connection closed by collectd')
+                        break
+                    except socket.error as err:
+                        self.close()
+                        if attempt:
+                            err.sent = start
+                            raise
+                replies.extend(chunk_replies)
+
+        accepted = 0
+        for line, reply in zip(lines, replies):
+            # e.g. "0 Success: 1 value has been dispatched.", "-1 Parsing options failed."
+            if reply.split(' ', 1)[0].lstrip('-').isdigit() and int(reply.split(' ', 1)[0]) >= 0:
+                accepted += 1
+            else:
+                logging.error("collectd rejected %r: %s" % (line, reply.strip()))
+        return accepted
+
+    def send(self, host, interval, values):
+        # imported here: collectd imports this module
+        from monitorlib.collectd import format_putval
+        return self.command([format_putval(host, path, interval, value, timestamp)
+                             for path, value, timestamp in values])
+
+    def notify(self, host, plugin, severity, message, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        # message has to be the last option, quoted
+        message = ' '.join(message.splitlines()).replace('\\', '\\\\').replace('"', '\\"')
+        return self.command(['PUTNOTIF host=%s plugin=%s severity=%s time=%d message="%s"'
+                             % (host, plugin, severity, timestamp, message)])
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+        self.sock = None
+        self.reader = None
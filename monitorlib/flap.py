@@ -0,0 +1,96 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Flap detection and notification damping, from a check's recent state history.
+
+    Usage:
+    damper = flap.Damper(history=20, high=0.5, low=0.25, hold_down=300, min_duration=60)
+    notify = damper.update(history, severity, transitioned, now)
+
+    history is a dict kept between runs (collectd.Client stores it next to the check's
+    state), updated in place:
+    states: the last `history` severities, oldest first
+    since: when the current severity started
+    flapping: whether the check is flapping
+    pending: severity of a transition that hasn't been notified yet, or None
+    notified: the severity notified last (initially 'okay')
+    notified_at: when the last notification went out
+
+    A check is flapping when the weighted share of runs that changed severity goes
+    above high, and stops flapping when it drops below low (recent runs weigh more,
+    as in nagios). A transition is only notified once the check isn't flapping, the
+    new severity has lasted min_duration seconds, and hold_down seconds have passed
+    since the last notification. If the check goes back to its previous severity
+    before then, nothing is notified at all.
+"""
+
+
+class Damper(object):
+
+    def __init__(self, history=20, high=0.5, low=0.25, hold_down=0, min_duration=0):
+        self.history = history
+        self.high = high
+        self.low = low
+        self.hold_down = hold_down
+        self.min_duration = min_duration
+
+    def change_rate(self, states):
+        """
+        Returns the weighted share (0-1) of runs in the last history runs that changed
+        severity; weights go from 0.8 for the oldest change to 1.2 for the newest. Runs
+        before the first one in states count as unchanged, so that a new check isn't
+        flapping after two runs.
+        """
+        window = self.history - 1
+        if window < 1:
+            return 0.0
+
+        offset = window - (len(states) - 1)
+        changed = 0.0
+        for i in range(len(states) - 1):
+            if states[i] != states[i + 1]:
+                changed += 0.8 + 0.4 * (i + offset) / max(window - 1, 1)
+        # the weights average 1, so they add up to window
+        return changed / window
+
+    def update(self, history, severity, transitioned, now):
+        """
+        Records this run's severity in history, and returns True if a notification
+        should go out now.
+        """
+        states = history.get('states', [])
+        changed = not states or states[-1] != severity
+        if changed:
+            history['since'] = now
+        states = (states + [severity])[-self.history:]
+        history['states'] = states
+
+        rate = self.change_rate(states)
+        if history.get('flapping'):
+            history['flapping'] = rate >= self.low
+        else:
+            history['flapping'] = rate > self.high
+
+        pending = history.get('pending')
+        if changed and severity == history.get('notified', 'okay'):
+            # went back to what was notified last, before we said anything else
+            pending = None
+        elif transitioned:
+            pending = severity
+        elif pending is not None and pending != severity:
+            pending = None
+
+        notify = False
+        if (pending is not None and not history['flapping'] and
+                now - history.get('since', now) >= self.min_duration and
+                now - history.get('notified_at', now - self.hold_down) >= self.hold_down):
+            notify = True
+            pending = None
+            history['notified'] = severity
+            history['notified_at'] = now
+
+        history['pending'] = pending
+        return notify
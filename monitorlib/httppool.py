@@ -0,0 +1,208 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Keep-alive HTTP(S) connection pool, shared by everything in a process, so that
+    alerts to the same endpoint (e.g. events.pagerduty.com) don't each pay for a new
+    TCP and TLS handshake. All requests have connect and read timeouts.
+
+    A request on a reused connection is only retried (once, on a new connection) when
+    it can't have reached the server: the connection failed while the request was
+    being written, or was closed or reset before any of the response came back. A
+    timeout waiting for the response is not retried, so a POST is never sent twice.
+
+    Proxies are taken from the environment as urllib2 does (http_proxy, https_proxy,
+    no_proxy): https requests are tunnelled through the proxy with CONNECT, http ones
+    are sent to it with the absolute URL. Redirects are not followed (a 3xx response's
+    body is returned as is).
+
+    Usage:
+    body = httppool.post_json(url, data)
+"""
+
+import base64
+import errno
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# seconds to wait on connecting, and on each read of the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+
+# idle connections kept per (scheme, host, port, proxy)
+MAX_IDLE = 4
+
+# (scheme, host, port, proxy): [idle connections]
+POOL = {}
+LOCK = threading.Lock()
+
+class HTTPError(Exception):
+    """
+    Raised for responses with a 4xx/5xx status.
+    """
+
+    def __init__(self, url, status, reason, body):
+        Exception.__init__(self, "%s: HTTP %s %s" % (url, status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+def post_json(url, data):
+    """
+    POSTs data as JSON to url, returns the response body.
+    """
+    return request('POST', url, json.dumps(data), {'Content-Type': 'application/json'})
+
+def request(method, url, body=None, headers=None):
+    """
+    Makes a request on a pooled connection, returns the response body, or raises
+    HTTPError. A request on a reused connection that the server has since closed is
+    retried once on a new connection (see retryable()).
+    """
+    parsed = urlparse.urlsplit(url)
+    proxy = proxy_for(parsed.scheme, parsed.hostname)
+    key = (parsed.scheme, parsed.hostname, parsed.port, proxy)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    headers = dict(headers or {})
+    if proxy and parsed.scheme == 'http':
+        # a plain http proxy takes the whole URL, and the credentials with each request
+        path = urlparse.urlunsplit((parsed.scheme, parsed.netloc, path, '', ''))
+        headers.update(proxy_headers(proxy))
+
+    conn, reused = checkout(key)
+    try:
+        try:
+            response = send(conn, method, path, body, headers)
+        except (httplib.HTTPException, socket.error) as err:
+            if not reused or not retryable(err):
+                raise
+            conn.close()
+            conn = connect(key)
+            response = send(conn, method, path, body, headers)
+    except:
+        conn.close()
+        raise
+
+    try:
+        data = response.read()
+    except:
+        conn.close()
+        raise
+
+    if response.will_close:
+        conn.close()
+    else:
+        checkin(key, conn)
+
+    if response.status >= 400:
+        raise HTTPError(url, response.status, response.reason, data)
+    return data
+
+# errors meaning the server closed the connection, rather than didn't answer in time
+CLOSED_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+def retryable(err):
+    """
+    Returns whether a request that failed with err on a reused connection can safely
+    be sent again, i.e. the server can't have started processing it.
+    """
+    if getattr(err, 'unsent', False):
+        return True
+    if isinstance(err, httplib.BadStatusLine):
+        # the connection was closed without a single byte of response
+        return True
+    if isinstance(err, socket.timeout):
+        return False
+    return isinstance(err, socket.error) and err.errno in CLOSED_ERRNOS
+
+def send(conn, method, path, body, headers):
+    if conn.sock is None:
+        conn.connect()
+        conn.sock.settimeout(READ_TIMEOUT)
+    try:
+        conn.request(method, path, body, headers)
+    except socket.error as err:
+        # not all of the request went out; a timeout might still have written most of it
+        err.unsent = not isinstance(err, socket.timeout)
+        raise
+    return conn.getresponse()
+
+def proxy_for(scheme, host):
+    """
+    Returns the proxy URL to reach host through, from the environment, or None.
+    """
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return proxy
+
+def proxy_headers(proxy):
+    """
+    Returns the Proxy-Authorization header for the credentials in the proxy URL, if any.
+    """
+    parsed = urlparse.urlsplit(proxy)
+    if parsed.username is None:
+        return {}
+    credentials = '%s:%s' % (urllib.unquote(parsed.username), urllib.unquote(parsed.password or ''))
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials)}
+
+def connect(key):
+    """
+    Returns a new (not yet connected) connection for key.
+    """
+    scheme, host, port, proxy = key
+    if proxy:
+        parsed = urlparse.urlsplit(proxy)
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(parsed.hostname, parsed.port or 80, timeout=CONNECT_TIMEOUT)
+            conn.set_tunnel(host, port, proxy_headers(proxy))
+            return conn
+        return httplib.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=CONNECT_TIMEOUT)
+    if scheme == 'https':
+        return httplib.HTTPSConnection(host, port, timeout=CONNECT_TIMEOUT)
+    return httplib.HTTPConnection(host, port, timeout=CONNECT_TIMEOUT)
+
+def checkout(key):
+    """
+    Returns (connection, reused): an idle connection for key, or a new one.
+    """
+    with LOCK:
+        idle = POOL.get(key)
+        if idle:
+            return idle.pop(), True
+    return connect(key), False
+
+def checkin(key, conn):
+    """
+    Returns conn to the pool, closing it if the pool is full.
+    """
+    with LOCK:
+        idle = POOL.setdefault(key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def close_all():
+    """
+    Closes all idle connections.
+    """
+    with LOCK:
+        for idle in POOL.values():
+            for conn in idle:
+                conn.close()
+        POOL.clear()
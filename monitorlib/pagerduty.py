@@ -7,16 +7,52 @@
 
     Usage:
     pagerduty.authenticate(key)
-    pageduty.set_datastore('file', '/tmp/incident_keys') # or 'redis' - see collectd.py
+    pageduty.set_datastore('sqlite', '/tmp/incident_keys.db') # or 'file', 'redis' - see collectd.py
     pagerduty.event(event_type, message, [details_json])
+    pagerduty.set_spool('/tmp/pagerduty_spool') # optional, see below
+
+    Datastores:
+    sqlite: one row per incident key, safe with many concurrent processes. If a
+            legacy 'file' pickle exists next to it (the same path without '.db'),
+            its keys are migrated on set_datastore().
+    file: a pickled dict, rewritten on every change. Not safe for concurrent writers.
+    local: no storage at all: the incident key is a hash of the service key, host and
+           script (see local_key()), sent with every trigger and resolve. Nothing to
+           look up, and resolves still work if the key store is lost, but every resolve
+           is sent (collectd.Client only sends them on recovery, in this mode).
+    redis: a hash per service key, updated with one pipelined (MULTI/EXEC) round
+           trip. Keys stored by older versions (one string key each) are still found,
+           and moved on their next update. Incident keys are kept until resolved,
+           unless the config has a 'key_ttl' (or REDIS_KEY_TTL is set): then ones
+           nobody has written for that many seconds expire.
+    get_incident_keys(store_keys) looks up many keys at once (one redis round trip),
+    and events() sends many events with a single lookup.
+
+    Spooling:
+    After set_spool(path), event() appends the event to a durable spool (see spool.py)
+    and returns at once. A background thread delivers spooled events in order,
+    retrying with exponential backoff while pagerduty is unreachable. At exit, the
+    process waits up to EXIT_DRAIN_TIMEOUT seconds for the spool to drain, unless
+    delivery is failing; anything left is delivered by the next process to spool.
+    Each spooled trigger carries its own id as incident_key (if none is stored yet),
+    so redelivering it can't open a second incident.
 """
 
 import os
 import sys
+import errno
 import time
+import uuid
+import hashlib
+import atexit
 import socket
-import urllib2
+import logging
+import threading
 import cPickle as pickle
+import monitorlib.sqlitedb as sqlitedb
+import monitorlib.httppool as httppool
+import monitorlib.spool as spool
+import monitorlib.redispool as redispool
 try:
     import redis
 except ImportError:
@@ -37,6 +73,125 @@ def set_datastore(kind, config):
     global STORAGE_CONFIG
     STORAGE_CONFIG = config
 
+    if 'sqlite' in kind and config.endswith('.db'):
+        migrate_pickle(config[:-len('.db')])
+
+    return True
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS incident_keys (
+    store_key TEXT PRIMARY KEY,
+    incident_key TEXT NOT NULL
+);
+"""
+
+def sqlite_conn():
+    """
+    Returns a connection to the sqlite key store.
+    """
+    return sqlitedb.connect(STORAGE_CONFIG, SQLITE_SCHEMA)
+
+def migrate_pickle(path):
+    """
+    Moves the keys from a 'file' datastore pickle at path into the sqlite store, and
+    renames the pickle to path.migrated. Keys already in the sqlite store win. Also
+    picks up path.migrating.<pid> files left by a process that died while migrating.
+    Returns the number of keys moved.
+    """
+    migrated = 0
+    for source in stale_migrations(path) + [path]:
+        if os.path.exists(source):
+            migrated += migrate_file(source, path)
+    return migrated
+
+def stale_migrations(path):
+    """
+    Returns the path.migrating.<pid> files whose process is gone.
+    """
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.migrating.'
+    stale = []
+    for name in os.listdir(directory):
+        if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+            continue
+        pid = int(name[len(prefix):])
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, 0)
+        except OSError as err:
+            if err.errno == errno.ESRCH:
+                stale.append(os.path.join(directory, name))
+    return stale
+
+def migrate_file(source, path):
+    """
+    Imports the pickle at source into the sqlite store, then renames it to
+    path.migrated. If it can't be imported, it is put back at path (for the next
+    try, or a human) and 0 is returned.
+    """
+    # claim the file with an atomic rename, so concurrent callers don't both import it.
+    claimed = "%s.migrating.%d" % (path, os.getpid())
+    try:
+        os.rename(source, claimed)
+    except OSError:
+        return 0
+
+    try:
+        try:
+            keys = pickle.load(open(claimed, 'r'))
+        except EOFError:
+            keys = {}
+
+        with sqlitedb.transaction(sqlite_conn()) as conn:
+            # OR IGNORE: importing the same file twice (after a crash) is harmless
+            conn.executemany('INSERT OR IGNORE INTO incident_keys (store_key, incident_key) VALUES (?, ?)',
+                             keys.items())
+    except Exception:
+        logging.exception("can't migrate incident keys from %s, leaving them in %s" % (source, path))
+        if not os.path.exists(path):
+            os.rename(claimed, path)
+        else:
+            os.rename(claimed, "%s.failed.%d" % (path, os.getpid()))
+        return 0
+
+    os.rename(claimed, path + '.migrated')
+    return len(keys)
+
+# redis layout: a hash per service key, 'incident_keys:<service key>', of
+# {host script: incident key}, and a sorted set 'incident_keys:<service key>:seen' of
+# host script by the time its incident key was last written. With a TTL (see
+# redis_key_ttl()), keys not written for that long are dropped (see
+# expire_incident_keys()), so orphans (from checks that were removed, or resolves that
+# never arrived) don't pile up. Off by default: a check failing for longer than the TTL
+# would lose its key, and its resolve with it.
+REDIS_PREFIX = 'incident_keys:'
+REDIS_KEY_TTL = None
+# seconds between expire_incident_keys() runs, per process and service key
+REDIS_EXPIRE_EVERY = 3600
+REDIS_EXPIRED_AT = {}
+
+# spooling, see set_spool()
+SPOOL = None
+DRAINER = None
+DRAINER_LOCK = threading.Lock()
+DRAIN_WAKEUP = threading.Event()
+DRAIN_FAILING = False
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+EXIT_DRAIN_TIMEOUT = 5
+
+def set_spool(path):
+    """
+    Spools events in the directory path, instead of sending them directly. None disables.
+    """
+    global SPOOL
+    if path is None:
+        SPOOL = None
+    else:
+        SPOOL = spool.Spool(path)
+    return True
+
 def authenticate(key):
     """
     Call this function, and provide your pagerduty service key.
@@ -46,24 +201,76 @@ def authenticate(key):
 
 def redis_conn(conf, mode):
     """
-    Create and return a redis connection, if you haven't done so already
+    Returns a pooled connection to the 'read'er or 'write'r redis server in conf.
     """
-    global REDIS_READER
-    global REDIS_WRITER
     if 'read' in mode:
-        if 'REDIS_READER' not in globals():
-            REDIS_READER = redis.Redis(conf['reader'], conf['reader_port'], conf['db'], conf['passwd'], socket_timeout=2)
-        return REDIS_READER
-    elif 'write' in mode:
-        if 'REDIS_WRITER' not in globals():
-            REDIS_WRITER = redis.Redis(conf['writer'], conf['writer_port'], conf['db'], conf['passwd'], socket_timeout=2)
-        return REDIS_WRITER
+        return redispool.get_connection(conf['reader'], conf['reader_port'], conf['db'], conf['passwd'])
+    return redispool.get_connection(conf['writer'], conf['writer_port'], conf['db'], conf['passwd'])
+
+def redis_keys(store_key):
+    """
+    Returns (hash, sorted set, field) holding store_key in the redis layout.
+    """
+    service_key, _, host_script = store_key.partition('^')
+    return REDIS_PREFIX + service_key, REDIS_PREFIX + service_key + ':seen', host_script
+
+def redis_key_ttl():
+    """
+    Returns the seconds after which unwritten incident keys expire from redis: the
+    config's 'key_ttl', or REDIS_KEY_TTL. None means never.
+    """
+    return STORAGE_CONFIG.get('key_ttl', REDIS_KEY_TTL)
+
+def expire_incident_keys(service_key=None, max_age=None):
+    """
+    Removes incident keys for service_key (default: the authenticated one) that
+    haven't been written for max_age seconds (default redis_key_ttl()) from redis.
+    Returns the number removed.
+    """
+    if service_key is None:
+        service_key = PD_KEY
+    if max_age is None:
+        max_age = redis_key_ttl()
+        if max_age is None:
+            return 0
+    hash_key, seen_key, _ = redis_keys(service_key + '^')
+
+    conn = redis_conn(STORAGE_CONFIG, 'write')
+    try:
+        stale = conn.zrangebyscore(seen_key, '-inf', time.time() - max_age)
+        if stale:
+            pipe = conn.pipeline()
+            pipe.hdel(hash_key, *stale)
+            pipe.zrem(seen_key, *stale)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        return 0
+    return len(stale)
+
+def maybe_expire_incident_keys(service_key):
+    """
+    Runs expire_incident_keys() for service_key, at most every REDIS_EXPIRE_EVERY seconds.
+    """
+    now = time.time()
+    if now - REDIS_EXPIRED_AT.get(service_key, 0) >= REDIS_EXPIRE_EVERY:
+        REDIS_EXPIRED_AT[service_key] = now
+        expire_incident_keys(service_key)
+
+def local_key(store_key):
+    """
+    Returns the incident key for store_key ('<service key>^<host> <script>') in the
+    'local' datastore: the same on every host and process, without storing anything.
+    """
+    return hashlib.sha1(store_key).hexdigest()
 
 def get_incident_key(store_key):
     """
     Returns an incident key if one matches 'store_key', otherwise returns None.
     """
-    if 'file' in KEY_STORAGE:
+    if 'local' in KEY_STORAGE:
+        return local_key(store_key)
+
+    elif 'file' in KEY_STORAGE:
         if not os.path.exists(STORAGE_CONFIG):
             return None
 
@@ -75,12 +282,52 @@ def get_incident_key(store_key):
 
         return keys.get(store_key)
 
+    elif 'sqlite' in KEY_STORAGE:
+        row = sqlite_conn().execute('SELECT incident_key FROM incident_keys WHERE store_key = ?',
+                                    (store_key,)).fetchone()
+        return row and row[0]
+
     elif 'redis' in KEY_STORAGE:
-        conn = redis_conn(STORAGE_CONFIG, 'read')
+        return get_incident_keys([store_key])[store_key]
+
+def get_incident_keys(store_keys):
+    """
+    Returns {store_key: incident key, or None} for all of store_keys, in one query (or
+    one redis round trip) where the datastore allows.
+    """
+    if 'sqlite' in KEY_STORAGE:
+        found = {}
+        conn = sqlite_conn()
+        # sqlite allows 999 parameters per statement
+        for i in range(0, len(store_keys), 500):
+            chunk = store_keys[i:i + 500]
+            found.update(conn.execute('SELECT store_key, incident_key FROM incident_keys WHERE store_key IN (%s)' %
+                                      ','.join('?' * len(chunk)), chunk).fetchall())
+        return dict([(store_key, found.get(store_key)) for store_key in store_keys])
+
+    elif 'redis' in KEY_STORAGE:
+        pipe = redis_conn(STORAGE_CONFIG, 'read').pipeline(transaction=False)
+        fields = {}
+        for store_key in store_keys:
+            hash_key, _, field = redis_keys(store_key)
+            fields.setdefault(hash_key, []).append((store_key, field))
+        for hash_key, keys in fields.items():
+            pipe.hmget(hash_key, [field for store_key, field in keys])
+        # keys written by the old layout, one string key per store_key
+        pipe.mget(store_keys)
         try:
-            return conn.get(store_key)
+            results = pipe.execute()
         except redis.exceptions.RedisError:
-            return None
+            return dict.fromkeys(store_keys)
+
+        found = dict(zip(store_keys, results[-1]))
+        for (hash_key, keys), values in zip(fields.items(), results):
+            for (store_key, field), value in zip(keys, values):
+                if value is not None:
+                    found[store_key] = value
+        return found
+
+    return dict([(store_key, get_incident_key(store_key)) for store_key in store_keys])
 
 def del_incident_key(store_key):
     """
@@ -95,10 +342,17 @@ def del_incident_key(store_key):
         del keys[store_key]
         pickle.dump(keys, open(STORAGE_CONFIG, 'w'))
 
+    elif 'sqlite' in KEY_STORAGE:
+        sqlite_conn().execute('DELETE FROM incident_keys WHERE store_key = ?', (store_key,))
+
     elif 'redis' in KEY_STORAGE:
-        conn = redis_conn(STORAGE_CONFIG, 'write')
+        hash_key, seen_key, field = redis_keys(store_key)
+        pipe = redis_conn(STORAGE_CONFIG, 'write').pipeline()
+        pipe.hdel(hash_key, field)
+        pipe.zrem(seen_key, field)
+        pipe.delete(store_key)
         try:
-            return conn.delete(store_key)
+            return pipe.execute()[0]
         except redis.exceptions.RedisError:
             return None
 
@@ -120,24 +374,54 @@ def add_incident_key(store_key, incident_key):
         keys.update({store_key: incident_key})
         pickle.dump(keys, open(STORAGE_CONFIG, 'w'))
 
+    elif 'sqlite' in KEY_STORAGE:
+        sqlite_conn().execute('INSERT OR REPLACE INTO incident_keys (store_key, incident_key) VALUES (?, ?)',
+                              (store_key, incident_key))
+
     elif 'redis' in KEY_STORAGE:
-        conn = redis_conn(STORAGE_CONFIG, 'write')
+        hash_key, seen_key, field = redis_keys(store_key)
+        pipe = redis_conn(STORAGE_CONFIG, 'write').pipeline()
+        pipe.hset(hash_key, field, incident_key)
+        pipe.zadd(seen_key, field, time.time())
+        ttl = redis_key_ttl()
+        if ttl is not None:
+            # so a service key nobody uses anymore goes away entirely
+            pipe.expire(hash_key, ttl)
+            pipe.expire(seen_key, ttl)
+        # moved from the old layout
+        pipe.delete(store_key)
         try:
-            return conn.set(store_key, incident_key)
+            result = pipe.execute()[0]
         except redis.exceptions.RedisError:
             return None
+        if ttl is not None:
+            maybe_expire_incident_keys(store_key.partition('^')[0])
+        return result
 
-def construct(service_key, event_type, desc, store_key, details):
+def construct(service_key, event_type, desc, store_key, details, incident_keys=None):
     """
     Constructs pagerduty json for sending; looks up the incident_key
-    in persistent storage, and adds it.
+    in persistent storage (or incident_keys, from get_incident_keys()), and adds it.
     """
+    if incident_keys is not None:
+        incident_key = incident_keys.get(store_key)
+    else:
+        incident_key = get_incident_key(store_key)
 
     return {'service_key': service_key, 'event_type': event_type,
-            'description': desc, 'incident_key': get_incident_key(store_key),
+            'description': desc, 'incident_key': incident_key,
             'details': details
            }
 
+def make_storage_key(service_key, desc):
+    """
+    Returns the key the incident key for an event is stored under.
+    """
+    # the host & script name from the alert message:
+    host_script = desc.split(':')[1]
+    # store the API key as part of the thing to key off of when storing incident_keys, to support multiple API keys at once.
+    return service_key + '^' + host_script
+
 def send_to_pagerduty(message):
     """
     Sends message to pagerduty, returns the response.
@@ -155,12 +439,7 @@ def send_to_pagerduty(message):
     ### if we dont have deatils yet
     message['details'] = message.get('details', desc) or desc
 
-    req = urllib2.Request(pd_url, json.dumps(message), {'Content-Type': 'application/json'})
-    f = urllib2.urlopen(req)
-    resp = f.read()
-    f.close()
-
-    return resp
+    return httppool.post_json(pd_url, message)
 
 def event(event_type, desc, details=None):
     """
@@ -169,17 +448,52 @@ def event(event_type, desc, details=None):
     "severity: host script_name: error_message", i.e.:
     "WARNING: hostname service_check.py: apache failed"
     """
-    # the host & script name from the alert message:
-    host_script = desc.split(':')[1]
-    # store the API key as part of the thing to key off of when storing incident_keys, to support multiple API keys at once.
-    storage_key = PD_KEY + '^' + host_script
+    if SPOOL is not None:
+        SPOOL.append({'id': uuid.uuid4().hex, 'service_key': PD_KEY,
+                      'event_type': event_type, 'desc': desc, 'details': details})
+        start_drainer()
+        return None
 
-    message = construct(PD_KEY, event_type, desc, storage_key, details)
+    return deliver(PD_KEY, event_type, desc, details)
+
+def events(items):
+    """
+    Like event(), for many events: items are (event_type, desc) pairs. The incident
+    keys are looked up all at once. Every event is tried; if any failed, the first
+    error is raised at the end.
+    """
+    if SPOOL is not None:
+        for event_type, desc in items:
+            event(event_type, desc)
+        return None
+
+    incident_keys = get_incident_keys([make_storage_key(PD_KEY, desc) for event_type, desc in items])
+    error = None
+    for event_type, desc in items:
+        try:
+            deliver(PD_KEY, event_type, desc, incident_keys=incident_keys)
+        except Exception:
+            logging.exception("sending %s to pagerduty failed" % desc)
+            error = error or sys.exc_info()
+    if error:
+        raise error[0], error[1], error[2]
+
+def deliver(service_key, event_type, desc, details=None, dedup_key=None, incident_keys=None):
+    """
+    Sends an event to PD, and keeps the stored incident_key up to date.
+    dedup_key is used as the incident_key of a trigger without a stored one.
+    incident_keys, if given, are the already looked up keys (see events()).
+    """
+    storage_key = make_storage_key(service_key, desc)
+
+    message = construct(service_key, event_type, desc, storage_key, details, incident_keys)
 
     # if this is an OKAY message, don't send to PD unless we have an incident key:
     if 'resolve' in event_type and message['incident_key']:
         resp = json.loads(send_to_pagerduty(message))
     elif 'trigger' in event_type:
+        if not message['incident_key'] and dedup_key:
+            message['incident_key'] = dedup_key
         resp = json.loads(send_to_pagerduty(message))
     else:
         # it was a 'resolve' and we didn't have the incident_key already (can't delete). done.
@@ -195,5 +509,70 @@ def event(event_type, desc, details=None):
             # store the incident_key returned by pagerduty
             add_incident_key(storage_key, resp['incident_key'])
 
+def deliver_spooled(record):
+    """
+    Delivers a spooled event. Events PD rejects as invalid are dropped, not retried.
+    """
+    try:
+        deliver(record['service_key'], record['event_type'], record['desc'], record['details'], record['id'])
+    except httppool.HTTPError as err:
+        if 400 <= err.status < 500 and err.status != 429:
+            logging.error("pagerduty rejected event, dropping it: %s %s" % (err, err.body))
+        else:
+            raise
 
+def drain_spool():
+    """
+    Delivers everything in the spool. Returns the number of events delivered (None if
+    another process is draining), raises the error if a delivery fails.
+    """
+    return SPOOL.drain(deliver_spooled)
+
+def start_drainer():
+    """
+    Starts the background thread draining the spool, or wakes it up.
+    """
+    global DRAINER
+    DRAIN_WAKEUP.set()
+    with DRAINER_LOCK:
+        if DRAINER is None or not DRAINER.is_alive():
+            if DRAINER is None:
+                atexit.register(wait_for_drainer)
+            DRAINER = threading.Thread(target=drain_forever, name='pagerduty-spool')
+            DRAINER.daemon = True
+            DRAINER.start()
+
+def drain_forever(poll_interval=30):
+    """
+    Drains the spool whenever woken up (or every poll_interval seconds), backing off
+    exponentially while delivery fails.
+    """
+    global DRAIN_FAILING
+    backoff = BACKOFF_MIN
+    while SPOOL is not None:
+        DRAIN_WAKEUP.clear()
+        try:
+            drain_spool()
+        except Exception:
+            logging.exception("delivering spooled pagerduty events failed, retrying in %ss" % backoff)
+            DRAIN_FAILING = True
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX)
+        else:
+            DRAIN_FAILING = False
+            backoff = BACKOFF_MIN
+            DRAIN_WAKEUP.wait(poll_interval)
 
+def wait_for_drainer(timeout=None):
+    """
+    Waits (at exit) for the spool to drain, for up to timeout (EXIT_DRAIN_TIMEOUT)
+    seconds, while delivery isn't failing.
+    """
+    if timeout is None:
+        timeout = EXIT_DRAIN_TIMEOUT
+    deadline = time.time() + timeout
+    while SPOOL is not None and not DRAIN_FAILING and time.time() < deadline:
+        if not SPOOL.pending():
+            return True
+        time.sleep(0.05)
+    return False
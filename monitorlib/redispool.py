@@ -0,0 +1,39 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Shared redis connection pools, so that everything in a process talking to
+    the same redis server reuses the same connections.
+
+    Usage:
+    conn = redispool.get_connection(host, port, db, passwd)
+"""
+
+try:
+    import redis
+except ImportError:
+    pass
+
+# (host, port, db, passwd, socket_timeout): redis.ConnectionPool
+POOLS = {}
+
+def get_connection(host, port, db, passwd, socket_timeout=2):
+    """
+    Returns a redis client using the process-wide pool for this server.
+    """
+    key = (host, port, db, passwd, socket_timeout)
+    pool = POOLS.get(key)
+    if pool is None:
+        pool = POOLS.setdefault(key, redis.ConnectionPool(host=host, port=port, db=db, password=passwd,
+                                                          socket_timeout=socket_timeout))
+    return redis.Redis(connection_pool=pool)
+
+def reset():
+    """
+    Disconnects and forgets all pools.
+    """
+    for pool in POOLS.values():
+        pool.disconnect()
+    POOLS.clear()
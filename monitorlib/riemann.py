@@ -0,0 +1,125 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Persistent riemann connections, shared by everything in a process, so that
+    sending an event doesn't mean setting up a new TCP connection.
+
+    Usage:
+    conn = riemann.get_connection(host, port, [proto]) # proto: 'tcp' (default) or 'udp'
+    conn.send({'host': ..., 'service': ..., 'state': ...})
+    conn.send_many([event, event, ...]) # one protobuf Msg for all of them
+
+    UDP is fire-and-forget: there's no acknowledgement, and riemann drops datagrams
+    larger than MAX_UDP_MESSAGE bytes without a word, so over UDP send_many() splits
+    the events into as many messages as it takes to stay under that.
+"""
+
+import socket
+import threading
+try:
+    import bernhard
+except ImportError:
+    pass
+
+# seconds to wait on connecting to, sending to, or reading an ack from riemann
+TIMEOUT = 5
+
+# riemann's UDP server's default max-size is 16384 bytes; leave room for the Msg framing
+MAX_UDP_MESSAGE = 16384 - 64
+
+# (host, port, proto): Connection
+CONNECTIONS = {}
+LOCK = threading.Lock()
+
+def get_connection(host, port, proto='tcp'):
+    """
+    Returns the process-wide Connection to host:port, creating it if needed.
+    """
+    key = (host, int(port), proto)
+    with LOCK:
+        if key not in CONNECTIONS:
+            CONNECTIONS[key] = Connection(host, int(port), proto)
+        return CONNECTIONS[key]
+
+def close_all():
+    """
+    Closes and forgets all connections.
+    """
+    with LOCK:
+        for conn in CONNECTIONS.values():
+            conn.close()
+        CONNECTIONS.clear()
+
+def split_udp(events, max_bytes=MAX_UDP_MESSAGE):
+    """
+    Splits bernhard Events into lists whose encoded Msg is at most max_bytes (an
+    event bigger than that on its own gets a list to itself).
+    """
+    chunks = [[]]
+    size = 0
+    for event in events:
+        length = event.event.ByteSize()
+        # the field tag, and the varint length prefix
+        length += 1 + (length.bit_length() + 6) // 7
+        if chunks[-1] and size + length > max_bytes:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(event)
+        size += length
+    return chunks
+
+def tcp_transport(host, port):
+    """
+    bernhard.TCPTransport, with connect/read timeouts.
+    """
+    transport = bernhard.TCPTransport.__new__(bernhard.TCPTransport)
+    transport.sock = socket.create_connection((host, port), TIMEOUT)
+    return transport
+
+class Connection:
+    """
+    A riemann connection that stays open between sends. bernhard reconnects (once)
+    when a send on the open connection fails.
+    """
+
+    def __init__(self, host, port, proto='tcp'):
+        if 'udp' in proto:
+            transport = bernhard.UDPTransport
+        else:
+            transport = tcp_transport
+        self.proto = proto
+        self.client = bernhard.Client(host=host, port=port, transport=transport)
+        self.lock = threading.Lock()
+
+    def send(self, event):
+        """
+        Sends one event (a dict of riemann event fields).
+        """
+        return self.send_many([event])
+
+    def send_many(self, events):
+        """
+        Sends the events in a single message (over UDP, as few as fit in
+        MAX_UDP_MESSAGE bytes each). Returns True if riemann acknowledged them (always
+        True for UDP).
+        """
+        if not events:
+            return True
+
+        events = [bernhard.Event(params=event) for event in events]
+        if 'udp' in self.proto:
+            with self.lock:
+                for chunk in split_udp(events):
+                    self.client.transmit(bernhard.Message(events=chunk))
+            return True
+
+        with self.lock:
+            response = self.client.transmit(bernhard.Message(events=events))
+        return bool(response.ok)
+
+    def close(self):
+        with self.lock:
+            self.client.disconnect()
@@ -0,0 +1,208 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Runs shell commands with timeouts and capped output, alone or several at once.
+
+    Usage:
+    result = runner.run('some command', timeout=10, max_output=65536)
+    results = runner.run_many(['cmd one', 'cmd two'], workers=4, timeout=10)
+    for line in runner.iter_lines('some command', timeout=10): ...
+
+    Each command runs in its own process group; on timeout the whole group (the
+    shell, and anything it started) is killed with SIGKILL. Output beyond max_output
+    bytes (per stream) is read and thrown away, so the command doesn't block on a full
+    pipe, and result.truncated is set.
+"""
+
+import os
+import time
+import logging
+import signal
+import threading
+import subprocess
+import Queue
+
+
+# bytes read from a pipe at a time
+CHUNK_SIZE = 65536
+
+
+class CommandTimeout(Exception):
+    """
+    Raised by iter_lines() when the command was killed for running too long.
+    """
+
+
+class Result(object):
+    """
+    What a command did: returncode, stdout, stderr, timed_out, truncated (output was
+    cut at max_output), elapsed (seconds) and error (why it couldn't be run, from
+    run_many(); otherwise None).
+    """
+    __slots__ = ('command', 'returncode', 'stdout', 'stderr', 'timed_out', 'truncated', 'elapsed', 'error')
+
+    def __init__(self, command, returncode, stdout, stderr, timed_out, elapsed, truncated=False, error=None):
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.truncated = truncated
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+        return "<Result %r returncode=%s timed_out=%s elapsed=%.3f>" % (self.command, self.returncode,
+                                                                         self.timed_out, self.elapsed)
+
+
+def start(command, stderr=subprocess.PIPE):
+    """
+    Starts command through the shell, in its own process group.
+    """
+    return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=stderr,
+                            close_fds=True, preexec_fn=os.setsid)
+
+
+def start_timer(process, timeout, killed):
+    """
+    Returns a started timer killing process' group after timeout seconds (None if
+    there's no timeout).
+    """
+    if timeout is None:
+        return None
+    timer = threading.Timer(timeout, kill_group, (process, killed))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def run(command, timeout=None, max_output=None):
+    """
+    Runs command through the shell, returns a Result. If it runs longer than timeout
+    seconds, its process group is killed, and the output so far is returned. Keeps at
+    most max_output bytes of each of stdout and stderr.
+    """
+    begin = time.time()
+    process = start(command)
+    killed = []
+    timer = start_timer(process, timeout, killed)
+
+    try:
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(read_capped(process.stderr, max_output)))
+        reader.daemon = True
+        reader.start()
+        stdout, out_truncated = read_capped(process.stdout, max_output)
+        reader.join()
+        stderr, err_truncated = errors[0]
+        process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+
+    return Result(command, process.returncode, stdout, stderr, bool(killed), time.time() - begin,
+                  out_truncated or err_truncated)
+
+
+def read_capped(pipe, limit=None):
+    """
+    Reads pipe to the end, returns (the first limit bytes, whether there were more).
+    """
+    chunks = []
+    size = 0
+    truncated = False
+    fd = pipe.fileno()
+    while True:
+        data = os.read(fd, CHUNK_SIZE)
+        if not data:
+            break
+        if limit is not None:
+            if size >= limit:
+                truncated = True
+                continue
+            if size + len(data) > limit:
+                data = data[:limit - size]
+                truncated = True
+        chunks.append(data)
+        size += len(data)
+    pipe.close()
+    return ''.join(chunks), truncated
+
+
+def iter_lines(command, timeout=None):
+    """
+    Runs command through the shell, and yields its stdout a line at a time, as it's
+    written (stderr is discarded). Raises CommandTimeout at the end if the command was
+    killed for running longer than timeout seconds. If the caller stops iterating
+    early, the command is killed.
+    """
+    devnull = open(os.devnull, 'w')
+    process = start(command, stderr=devnull)
+    devnull.close()
+    killed = []
+    timer = start_timer(process, timeout, killed)
+
+    try:
+        for line in iter(process.stdout.readline, ''):
+            yield line
+        process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if process.poll() is None:
+            kill_group(process, [])
+            process.wait()
+        process.stdout.close()
+
+    if killed:
+        raise CommandTimeout("%s timed out after %ss" % (command, timeout))
+
+
+def kill_group(process, killed):
+    """
+    Kills process' process group, and records that in killed (a list).
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+        killed.append(True)
+    except OSError:
+        # already gone
+        pass
+
+
+def run_many(commands, workers=4, timeout=None, max_output=None):
+    """
+    Runs commands, at most workers at a time, each with its own timeout. Returns the
+    Results in the same order as commands. A command that can't be run at all gets a
+    Result with returncode None and the exception in error.
+    """
+    commands = list(commands)
+    results = [None] * len(commands)
+    todo = Queue.Queue()
+    for index, command in enumerate(commands):
+        todo.put((index, command))
+
+    def worker():
+        while True:
+            try:
+                index, command = todo.get_nowait()
+            except Queue.Empty:
+                return
+            begin = time.time()
+            try:
+                results[index] = run(command, timeout, max_output)
+            except Exception as error:
+                logging.exception("can't run %r" % command)
+                results[index] = Result(command, None, '', '', False, time.time() - begin, error=error)
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(commands)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
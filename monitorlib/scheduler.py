@@ -0,0 +1,213 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Runs many checks in one long-running process, against one collectd.Client,
+    instead of one collectd Exec process per check script.
+
+    Usage:
+    cd = collectd.Client(riemann=...)
+    sched = scheduler.Scheduler(cd, workers=8)
+    sched.register('disk_check', disk_check, interval=60, timeout=20)
+    sched.register('redis_check', redis_check, interval=10)
+    sched.run()
+
+    Each check is called as check(client), where client is cd.for_check(name): alerts
+    from it are sent as, and its state is kept under, its registered name. Checks start
+    spread out over their first interval, and each run is shifted by up to +/- jitter
+    of the interval, so they don't all fire at once. A check still running after its
+    timeout gets a failure alert, and its worker is replaced (Python threads can't be
+    killed; the stuck one exits once the check returns). A check isn't started again
+    while its previous run is still going.
+"""
+
+import sys
+import time
+import heapq
+import random
+import logging
+import threading
+import Queue
+
+
+class Check(object):
+
+    def __init__(self, name, func, interval, timeout, jitter):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.queued = False
+        self.started = None
+        self.timed_out = False
+        self.runs = 0
+
+
+class Scheduler(object):
+
+    def __init__(self, client, workers=8, jitter=0.1):
+        self.client = client
+        self.workers = workers
+        self.jitter = jitter
+        self.checks = {}
+        self.queue = []
+        self.todo = Queue.Queue()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.threads = []
+        self.alert_threads = []
+        self.stopped = threading.Event()
+        self.seq = 0
+
+    def register(self, name, func, interval=None, timeout=None, jitter=None):
+        """
+        Registers func to run every interval seconds (default: the client's interval),
+        for at most timeout seconds (default: interval).
+        """
+        if name in self.checks:
+            raise ValueError("check %s is already registered" % name)
+        if interval is None:
+            interval = self.client.interval
+        interval = float(interval)
+        if timeout is None:
+            timeout = interval
+        if jitter is None:
+            jitter = self.jitter
+
+        check = Check(name, func, interval, float(timeout), jitter)
+        self.checks[name] = check
+        self._schedule(check, time.time() + random.uniform(0, interval))
+        return check
+
+    def _schedule(self, check, when):
+        self.seq += 1
+        heapq.heappush(self.queue, (when, self.seq, check))
+
+    def _next_run(self, check, scheduled):
+        spread = check.interval * check.jitter
+        return scheduled + check.interval + random.uniform(-spread, spread)
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._worker, name='check-worker')
+        thread.daemon = True
+        thread.retired = False
+        thread.start()
+        self.threads.append(thread)
+
+    def _worker(self):
+        me = threading.current_thread()
+        while not me.retired:
+            try:
+                check = self.todo.get(timeout=0.5)
+            except Queue.Empty:
+                if self.stopped.is_set():
+                    return
+                continue
+            if check is None:
+                return
+
+            with self.lock:
+                check.queued = False
+                check.started = time.time()
+                self.running[check.name] = me
+            try:
+                check.func(self.client.for_check(check.name))
+            except Exception:
+                logging.exception("check %s failed" % check.name)
+            finally:
+                with self.lock:
+                    check.started = None
+                    check.timed_out = False
+                    check.runs += 1
+                    if self.running.get(check.name) is me:
+                        del self.running[check.name]
+
+    def _check_timeouts(self, now):
+        """
+        Alerts on checks running past their timeout, and replaces their workers. The
+        alerts are sent from their own threads: sinks can take up to their deadlines,
+        and the loop has other checks to start meanwhile.
+        """
+        expired = []
+        with self.lock:
+            for name, thread in self.running.items():
+                check = self.checks[name]
+                if check.started is not None and not check.timed_out and now - check.started > check.timeout:
+                    check.timed_out = True
+                    thread.retired = True
+                    expired.append(check)
+
+        self.alert_threads = [thread for thread in self.alert_threads if thread.is_alive()]
+        for check in expired:
+            logging.error("check %s timed out after %ss" % (check.name, check.timeout))
+            self._start_worker()
+            thread = threading.Thread(target=self._alert_timeout, args=(check,), name='check-timeout-alert')
+            thread.daemon = True
+            thread.start()
+            self.alert_threads.append(thread)
+
+    def _alert_timeout(self, check):
+        try:
+            self.client.for_check(check.name).failure("check timed out after %ss" % check.timeout)
+        except Exception:
+            logging.exception("sending timeout alert for %s failed" % check.name)
+
+    def run(self, duration=None):
+        """
+        Runs the registered checks until stop() is called (or for duration seconds).
+        """
+        end = duration is not None and time.time() + duration
+        self.stopped.clear()
+        for i in range(self.workers):
+            self._start_worker()
+
+        try:
+            while not self.stopped.is_set():
+                now = time.time()
+                if end and now >= end:
+                    break
+
+                while self.queue and self.queue[0][0] <= now:
+                    scheduled, _, check = heapq.heappop(self.queue)
+                    if check.queued or check.started is not None:
+                        logging.warning("check %s is still running, skipping this run" % check.name)
+                    else:
+                        check.queued = True
+                        self.todo.put(check)
+                    self._schedule(check, max(self._next_run(check, scheduled), now))
+
+                self._check_timeouts(now)
+
+                # write what the checks produced, for collectd to read
+                self.client.flush_metrics(wait_interval=True)
+                sys.stdout.flush()
+
+                wait = 0.5
+                if self.queue:
+                    wait = min(wait, max(self.queue[0][0] - time.time(), 0))
+                if end:
+                    wait = min(wait, max(end - time.time(), 0))
+                self.stopped.wait(wait)
+        finally:
+            threads = self.stop()
+            # let idle workers exit; don't wait on ones still in a check
+            with self.lock:
+                busy = self.running.values()
+            for thread in threads:
+                if thread not in busy:
+                    thread.join(1)
+            self.client.flush_metrics()
+
+    def stop(self):
+        """
+        Stops run(). Checks already running finish in the background. Returns the
+        worker threads that were stopped.
+        """
+        self.stopped.set()
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            thread.retired = True
+        return threads
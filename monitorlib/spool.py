@@ -0,0 +1,227 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Durable on-disk outbound spool: records are appended (and fsync'd) to a segment
+    file, and handed to a delivery function later by drain(), in order, across
+    process restarts. Safe to use from many processes at once.
+
+    Usage:
+    s = spool.Spool('/tmp/pagerduty_spool')
+    s.append({'any': 'json-able dict'})
+    s.drain(deliver) # calls deliver(record) for each record, stops at the first error
+    s.drain_all(deliver_batch) # calls deliver_batch(records) once, with every record
+
+    Delivery is at-least-once: a record whose delivery succeeded, but whose progress
+    wasn't saved (crash), is delivered again. Make deliver() idempotent.
+
+    Layout of the spool directory:
+    current: the segment being appended to
+    segment-<usec>-<pid>: segments taken over by drain(), oldest first
+    segment-<usec>-<pid>.offset: bytes of that segment already delivered
+    lock, drain.lock: flock()s for appending/rotating, and draining
+"""
+
+import os
+import time
+import fcntl
+import logging
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Spool:
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # someone else made it first
+                if not os.path.isdir(path):
+                    raise
+        self.current = os.path.join(path, 'current')
+
+    def _lock(self, name, blocking=True):
+        """
+        Returns an open file holding an flock() on name, or None if not blocking and
+        it's held elsewhere. Close the file to unlock.
+        """
+        fh = open(os.path.join(self.path, name), 'a')
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fh, flags)
+        except IOError:
+            fh.close()
+            return None
+        return fh
+
+    def append(self, record):
+        """
+        Appends record (a dict) to the spool, and syncs it to disk.
+        """
+        line = json.dumps(record) + '\n'
+        lock = self._lock('lock')
+        try:
+            with open(self.current, 'a') as fh:
+                fh.write(line)
+                fh.flush()
+                os.fsync(fh.fileno())
+        finally:
+            lock.close()
+
+    def segments(self):
+        """
+        Returns the paths of the segments waiting to be drained, oldest first.
+        """
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))
+                if name.startswith('segment-') and '.' not in name]
+
+    def pending(self):
+        """
+        Returns True if there are records waiting to be drained.
+        """
+        if self.segments():
+            return True
+        return os.path.exists(self.current) and os.path.getsize(self.current) > 0
+
+    def rotate(self):
+        """
+        Moves the current segment aside, so it can be drained without racing appends.
+        """
+        lock = self._lock('lock')
+        try:
+            if os.path.exists(self.current) and os.path.getsize(self.current) > 0:
+                name = "segment-%020d-%d" % (time.time() * 1000000, os.getpid())
+                os.rename(self.current, os.path.join(self.path, name))
+        finally:
+            lock.close()
+
+    def drain(self, deliver):
+        """
+        Calls deliver(record) for every spooled record, oldest first. Stops at, and
+        re-raises, the first exception from deliver; that record is retried on the next
+        drain(). Returns the number of records delivered, or None if another process is
+        already draining.
+        """
+        lock = self._lock('drain.lock', blocking=False)
+        if lock is None:
+            return None
+
+        delivered = 0
+        try:
+            self.rotate()
+            for segment in self.segments():
+                delivered += self._drain_segment(segment, deliver)
+        finally:
+            lock.close()
+        return delivered
+
+    def drain_all(self, deliver_batch):
+        """
+        Calls deliver_batch(records) once, with every spooled record, oldest first. The
+        records are only removed if it returns without raising. Returns the number of
+        records delivered, or None if another process is already draining.
+        """
+        lock = self._lock('drain.lock', blocking=False)
+        if lock is None:
+            return None
+
+        try:
+            self.rotate()
+            segments = self.segments()
+            records = []
+            for segment in segments:
+                records.extend(self.read(segment))
+            if records:
+                deliver_batch(records)
+            for segment in segments:
+                self._remove_segment(segment)
+        finally:
+            lock.close()
+        return len(records)
+
+    def oldest(self):
+        """
+        Returns the oldest undelivered record, or None if the spool is empty.
+        """
+        for segment in self.segments() + [self.current]:
+            for record in self.read(segment):
+                return record
+        return None
+
+    def read(self, segment):
+        """
+        Yields the undelivered records in segment.
+        """
+        for record, offset in self._records(segment):
+            if record is not None:
+                yield record
+
+    def _records(self, segment):
+        """
+        Yields (record, offset after it) for the undelivered lines of segment. Unreadable
+        lines are logged, and yielded as None.
+        """
+        try:
+            offset = int(open(segment + '.offset').read() or 0)
+        except (IOError, ValueError):
+            offset = 0
+
+        try:
+            fh = open(segment, 'r')
+        except IOError:
+            # drained (or rotated) by someone else since we listed it
+            return
+
+        with fh:
+            fh.seek(offset)
+            while True:
+                line = fh.readline()
+                if not line:
+                    break
+                record = None
+                if line.endswith('\n'):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.error("dropping unreadable spool record in %s: %r" % (segment, line))
+                else:
+                    # a partial write from a crash; nothing more can be appended to a segment.
+                    logging.error("dropping partial spool record in %s: %r" % (segment, line))
+                yield record, fh.tell()
+
+    def _remove_segment(self, segment):
+        os.remove(segment)
+        if os.path.exists(segment + '.offset'):
+            os.remove(segment + '.offset')
+
+    def _drain_segment(self, segment, deliver):
+        delivered = 0
+        for record, offset in self._records(segment):
+            if record is not None:
+                deliver(record)
+                delivered += 1
+            write_atomic(segment + '.offset', str(offset))
+
+        self._remove_segment(segment)
+        return delivered
+
+
+def write_atomic(path, data):
+    """
+    Replaces path with data, so that readers see either the old or the new contents.
+    """
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp, path)
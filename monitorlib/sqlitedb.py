@@ -0,0 +1,137 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Shared sqlite connections for the on-disk stores, set up to be safe with
+    many processes (and threads) using the same database file at once. There is one
+    connection per process and database, so threads (like the ones sinks are sent
+    from) don't each open the database and set it up again.
+
+    Usage:
+    conn = sqlitedb.connect('/tmp/incident_keys.db', 'CREATE TABLE IF NOT EXISTS ...')
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# seconds to wait on a lock held by another process, before giving up
+BUSY_TIMEOUT = 10
+
+# setting up a new database races with other processes doing the same; retry this often
+SETUP_RETRIES = 20
+
+# path: Connection, for the process in CONNECTIONS_PID (connections can't be shared
+# across a fork).
+CONNECTIONS = {}
+CONNECTIONS_PID = None
+LOCK = threading.Lock()
+
+def connect(path, schema=None):
+    """
+    Returns the process' connection to the database at path, creating it (with schema)
+    if needed. It is shared by all threads, which take turns using it. Connections are
+    in autocommit mode, so every statement is its own transaction; use transaction()
+    to group several.
+    """
+    global CONNECTIONS_PID
+    with LOCK:
+        if CONNECTIONS_PID != os.getpid():
+            CONNECTIONS.clear()
+            CONNECTIONS_PID = os.getpid()
+
+        conn = CONNECTIONS.get(path)
+        if conn is None:
+            conn = CONNECTIONS[path] = Connection(path, schema)
+        return conn
+
+class Result:
+    """
+    The rows and rowcount of a statement, read while the connection was locked.
+    """
+
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+class Connection:
+    """
+    A sqlite connection shared by a process' threads: each statement (or transaction())
+    holds a lock, so they don't interleave.
+    """
+
+    def __init__(self, path, schema=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        setup(self.conn, schema)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            return Result(cursor.fetchall(), cursor.rowcount)
+
+    def executemany(self, sql, seq):
+        with self.lock:
+            cursor = self.conn.executemany(sql, seq)
+            return Result([], cursor.rowcount)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def setup(conn, schema):
+    """
+    Switches conn to WAL mode and creates the schema. Both fail with 'locked' or 'schema
+    has changed' if another process is doing the same at that moment, so retry.
+    """
+    for attempt in range(SETUP_RETRIES):
+        try:
+            # WAL lets readers run alongside a writer, and makes each commit a single append.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if schema:
+                conn.executescript(schema)
+            return
+        except sqlite3.OperationalError:
+            if attempt == SETUP_RETRIES - 1:
+                raise
+            time.sleep(0.05)
+
+class transaction:
+    """
+    Context manager for a write transaction: takes the write lock up front, commits
+    on success, rolls back on error.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        # other threads wait until the transaction is over
+        self.conn.lock.acquire()
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.conn.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.conn.execute('COMMIT')
+            else:
+                self.conn.execute('ROLLBACK')
+        finally:
+            self.conn.lock.release()
+        return False
@@ -0,0 +1,68 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc.
+###
+
+"""
+    Shared check state database: one sqlite file (in WAL mode) per state_dir, instead
+    of one JSON file per check, safe for many processes at once.
+
+    Usage:
+    store = statestore.get_store('/tmp/monitorlib-state.db')
+    store.get('check.py')              # the JSON text written last, or None
+    store.put('check.py', state_dict)  # writes only if the state changed
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import monitorlib.sqlitedb as sqlitedb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+"""
+
+# path: StateStore
+STORES = {}
+
+def get_store(path):
+    """
+    Returns the StateStore for the database at path.
+    """
+    if path not in STORES:
+        STORES[path] = StateStore(path)
+    return STORES[path]
+
+class StateStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def conn(self):
+        return sqlitedb.connect(self.path, SCHEMA)
+
+    def get(self, key):
+        """
+        Returns the state text stored for key, or None.
+        """
+        row = self.conn().execute('SELECT state FROM states WHERE key = ?', (key,)).fetchone()
+        return row and row[0]
+
+    def put(self, key, state):
+        """
+        Stores state (a dict) for key, in a single atomic statement that writes nothing if
+        the stored state is already the same. Returns True if it was written.
+        """
+        text = json.dumps(state, sort_keys=True)
+        cursor = self.conn().execute('INSERT OR REPLACE INTO states (key, state) SELECT ?, ? '
+                                     'WHERE NOT EXISTS (SELECT 1 FROM states WHERE key = ? AND state = ?)',
+                                     (key, text, key, text))
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        self.conn().execute('DELETE FROM states WHERE key = ?', (key,))
@@ -10,6 +10,7 @@ Tests for monitorlib.cloudkick
 
 
 from operator import itemgetter
+from StringIO import StringIO
 
 import nose.tools as test
 
@@ -205,3 +206,78 @@ def test_sort_by_priority():
 def test_highest_priority():
     ### At this point we've tested get_status_type() so we can use it.
     test.eq_(ck.get_status_type(ck.highest_priority(STATUS_CASES)), 'err')
+
+
+def test_parse():
+    output = StringIO('\n'.join(STATUS_CASES + METRIC_CASES + ['metric tooshort']) + '\n')
+    records = list(ck.parse(output))
+    test.eq_([type(r) for r in records],
+             [ck.Status, ck.Status, ck.Status, ck.Metric, ck.Metric])
+    test.eq_(records[1].status, 'warn')
+    test.eq_(records[1].message, 'this is a valid warning status line')
+    test.eq_(records[1].priority, ck.STATUS_PRIORITY['warn'])
+    test.eq_(records[4].name, 'two')
+    test.eq_(records[4].type, 'string')
+    test.eq_(records[4].value, 'tea for two and two for tea')
+    test.eq_(records[0], ck.status_tuple(STATUS_CASES[0]))
+    test.eq_(records[3], ck.metric_tuple(METRIC_CASES[0]))
+
+
+def test_parse_is_lazy():
+    def lines():
+        yield 'status ok fine'
+        raise AssertionError('read too far')
+
+    test.eq_(next(ck.parse(lines())), ('status', 'ok', 'fine'))
+
+
+def test_parse_line():
+    test.eq_(ck.parse_line('status err broken'), ('status', 'err', 'broken'))
+    test.eq_(ck.parse_line('metric one int 1'), ('metric', 'one', 'int', '1'))
+    test.eq_(ck.parse_line('neither of those'), None)
+
+
+def test_add_lines():
+    lines = ['status warn first warning', 'metric one int 1']
+    output = ['status ok fine', 'status warn second warning', 'metric two float 2.0', 'junk']
+    test.eq_(ck.add_lines(lines, output),
+             ['status warn second warning', 'metric one int 1', 'metric two float 2.0'])
+    test.assert_raises(IndexError, ck.add_lines, ['metric one int 1'], [])
+
+
+def test_aggregator():
+    agg = ck.Aggregator()
+    test.eq_(agg.lines(), [])
+    agg.add(['status ok fine', 'metric one int 1'])
+    agg.add(iter(['status err broken', 'metric two int 2']))
+    agg.add(['status warn odd'])
+    test.eq_(agg.status, ('status', 'err', 'broken'))
+    test.eq_(agg.lines(), ['status err broken', 'metric one int 1', 'metric two int 2'])
+
+
+def test_aggregator_matches_sort_by_priority():
+    lines = ['status %s message %d' % (status, i) for i, status in
+             enumerate(['ok', 'warn', 'warn', 'ok', 'err', 'err', 'warn'])]
+    for end in range(1, len(lines) + 1):
+        test.eq_(ck.Aggregator(lines[:end]).lines()[0], ck.sort_by_priority(lines[:end])[0])
+
+
+def test_run_plugins():
+    commands = ['echo "status ok fine"; echo "metric one int 1"',
+                'echo "status warn odd"; echo "metric two int 2"',
+                'echo "metric three int 3"']
+    test.eq_(ck.run_plugins(commands),
+             ['status err echo "metric three int 3" printed no status (exit code 0)',
+              'metric one int 1', 'metric two int 2', 'metric three int 3'])
+    test.eq_(ck.run_plugins(commands[:2]),
+             ['status warn odd', 'metric one int 1', 'metric two int 2'])
+
+
+def test_run_plugins_timeout():
+    test.eq_(ck.run_plugins(['echo "status ok fine"', 'sleep 5'], timeout=0.2),
+             ['status err sleep 5 timed out after 0.2s'])
+
+
+def test_run_plugins_error():
+    test.eq_(ck.run_plugins(['echo "status ok fine"', 'echo \0']),
+             ['status err echo \0 failed to run: execv() arg 2 must contain only strings'])
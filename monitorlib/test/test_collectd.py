@@ -0,0 +1,743 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.collectd
+"""
+
+
+import os
+import sys
+import socket
+import shutil
+import subprocess
+import tempfile
+import time
+from StringIO import StringIO
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import nose.tools as test
+
+### set before the Client is created, so dispatch_alert doesn't print.
+os.environ.setdefault('COLLECTD_HOSTNAME', 'testhost.example.com')
+
+import smtplib
+
+import monitorlib.collectd as collectd
+import monitorlib.redispool as redispool
+
+
+STATE_DIR = None
+REAL_GET_CONNECTION = redispool.get_connection
+
+
+def setup_module():
+    global STATE_DIR
+    STATE_DIR = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(STATE_DIR)
+    redispool.get_connection = REAL_GET_CONNECTION
+
+
+def make_client(caller=None, **kwargs):
+    cd = collectd.Client(**kwargs)
+    if caller:
+        cd.caller = caller
+    cd.set_state_dir(STATE_DIR)
+    return cd
+
+
+def test_run_forever_iterations():
+    cd = make_client()
+    runs = []
+    cd.run_forever(lambda client: runs.append(client), interval=0, iterations=3)
+    test.eq_(len(runs), 3)
+    assert all([client is cd for client in runs])
+
+
+def test_run_forever_resets_per_run_state():
+    cd = make_client()
+    cd.riemann_tag('base')
+    seen = []
+
+    def check(client):
+        seen.append((list(client.riemann_tags), client.alert_message, client.cur_state,
+                     client.dispatch_report))
+        client.riemann_tag('per-run')
+        client.ok('everything is fine')
+
+    cd.run_forever(check, interval=0, iterations=3)
+    for tags, alert_message, cur_state, dispatch_report in seen:
+        test.eq_(tags, ['base'])
+        test.eq_(alert_message, None)
+        test.eq_(cur_state, None)
+        test.eq_(dispatch_report, None)
+    test.eq_(cd.riemann_tags, ['base', 'per-run'])
+
+
+def test_run_forever_survives_check_errors():
+    cd = make_client()
+    runs = []
+
+    def check(client):
+        runs.append(1)
+        raise ValueError('broken check')
+
+    cd.run_forever(check, interval=0, iterations=2)
+    test.eq_(len(runs), 2)
+
+
+def test_metric():
+    cd = make_client()
+    test.eq_(cd.metric('testing/gauge-foo', 5),
+             'PUTVAL %s/testing/gauge-foo interval=%s N:5' % (cd.fqdn, cd.interval))
+
+
+def test_format_putval():
+    test.eq_(collectd.format_putval('host', 'disk-sda/disk_octets', 10, (1, 2), 1400000000.5),
+             'PUTVAL host/disk-sda/disk_octets interval=10 1400000000:1:2')
+    test.eq_(collectd.format_putval('host', 'testing/gauge-foo', 10, 1.5),
+             'PUTVAL host/testing/gauge-foo interval=10 N:1.5')
+
+
+class FakeStream(StringIO):
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringIO.write(self, data)
+
+
+def test_metric_writer_single_write():
+    stream = FakeStream()
+    writer = collectd.MetricWriter('host', 60, stream)
+    for i in range(100):
+        writer.add('queue-%d/gauge-size' % i, i)
+    test.eq_(len(writer), 100)
+    test.eq_(writer.flush(), 100)
+    test.eq_(stream.writes, 1)
+    lines = stream.getvalue().splitlines()
+    test.eq_(len(lines), 100)
+    test.eq_(lines[0], 'PUTVAL host/queue-0/gauge-size interval=60 N:0')
+    test.eq_(len(writer), 0)
+    test.eq_(writer.flush(), 0)
+    test.eq_(stream.writes, 1)
+
+
+def test_run_forever_flushes_metrics():
+    cd = make_client()
+    stream = FakeStream()
+    cd.writer.stream = stream
+    cd.run_forever(lambda client: client.add_metric('testing/gauge-foo', 1), interval=0, iterations=2)
+    test.eq_(stream.writes, 2)
+    test.eq_(len(stream.getvalue().splitlines()), 2)
+
+
+class FakeRedis:
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = 0
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+
+def with_fake_redis(data, ttl=10):
+    conn = FakeRedis(data)
+    redispool.get_connection = lambda *args, **kwargs: conn
+    collectd.ACK_CACHE.clear()
+    cd = make_client()
+    cd.set_redis_config('writer', 'reader', 6379, 6379, 'passwd', ack_cache_ttl=ttl)
+    return cd, conn
+
+
+def test_check_redis_alerts_disabled():
+    cd, conn = with_fake_redis({'global': 'other.py', 'testhost': 'check.py'})
+    assert cd.check_redis_alerts_disabled({'host': 'testhost', 'plugin': 'check.py'})
+    assert cd.check_redis_alerts_disabled({'host': 'testhost', 'plugin': 'other.py'})
+    test.assert_false(cd.check_redis_alerts_disabled({'host': 'otherhost', 'plugin': 'check.py'}))
+
+    cd, conn = with_fake_redis({'global': '*'})
+    assert cd.check_redis_alerts_disabled({'host': 'testhost', 'plugin': 'check.py'})
+
+
+def test_check_redis_alerts_disabled_cached():
+    cd, conn = with_fake_redis({'testhost': 'check.py'})
+    for i in range(5):
+        assert cd.check_redis_alerts_disabled({'host': 'testhost', 'plugin': 'check.py'})
+    test.eq_(conn.calls, 1)
+
+    cd, conn = with_fake_redis({'testhost': 'check.py'}, ttl=0)
+    for i in range(5):
+        assert cd.check_redis_alerts_disabled({'host': 'testhost', 'plugin': 'check.py'})
+    test.eq_(conn.calls, 5)
+
+
+def test_fan_out():
+    def slow():
+        time.sleep(5)
+
+    def broken():
+        raise ValueError('broken sink')
+
+    start = time.time()
+    report = collectd.fan_out([('fast', lambda: 'sent', ()),
+                               ('slow', slow, ()),
+                               ('broken', broken, ())],
+                              {'slow': 0.1}, 1)
+    assert time.time() - start < 1
+    test.eq_(report['fast']['status'], 'ok')
+    test.eq_(report['fast']['result'], 'sent')
+    test.eq_(report['slow']['status'], 'timeout')
+    test.eq_(report['broken']['status'], 'error')
+    assert isinstance(report['broken']['error'], ValueError)
+
+
+def test_dispatch_alert_fans_out():
+    cd = make_client('fan_out_check.py', url='http://localhost/', riemann={'host': 'localhost', 'port': 5555})
+    cd.set_sink_deadlines(0.2, 1)
+    cd._post_to_url = lambda message, url: time.sleep(5)
+    sent = []
+    cd._send_to_riemann = lambda riemann, message: sent.append(message)
+
+    start = time.time()
+    report = cd.failure('something is broken')
+    assert time.time() - start < 1
+    test.eq_(report['url']['status'], 'timeout')
+    test.eq_(report['riemann']['status'], 'ok')
+    test.eq_(len(sent), 1)
+    test.eq_(cd.dispatch_report, report)
+
+
+def test_dispatch_alert_reraises_sink_errors():
+    cd = make_client('reraise_check.py', riemann={'host': 'localhost', 'port': 5555})
+
+    def broken(riemann, message):
+        raise collectd.RiemannError('riemann is down')
+
+    cd._send_to_riemann = broken
+    test.assert_raises(collectd.RiemannError, cd.failure, 'something is broken')
+
+    cd.raise_sink_errors = False
+    test.eq_(cd.failure('something is broken')['riemann']['status'], 'error')
+
+
+class FakeSMTP:
+    sessions = []
+
+    def __init__(self, host):
+        self.mails = []
+        FakeSMTP.sessions.append(self)
+
+    def sendmail(self, sender, recipients, text):
+        self.mails.append((sender, recipients, text))
+
+    def quit(self):
+        pass
+
+
+def with_fake_smtp(func):
+    def wrapper():
+        real = smtplib.SMTP
+        smtplib.SMTP = FakeSMTP
+        FakeSMTP.sessions = []
+        try:
+            func()
+        finally:
+            smtplib.SMTP = real
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+@with_fake_smtp
+def test_email_digest():
+    cd = make_client()
+    cd.set_email_digest(60, STATE_DIR + '/email_spool')
+    for i in range(3):
+        cd._send_to_email('a@example.com, b@example.com',
+                          {'host': 'host', 'plugin': 'check-%d.py' % i, 'severity': 'failure', 'message': 'broken'})
+    cd._send_to_email('c@example.com',
+                      {'host': 'host', 'plugin': 'check.py', 'severity': 'warning', 'message': 'odd'})
+    ### still within the window
+    test.eq_(FakeSMTP.sessions, [])
+    test.eq_(cd.flush_email_digest(), 0)
+
+    test.eq_(cd.flush_email_digest(force=True), 4)
+    test.eq_(len(FakeSMTP.sessions), 1)
+    mails = FakeSMTP.sessions[0].mails
+    test.eq_([recipients for sender, recipients, text in mails],
+             [['a@example.com', 'b@example.com'], ['c@example.com']])
+    assert 'Subject: [collectd] 3 alerts: host' in mails[0][2]
+    assert 'Subject: [collectd] WARNING host check.py: odd' in mails[1][2]
+    test.eq_(cd.flush_email_digest(force=True), 0)
+
+
+class DownSMTP:
+    connects = 0
+
+    def __init__(self, host):
+        DownSMTP.connects += 1
+        raise socket.error('connection refused')
+
+
+def test_email_digest_smtp_down():
+    tmp = tempfile.mkdtemp()
+    real = smtplib.SMTP
+    smtplib.SMTP = DownSMTP
+    DownSMTP.connects = 0
+    try:
+        cd = make_client('digest_down_check.py')
+        cd.set_email_digest(0, tmp + '/email_spool')
+        cd.set_state_dir(tmp)
+        ### an emailing alert fails, but stays spooled
+        test.assert_raises(socket.error, cd.failure, 'broken', email='a@example.com')
+        test.eq_(DownSMTP.connects, 1)
+
+        ### dispatches that don't email neither raise, nor reconnect while backing off
+        for i in range(3):
+            cd.ok('fine')
+            cd.for_check('other_check.py').ok('fine')
+        test.eq_(DownSMTP.connects, 1)
+
+        ### once the backoff is over, the digest goes out
+        smtplib.SMTP = FakeSMTP
+        FakeSMTP.sessions = []
+        backoff = cd._email_backoff()
+        test.eq_(backoff['delay'], collectd.EMAIL_BACKOFF_MIN)
+        cd._write_email_backoff(dict(backoff, retry_at=time.time() - 1))
+        cd.ok('fine')
+        test.eq_(len(FakeSMTP.sessions), 1)
+        test.eq_(cd._email_backoff(), {})
+    finally:
+        smtplib.SMTP = real
+        shutil.rmtree(tmp)
+
+
+@with_fake_smtp
+def test_email_without_digest():
+    cd = make_client()
+    cd._send_to_email('a@example.com', {'host': 'host', 'plugin': 'check.py', 'severity': 'failure', 'message': 'broken'})
+    test.eq_(len(FakeSMTP.sessions), 1)
+    assert 'Subject: [collectd] FAILURE host check.py: broken' in FakeSMTP.sessions[0].mails[0][2]
+
+
+def count_state_writes(cd):
+    writes = []
+    real = cd.write_state
+
+    def write_state(message):
+        writes.append(message)
+        real(message)
+
+    cd.write_state = write_state
+    return writes
+
+
+def check_state_written_on_change(cd):
+    writes = count_state_writes(cd)
+    cd.ok('everything is fine')
+    cd.ok('everything is fine')
+    test.eq_(len(writes), 1)
+    cd.failure('something is broken')
+    test.eq_(cd.cur_state, 'transitioned')
+    cd.failure('something is broken')
+    test.eq_(len(writes), 2)
+    test.eq_(cd.cur_state['severity'], 'failure')
+
+
+def test_state_file_written_on_change():
+    check_state_written_on_change(make_client('state_file_check.py'))
+
+
+def test_state_store_written_on_change():
+    cd = make_client('state_store_check.py')
+    cd.set_state_store()
+    check_state_written_on_change(cd)
+    assert os.path.exists(STATE_DIR + '/monitorlib-state.db')
+    test.assert_false(os.path.exists(cd.state_file))
+    test.eq_(json.loads(cd.get_current_state())['message'], 'something is broken')
+
+
+### modules only the sinks (and cmd()) need; the plain import must not load them.
+SINK_MODULES = ['subprocess', 'smtplib', 'email', 'redis', 'bernhard', 'sqlite3', 'httplib', 'uuid',
+                'monitorlib.pagerduty', 'monitorlib.riemann', 'monitorlib.httppool', 'monitorlib.redispool',
+                'monitorlib.spool', 'monitorlib.statestore', 'monitorlib.sqlitedb', 'monitorlib.collectdnet']
+
+IMPORT_CODE = """
+import sys, time
+### the stdlib modules collectd imports itself, so only monitorlib's own cost is timed
+import socket, os, copy, logging, array, threading, json
+start = time.time()
+import monitorlib.collectd as collectd
+elapsed = time.time() - start
+collectd.Client().metric('testing/gauge-foo', 1)
+print elapsed
+print ' '.join(sys.modules)
+"""
+
+
+def test_import_time_budget():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(collectd.__file__)))
+    output = subprocess.Popen([sys.executable, '-c', IMPORT_CODE], cwd=root,
+                              stdout=subprocess.PIPE).communicate()[0]
+    elapsed, modules = output.splitlines()
+    loaded = [module for module in SINK_MODULES if module in modules.split()]
+    test.eq_(loaded, [])
+    ### timing is too noisy on shared hosts to fail every run on
+    if os.environ.get('MONITORLIB_IMPORT_BUDGET'):
+        assert float(elapsed) < collectd.IMPORT_BUDGET, \
+            "import monitorlib.collectd took %.3fs, budget is %.3fs" % (float(elapsed), collectd.IMPORT_BUDGET)
+
+
+def test_cmd():
+    cd = make_client()
+    test.eq_(cd.cmd('echo out; echo err >&2'), ('out\n', 'err\n'))
+    cd.cmd_timeout = 0.2
+    start = time.time()
+    test.eq_(cd.cmd('echo started; sleep 5'), ('started\n', ''))
+    assert time.time() - start < 2
+    results = cd.cmds(['echo %d' % i for i in range(3)])
+    test.eq_([r.stdout for r in results], ['0\n', '1\n', '2\n'])
+
+
+def test_flap_detection():
+    cd = make_client('flapping_check.py', url='http://localhost/')
+    cd.set_flap_detection(history=10, high=0.5, low=0.25)
+    emails = []
+    posts = []
+    cd._send_to_email = lambda address, message: emails.append(message['severity'])
+    cd._post_to_url = lambda message, url: posts.append(message['severity'])
+
+    for i in range(5):
+        cd.failure('something is broken', email='a@example.com')
+        cd.ok('everything is fine', email='a@example.com')
+    assert cd.flapping
+    assert len(emails) < 5
+    test.eq_(len(posts), 10)
+    assert os.path.exists(cd.state_file + '.history')
+
+    ### steady again: the history isn't rewritten, and nothing more is emailed
+    for i in range(10):
+        cd.ok('everything is fine', email='a@example.com')
+    test.assert_false(cd.flapping)
+    writes = []
+    cd.write_history = writes.append
+    cd.ok('everything is fine', email='a@example.com')
+    test.eq_(writes, [])
+    test.eq_(cd.get_history()['states'], ['okay'] * 10)
+
+
+def test_self_monitoring():
+    cd = make_client('self_monitoring_check.py', url='http://localhost/', riemann={'host': 'localhost', 'port': 5555})
+    cd.set_sink_deadlines(0.2, 1)
+    cd.raise_sink_errors = False
+    cd._post_to_url = lambda message, url: time.sleep(5)
+
+    def broken(riemann, message):
+        raise collectd.RiemannError('riemann is down')
+
+    cd._send_to_riemann = broken
+    cd.for_check('other_check.py').failure('something is broken')
+    cd.failure('something is broken')
+
+    stream = FakeStream()
+    cd.writer.stream = stream
+    cd.set_self_monitoring(0)
+    cd.flush_metrics()
+    values = dict([(line.split()[1].split('/', 1)[1], float(line.split()[3][2:]))
+                   for line in stream.getvalue().splitlines()])
+    for stage in ['state_read', 'state_write', 'dispatch', 'sink_url', 'sink_riemann']:
+        assert 'monitorlib-timing/gauge-%s' % stage in values
+        assert 'monitorlib-timing/gauge-%s_max' % stage in values
+    assert values['monitorlib-timing/gauge-sink_url_max'] >= 200
+    test.eq_(values['monitorlib-sink/gauge-url_timeouts'], 2)
+    test.eq_(values['monitorlib-sink/gauge-url_errors'], 0)
+    test.eq_(values['monitorlib-sink/gauge-riemann_errors'], 2)
+
+    ### started over
+    test.eq_(cd.emit_stats(), 0)
+
+
+def test_metric_aggregation():
+    cd = make_client()
+    stream = FakeStream()
+    cd.writer.stream = stream
+    for i in range(1, 101):
+        cd.incr('app-web/gauge-requests')
+        cd.timing('app-web/gauge-latency', i)
+    cd.incr('app-web/gauge-errors', 3)
+    cd.histogram('app-web/gauge-size', 7)
+
+    ### run_forever() and the scheduler: nothing until the interval has passed
+    cd.flush_metrics(wait_interval=True)
+    test.eq_(stream.getvalue(), '')
+
+    cd.aggregated_at -= float(cd.interval)
+    test.eq_(cd.flush_metrics(wait_interval=True), 2 + 7 * 2)
+    values = dict([(line.split()[1].split('/', 1)[1], float(line.split()[3][2:]))
+                   for line in stream.getvalue().splitlines()])
+    test.eq_(values['app-web/gauge-requests'], 100)
+    test.eq_(values['app-web/gauge-errors'], 3)
+    test.eq_(values['app-web/gauge-latency_count'], 100)
+    test.eq_(values['app-web/gauge-latency_min'], 1)
+    test.eq_(values['app-web/gauge-latency_max'], 100)
+    test.eq_(values['app-web/gauge-latency_mean'], 50.5)
+    test.eq_(values['app-web/gauge-latency_p50'], 50)
+    test.eq_(values['app-web/gauge-latency_p95'], 95)
+    test.eq_(values['app-web/gauge-latency_p99'], 99)
+    test.eq_(values['app-web/gauge-size_p99'], 7)
+
+    ### started over
+    test.eq_(cd.flush_aggregates(), 0)
+
+
+def test_metric_aggregation_one_shot():
+    cd = make_client()
+    stream = FakeStream()
+    cd.writer.stream = stream
+    cd.incr('app-web/gauge-requests', 5)
+    ### a check that runs once flushes at the end: nothing may be held back
+    test.eq_(cd.flush_metrics(), 1)
+    assert 'app-web/gauge-requests interval=%s N:5' % cd.interval in stream.getvalue()
+
+    ### nor at the end of run_forever()
+    cd.run_forever(lambda client: client.incr('app-web/gauge-requests'), interval=0, iterations=3)
+    assert stream.getvalue().endswith('app-web/gauge-requests interval=%s N:3\n' % cd.interval)
+
+
+@with_fake_smtp
+def test_dispatch_many():
+    cd = make_client('many_check.py', url='http://localhost/', riemann={'host': 'localhost', 'port': 5555})
+    cd.set_pagerduty_key('key')
+    posts = []
+    batches = []
+    pages = []
+    cd._post_to_url = lambda message, url: posts.append(message)
+    cd._send_many_to_riemann = lambda riemann, messages: batches.append(messages)
+    cd._send_many_to_pagerduty = lambda messages: pages.extend([message['plugin'] for message in messages])
+    writes = []
+    real_write = cd._write_json
+    cd._write_json = lambda suffix, data: writes.append(suffix) or real_write(suffix, data)
+
+    results = [('disk-%d' % i, 'ok', 'fine') for i in range(500)]
+    cd.dispatch_many(results, page=True, email='a@example.com')
+    test.eq_(len(posts), 1)
+    test.eq_(len(posts[0]), 500)
+    test.eq_(len(batches[0]), 500)
+    test.eq_(posts[0][0]['plugin'], 'many_check.py/disk-0')
+    test.eq_(FakeSMTP.sessions, [])
+    test.eq_(writes, ['.resources'])
+
+    ### two disks break: one email for both, pages for them (and the oks)
+    results[3] = ('disk-3', 'failure', 'full')
+    results[7] = ('disk-7', 'warning', 'almost full')
+    del pages[:]
+    cd.dispatch_many(results, page=True, email='a@example.com')
+    test.eq_([message['plugin'] for message in cd.cur_state], ['many_check.py/disk-3', 'many_check.py/disk-7'])
+    test.eq_(len(pages), 500)
+    test.eq_(len(FakeSMTP.sessions), 1)
+    mails = FakeSMTP.sessions[0].mails
+    test.eq_(len(mails), 1)
+    assert 'Subject: [collectd] 2 alerts: testhost' in mails[0][2]
+
+    ### steady: no emails, no state write
+    cd.dispatch_many(results, email='a@example.com')
+    test.eq_(len(FakeSMTP.sessions), 1)
+    test.eq_(writes, ['.resources', '.resources'])
+    states = cd._read_json('.resources')
+    test.eq_(len(states), 500)
+    test.eq_(states['disk-3']['severity'], 'failure')
+
+
+def test_dispatch_many_prune():
+    cd = make_client('prune_check.py')
+    cd.set_pagerduty_key('key')
+    pages = []
+    cd._send_many_to_pagerduty = lambda messages: pages.extend([(message['plugin'], message['severity'])
+                                                                for message in messages])
+
+    cd.dispatch_many([('disk-0', 'ok', 'fine'), ('disk-1', 'failure', 'full'), ('disk-2', 'ok', 'fine')], page=True)
+    ### without prune, missing resources are kept
+    cd.dispatch_many([('disk-0', 'ok', 'fine')], page=True)
+    test.eq_(sorted(cd._read_json('.resources')), ['disk-0', 'disk-1', 'disk-2'])
+
+    del pages[:]
+    cd.dispatch_many([('disk-0', 'ok', 'fine')], page=True, prune=True)
+    test.eq_(cd._read_json('.resources').keys(), ['disk-0'])
+    ### the failing one that went away is resolved
+    test.eq_(pages, [('prune_check.py/disk-0', 'okay'), ('prune_check.py/disk-1', 'okay')])
+    test.eq_([message['plugin'] for message in cd.cur_state], ['prune_check.py/disk-1'])
+
+
+def test_local_pagerduty_keys_resolve_on_recovery():
+    cd = make_client('local_keys_check.py')
+    cd.set_pagerduty_key('key')
+    cd.set_pagerduty_store('local')
+    pages = []
+    cd.send_to_pagerduty = lambda message, key=None: pages.append(message['severity'])
+
+    for severity in ['okay', 'okay', 'failure', 'failure', 'okay', 'okay']:
+        cd.dispatch_alert(severity, 'message', True, False, False, False)
+    test.eq_(pages, ['failure', 'okay'])
+
+    del pages[:]
+    cd._send_many_to_pagerduty = lambda messages: pages.extend([message['severity'] for message in messages])
+    for severity in ['ok', 'failure', 'ok', 'ok']:
+        cd.dispatch_many([('disk-0', severity, 'message')], page=True)
+    test.eq_(pages, ['failure', 'okay'])
+
+
+def test_local_pagerduty_keys_resolve_after_flapping():
+    cd = make_client('local_keys_flapping_check.py')
+    cd.set_pagerduty_key('key')
+    cd.set_pagerduty_store('local')
+    cd.set_flap_detection(history=4, high=0.5, low=0.25)
+    pages = []
+    cd.send_to_pagerduty = lambda message, key=None: pages.append(message['severity'])
+
+    ### recovers while flapping: the resolve goes out once it settles down
+    for severity in ['okay'] * 10 + ['failure', 'warning'] + ['okay'] * 31:
+        cd.dispatch_alert(severity, 'message', True, False, False, False)
+    test.eq_(pages[-1], 'okay')
+    test.eq_(pages.count('okay'), 1)
+    test.eq_(cd._read_json('.resolves'), {})
+
+
+def test_local_pagerduty_keys_resend_failed_resolves():
+    cd = make_client('local_keys_failing_check.py')
+    cd.set_pagerduty_key('key')
+    cd.set_pagerduty_store('local')
+    cd.raise_sink_errors = False
+    pages = []
+    failing = []
+
+    def send_to_pagerduty(message, key=None):
+        if failing:
+            raise IOError('pagerduty is down')
+        pages.append(message['severity'])
+    cd.send_to_pagerduty = send_to_pagerduty
+
+    cd.dispatch_alert('failure', 'message', True, False, False, False)
+    failing.append(True)
+    cd.dispatch_alert('okay', 'message', True, False, False, False)
+    test.eq_(cd.dispatch_report['pagerduty']['status'], 'error')
+    cd.dispatch_alert('okay', 'message', True, False, False, False)
+    del failing[:]
+    ### sent on every ok run until it gets through, then no more
+    for i in range(3):
+        cd.dispatch_alert('okay', 'message', True, False, False, False)
+    test.eq_(pages, ['failure', 'okay'])
+
+    ### the same for dispatch_many
+    del pages[:]
+    cd._send_many_to_pagerduty = lambda messages: [send_to_pagerduty(message) for message in messages]
+    cd.dispatch_many([('disk-0', 'failure', 'full')], page=True)
+    failing.append(True)
+    cd.dispatch_many([('disk-0', 'ok', 'fine')], page=True)
+    del failing[:]
+    for i in range(3):
+        cd.dispatch_many([('disk-0', 'ok', 'fine')], page=True)
+    test.eq_(pages, ['failure', 'okay'])
+    test.eq_(cd._read_json('.resolves'), {})
+
+
+class FakeRiemannConnection:
+
+    def __init__(self):
+        self.messages = []
+
+    def send_many(self, events):
+        self.messages.append(events)
+        return True
+
+
+def test_riemann_metrics():
+    import monitorlib.riemann as riemann
+
+    conn = FakeRiemannConnection()
+    real = riemann.get_connection
+    riemann.get_connection = lambda host, port, proto='tcp': conn
+    try:
+        cd = make_client(riemann={'host': 'localhost', 'port': 5555})
+        cd.writer.stream = FakeStream()
+        cd.riemann_tag('metrics')
+        cd.set_riemann_metrics()
+        cd.metric('testing/gauge-foo', 1)
+        for i in range(collectd.RIEMANN_METRIC_BATCH):
+            cd.for_check('other.py').add_metric('queue-%d/gauge-size' % i, i)
+        cd.add_metric('disk-sda/disk_octets', (10, 20), 1400000000)
+        test.eq_(cd.flush_metrics(), collectd.RIEMANN_METRIC_BATCH + 1)
+    finally:
+        riemann.get_connection = real
+
+    test.eq_([len(events) for events in conn.messages], [collectd.RIEMANN_METRIC_BATCH, 3])
+    first = conn.messages[0][0]
+    test.eq_(first['service'], 'testing/gauge-foo')
+    test.eq_(first['metric_f'], 1.0)
+    test.eq_(first['host'], 'testhost')
+    test.eq_(first['tags'], ['metrics'])
+    test.eq_(first['ttl'], 2 * float(cd.interval))
+    test.eq_([(e['service'], e['metric_f'], e['time']) for e in conn.messages[1][1:]],
+             [('disk-sda/disk_octets/0', 10.0, 1400000000), ('disk-sda/disk_octets/1', 20.0, 1400000000)])
+    ### nothing left over
+    test.eq_(cd.flush_metrics(), 0)
+    test.eq_(len(conn.messages), 2)
+
+
+def test_riemann_metrics_after_collectd():
+    import monitorlib.riemann as riemann
+
+    stream = FakeStream()
+    conn = FakeRiemannConnection()
+    written = []
+    send_many = conn.send_many
+    conn.send_many = lambda events: written.append(stream.getvalue()) or send_many(events)
+    real = riemann.get_connection
+    riemann.get_connection = lambda host, port, proto='tcp': conn
+    try:
+        cd = make_client(riemann={'host': 'localhost', 'port': 5555})
+        cd.writer.stream = stream
+        cd.set_riemann_metrics()
+        cd.add_metric('testing/gauge-foo', 'U')
+        cd.add_metric('testing/gauge-bar', 2)
+        cd.add_metric('disk-sda/disk_octets', ('U', 20))
+        test.eq_(cd.flush_metrics(), 3)
+    finally:
+        riemann.get_connection = real
+
+    ### collectd gets everything (it knows 'U'), first; riemann just the numbers
+    test.eq_(len(stream.getvalue().splitlines()), 3)
+    test.eq_(written, [stream.getvalue()])
+    test.eq_([(event['service'], event['metric_f']) for event in conn.messages[0]],
+             [('testing/gauge-bar', 2.0), ('disk-sda/disk_octets/1', 20.0)])
+    test.eq_(cd.counters.get('riemann_metric_errors'), None)
+
+
+def test_riemann_metrics_not_acknowledged():
+    import monitorlib.riemann as riemann
+
+    conn = FakeRiemannConnection()
+    conn.send_many = lambda events: False
+    real = riemann.get_connection
+    riemann.get_connection = lambda host, port, proto='tcp': conn
+    try:
+        cd = make_client(riemann={'host': 'localhost', 'port': 5555})
+        cd.writer.stream = FakeStream()
+        cd.set_riemann_metrics()
+        cd.add_metric('testing/gauge-foo', 1)
+        test.eq_(cd.flush_metrics(), 1)
+    finally:
+        riemann.get_connection = real
+    test.eq_(cd.counters['riemann_metric_errors'], 1)
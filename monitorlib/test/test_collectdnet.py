@@ -0,0 +1,251 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.collectdnet
+"""
+
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+
+import nose.tools as test
+
+os.environ.setdefault('COLLECTD_HOSTNAME', 'testhost.example.com')
+
+import monitorlib.collectd as collectd
+import monitorlib.collectdnet as collectdnet
+
+
+def parse_packet(packet):
+    """
+    Decodes a network protocol packet into a list of value dicts (and notifications).
+    """
+    values = []
+    current = {}
+    while packet:
+        part_type, length = struct.unpack('!HH', packet[:4])
+        body = packet[4:length]
+        packet = packet[length:]
+        if part_type in (collectdnet.TYPE_TIME_HR, collectdnet.TYPE_INTERVAL, collectdnet.TYPE_SEVERITY):
+            current[part_type] = struct.unpack('!Q', body)[0]
+        elif part_type == collectdnet.TYPE_VALUES:
+            count = struct.unpack('!H', body[:2])[0]
+            ds_types = struct.unpack('%dB' % count, body[2:2 + count])
+            data = body[2 + count:]
+            parsed = []
+            for i, ds_type in enumerate(ds_types):
+                fmt = {collectdnet.GAUGE: '<d', collectdnet.DERIVE: '!q'}.get(ds_type, '!Q')
+                parsed.append(struct.unpack(fmt, data[i * 8:i * 8 + 8])[0])
+            values.append(dict(current, values=parsed, ds_types=list(ds_types)))
+        elif part_type == collectdnet.TYPE_MESSAGE:
+            values.append(dict(current, message=body.rstrip('\0')))
+        else:
+            current[part_type] = body.rstrip('\0')
+    return values
+
+
+def udp_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(2)
+    return sock
+
+
+def test_network_packets():
+    transport = collectdnet.NetworkTransport('127.0.0.1', 1)
+    values = [('queue-%d/gauge-size' % (i % 3), i * 1.5, 1400000000 + i) for i in range(300)]
+    values.append(('disk-sda/disk_octets', (10, 20), 1400000000))
+    packets = transport.packets('host', 10, values)
+    assert 1 < len(packets) < 20
+    assert all([len(packet) <= collectdnet.MAX_PACKET for packet in packets])
+
+    parsed = sum([parse_packet(packet) for packet in packets], [])
+    test.eq_(len(parsed), 301)
+    test.eq_(parsed[4][collectdnet.TYPE_HOST], 'host')
+    test.eq_(parsed[4][collectdnet.TYPE_PLUGIN], 'queue')
+    test.eq_(parsed[4][collectdnet.TYPE_PLUGIN_INSTANCE], '1')
+    test.eq_(parsed[4][collectdnet.TYPE_TYPE], 'gauge')
+    test.eq_(parsed[4][collectdnet.TYPE_TYPE_INSTANCE], 'size')
+    test.eq_(parsed[4][collectdnet.TYPE_INTERVAL], 10)
+    test.eq_(parsed[4][collectdnet.TYPE_TIME_HR] >> 30, 1400000004)
+    test.eq_(parsed[4]['values'], [6.0])
+    test.eq_(parsed[-1]['values'], [10, 20])
+    test.eq_(parsed[-1]['ds_types'], [collectdnet.DERIVE, collectdnet.DERIVE])
+
+    ### the host is only sent once per packet
+    test.eq_(packets[1].count('host\0'), 1)
+
+
+def test_network_coerces_values():
+    transport = collectdnet.NetworkTransport('127.0.0.1', 1)
+    values = [('testing/gauge-foo', '42', 1400000000), ('testing/gauge-unknown', 'U', 1400000000),
+              ('testing/gauge-bad', 'broken', 1400000000), ('testing/derive-count', '7', 1400000000),
+              ('disk-sda/disk_octets', ('10', 20.0), 1400000000)]
+    parsed = sum([parse_packet(packet) for packet in transport.packets('host', 10, values)], [])
+    ### only the value that isn't a number is skipped
+    test.eq_([value[collectdnet.TYPE_TYPE_INSTANCE] for value in parsed], ['foo', 'unknown', 'count', ''])
+    test.eq_(parsed[0]['values'], [42.0])
+    assert parsed[1]['values'][0] != parsed[1]['values'][0]
+    test.eq_(parsed[2]['values'], [7])
+    test.eq_(parsed[3]['values'], [10, 20])
+
+
+def test_client_network_transport():
+    server = udp_server()
+    cd = collectd.Client()
+    cd.set_metric_transport('network', host='127.0.0.1', port=server.getsockname()[1], notify=True)
+    cd.set_state_dir(tempfile.mkdtemp())
+    try:
+        for i in range(5):
+            cd.add_metric('testing/gauge-foo-%d' % i, i)
+        test.eq_(cd.flush_metrics(), 5)
+        test.eq_(len(parse_packet(server.recv(65536))), 5)
+
+        cd.failure('something is broken')
+        notification = parse_packet(server.recv(65536))[0]
+        test.eq_(notification['message'], 'something is broken')
+        test.eq_(notification[collectdnet.TYPE_SEVERITY], 1)
+    finally:
+        shutil.rmtree(cd.state_dir)
+        server.close()
+
+
+class FakeUnixsock(threading.Thread):
+    """
+    Stands in for collectd's unixsock plugin: replies to each command, rejecting ones
+    containing 'bad'.
+    """
+
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.commands = []
+        self.connections = 0
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            reader = conn.makefile('r')
+            for line in reader:
+                self.commands.append(line.rstrip('\n'))
+                if 'bad' in line:
+                    conn.sendall('-1 Parsing options failed.\n')
+                else:
+                    conn.sendall('0 Success: 1 value has been dispatched.\n')
+            conn.close()
+
+
+def test_unixsock_transport():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'collectd-unixsock')
+    server = FakeUnixsock(path)
+    server.start()
+    transport = collectdnet.UnixsockTransport(path)
+    try:
+        test.eq_(transport.send('host', 10, [('testing/gauge-foo', 1, None),
+                                             ('testing/gauge-bad', 2, 1400000000),
+                                             ('testing/gauge-bar', 3, None)]), 2)
+        test.eq_(server.commands[:3], ['PUTVAL host/testing/gauge-foo interval=10 N:1',
+                                       'PUTVAL host/testing/gauge-bad interval=10 1400000000:2',
+                                       'PUTVAL host/testing/gauge-bar interval=10 N:3'])
+        test.eq_(transport.notify('host', 'check.py', 'failure', 'it "broke"', 1400000000), 1)
+        test.eq_(server.commands[3],
+                 'PUTNOTIF host=host plugin=check.py severity=failure time=1400000000 message="it \\"broke\\""')
+
+        ### reconnects if collectd closed the connection
+        transport.sock.shutdown(socket.SHUT_RDWR)
+        test.eq_(transport.send('host', 10, [('testing/gauge-foo', 1, None)]), 1)
+        test.eq_(server.connections, 2)
+    finally:
+        transport.close()
+        server.sock.close()
+        shutil.rmtree(tmp)
+
+
+def test_unixsock_large_batch():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'collectd-unixsock')
+    server = FakeUnixsock(path)
+    server.start()
+    ### a short timeout: writing everything before reading replies would deadlock
+    transport = collectdnet.UnixsockTransport(path, timeout=2)
+    try:
+        values = [('queue-%d/gauge-size' % i, i, None) for i in range(20000)]
+        test.eq_(transport.send('host', 10, values), 20000)
+        test.eq_(len(server.commands), 20000)
+        test.eq_(server.commands[-1], 'PUTVAL host/queue-19999/gauge-size interval=10 N:19999')
+    finally:
+        transport.close()
+        server.sock.close()
+        shutil.rmtree(tmp)
+
+
+def test_client_keeps_values_while_collectd_is_away():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'collectd-unixsock')
+    cd = collectd.Client()
+    cd.set_metric_transport('unixsock', path=path)
+    server = None
+    try:
+        ### no collectd yet: nothing is lost, and run_forever keeps going
+        cd.run_forever(lambda client: client.add_metric('testing/gauge-foo', 1), interval=0, iterations=3)
+        test.eq_(len(cd.writer), 3)
+        test.eq_(cd.writer.errors, 3)
+        test.eq_(cd.counters['metric_write_errors'], 3)
+
+        server = FakeUnixsock(path)
+        server.start()
+        cd.add_metric('testing/gauge-foo', 2)
+        test.eq_(cd.flush_metrics(), 4)
+        test.eq_(len(cd.writer), 0)
+        test.eq_([command.split()[-1] for command in server.commands], ['N:1', 'N:1', 'N:1', 'N:2'])
+    finally:
+        cd.writer.transport.close()
+        if server is not None:
+            server.sock.close()
+        shutil.rmtree(tmp)
+
+
+def test_writer_buffer_limit():
+    writer = collectd.MetricWriter('host', 10, transport=collectdnet.UnixsockTransport('/nonexistent'),
+                                   max_values=5)
+    for i in range(4):
+        writer.add('testing/gauge-foo', i)
+    writer.flush()
+    for i in range(4, 8):
+        writer.add('testing/gauge-foo', i)
+    writer.flush()
+    test.eq_([value for path, value, timestamp in writer.values], [3, 4, 5, 6, 7])
+
+
+class HalfTransport:
+    """
+    Gets the first chunk of values through, then fails.
+    """
+
+    def send(self, host, interval, values):
+        err = socket.error('connection closed by collectd')
+        err.sent = 2
+        raise err
+
+
+def test_writer_requeues_only_unsent_values():
+    writer = collectd.MetricWriter('host', 10, transport=HalfTransport())
+    for i in range(5):
+        writer.add('testing/gauge-foo', i)
+    test.eq_(writer.flush(), 2)
+    test.eq_([value for path, value, timestamp in writer.values], [2, 3, 4])
@@ -0,0 +1,73 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.flap
+"""
+
+
+import nose.tools as test
+
+import monitorlib.flap as flap
+
+
+def run(damper, history, severities, start=0, step=60):
+    """
+    Feeds severities to damper, one run every step seconds, and returns the runs that
+    notified. A run transitions when its severity differs from the previous one.
+    """
+    notified = []
+    previous = history.get('states', ['okay'])[-1]
+    for i, severity in enumerate(severities):
+        if damper.update(history, severity, severity != previous, start + i * step):
+            notified.append(i)
+        previous = severity
+    return notified
+
+
+def test_change_rate():
+    damper = flap.Damper(history=10)
+    test.eq_(damper.change_rate(['okay']), 0.0)
+    test.eq_(damper.change_rate(['okay'] * 10), 0.0)
+    test.eq_(damper.change_rate(['okay', 'failure'] * 5), 1.0)
+    ### recent changes weigh more than old ones
+    assert damper.change_rate(['okay'] * 5 + ['failure']) > damper.change_rate(['failure'] + ['okay'] * 5)
+
+
+def test_no_damping_by_default():
+    history = {}
+    test.eq_(run(flap.Damper(), history, ['failure', 'okay', 'failure']), [0, 1, 2])
+
+
+def test_flapping_suppresses_until_settled():
+    damper = flap.Damper(history=10, high=0.5, low=0.25)
+    history = {}
+    notified = run(damper, history, ['failure', 'okay'] * 5)
+    assert history['flapping']
+    ### the first few changes go out, before the check counts as flapping
+    assert len(notified) < 5
+    ### settling in failure: notified once the change rate drops below low
+    notified = run(damper, history, ['failure'] * 10, start=600)
+    test.eq_(len(notified), 1)
+    test.assert_false(history['flapping'])
+    test.eq_(history['pending'], None)
+
+
+def test_min_duration():
+    damper = flap.Damper(min_duration=120)
+    history = {}
+    ### a blip shorter than min_duration is never notified
+    test.eq_(run(damper, history, ['failure', 'okay', 'okay']), [])
+    test.eq_(history['pending'], None)
+    ### a lasting failure is, once it's lasted min_duration
+    test.eq_(run(damper, history, ['failure', 'failure', 'failure', 'failure'], start=1000), [2])
+
+
+def test_hold_down():
+    damper = flap.Damper(hold_down=300)
+    history = {}
+    test.eq_(run(damper, history, ['failure'] + ['warning'] * 5), [0, 5])
+    ### going back to what was notified last, within hold_down, isn't notified again
+    test.eq_(run(damper, history, ['failure', 'warning'], start=400), [])
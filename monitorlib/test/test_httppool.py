@@ -0,0 +1,189 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.httppool
+"""
+
+
+import os
+import time
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import nose.tools as test
+
+import monitorlib.httppool as httppool
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        self.server.sockets.append(self.connection)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.bodies.append(body)
+        self.server.requests.append((self.path, self.headers.get('Proxy-Authorization')))
+        if 'slow' in self.path:
+            time.sleep(0.5)
+        status = 500 if 'fail' in self.path else 200
+        reply = '{"status": "success"}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        ### clients hanging up (e.g. after timing out) are expected
+        pass
+
+
+def start_server():
+    server = Server(('127.0.0.1', 0), Handler)
+    server.connections = 0
+    server.bodies = []
+    server.requests = []
+    server.sockets = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def close_all():
+    httppool.close_all()
+
+
+@test.with_setup(teardown=close_all)
+def test_post_json_keepalive():
+    server, url = start_server()
+    for i in range(5):
+        test.eq_(httppool.post_json(url + '/event', {'n': i}), '{"status": "success"}')
+    test.eq_(server.connections, 1)
+    test.eq_(server.bodies[-1], '{"n": 4}')
+    server.shutdown()
+
+
+@test.with_setup(teardown=close_all)
+def test_post_json_error_status():
+    server, url = start_server()
+    try:
+        httppool.post_json(url + '/fail', {})
+    except httppool.HTTPError as err:
+        test.eq_(err.status, 500)
+        test.eq_(err.body, '{"status": "success"}')
+    else:
+        raise AssertionError('expected HTTPError')
+    server.shutdown()
+
+
+@test.with_setup(teardown=close_all)
+def test_reconnects_after_server_closes():
+    server, url = start_server()
+    httppool.post_json(url, {})
+    ### break the pooled connection, as if the server had closed it: the
+    ### request is retried on a new connection.
+    for idle in httppool.POOL.values():
+        for conn in idle:
+            conn.sock.shutdown(2)
+    test.eq_(httppool.post_json(url, {}), '{"status": "success"}')
+    test.eq_(server.connections, 2)
+    server.shutdown()
+
+
+@test.with_setup(teardown=close_all)
+def test_reconnects_after_server_closes_idle_connection():
+    server, url = start_server()
+    httppool.post_json(url, {})
+    ### the server closes the idle connection: the request goes out, but no
+    ### response comes back.
+    server.sockets[0].shutdown(socket.SHUT_RDWR)
+    time.sleep(0.1)
+    test.eq_(httppool.post_json(url, {}), '{"status": "success"}')
+    test.eq_(server.connections, 2)
+    server.shutdown()
+
+
+@test.with_setup(teardown=close_all)
+def test_no_retry_after_read_timeout():
+    server, url = start_server()
+    httppool.post_json(url, {})
+    read_timeout = httppool.READ_TIMEOUT
+    httppool.READ_TIMEOUT = 0.1
+    try:
+        for idle in httppool.POOL.values():
+            for conn in idle:
+                conn.sock.settimeout(0.1)
+        ### the server got the request, so it must not be sent again
+        test.assert_raises(socket.timeout, httppool.post_json, url + '/slow', {'n': 1})
+        time.sleep(0.5)
+        test.eq_(server.bodies.count('{"n": 1}'), 1)
+    finally:
+        httppool.READ_TIMEOUT = read_timeout
+    server.shutdown()
+
+
+def with_proxy_env(**env):
+    def decorate(func):
+        def wrapper():
+            saved = dict((name, os.environ.get(name)) for name in env)
+            os.environ.update(env)
+            try:
+                func()
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorate
+
+
+@test.with_setup(teardown=close_all)
+def test_http_through_proxy():
+    proxy, proxy_url = start_server()
+    os.environ['http_proxy'] = proxy_url.replace('//', '//user:secret@')
+    try:
+        for i in range(2):
+            test.eq_(httppool.post_json('http://events.example.com/event?x=1', {'n': i}), '{"status": "success"}')
+    finally:
+        del os.environ['http_proxy']
+    ### the proxy gets the absolute URL and the credentials, on a kept-alive connection
+    test.eq_(proxy.requests[-1], ('http://events.example.com/event?x=1', 'Basic dXNlcjpzZWNyZXQ='))
+    test.eq_(proxy.connections, 1)
+    proxy.shutdown()
+
+
+@test.with_setup(teardown=close_all)
+@with_proxy_env(http_proxy='http://127.0.0.1:1', no_proxy='127.0.0.1')
+def test_no_proxy_bypass():
+    server, url = start_server()
+    test.eq_(httppool.post_json(url + '/event', {}), '{"status": "success"}')
+    test.eq_(server.requests[-1][0], '/event')
+    server.shutdown()
+
+
+@with_proxy_env(https_proxy='proxy.example.com:3128')
+def test_https_tunnels_through_proxy():
+    proxy = httppool.proxy_for('https', 'events.example.com')
+    test.eq_(proxy, 'http://proxy.example.com:3128')
+    conn = httppool.connect(('https', 'events.example.com', None, proxy))
+    test.eq_((conn.host, conn.port), ('proxy.example.com', 3128))
+    test.eq_(conn._tunnel_host, 'events.example.com')
@@ -0,0 +1,390 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.pagerduty
+"""
+
+
+import os
+import shutil
+import tempfile
+import cPickle as pickle
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import nose.tools as test
+
+import monitorlib.pagerduty as pd
+import monitorlib.redispool as redispool
+
+
+TMP_DIR = None
+
+
+def setup_tmp():
+    global TMP_DIR
+    TMP_DIR = tempfile.mkdtemp()
+
+
+def teardown_tmp():
+    shutil.rmtree(TMP_DIR)
+
+
+def store_path(name):
+    return os.path.join(TMP_DIR, name)
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_store():
+    assert pd.set_datastore('sqlite', store_path('incident_keys.db'))
+    test.eq_(pd.get_incident_key('key^host check.py'), None)
+    pd.add_incident_key('key^host check.py', 'abc123')
+    test.eq_(pd.get_incident_key('key^host check.py'), 'abc123')
+    pd.add_incident_key('key^host check.py', 'def456')
+    test.eq_(pd.get_incident_key('key^host check.py'), 'def456')
+    pd.del_incident_key('key^host check.py')
+    test.eq_(pd.get_incident_key('key^host check.py'), None)
+    ### deleting a missing key is fine
+    pd.del_incident_key('key^host check.py')
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_migrates_pickle():
+    legacy = store_path('incident_keys')
+    pickle.dump({'key^host a.py': 'aaa', 'key^host b.py': 'bbb'}, open(legacy, 'w'))
+    pd.set_datastore('sqlite', legacy + '.db')
+    test.eq_(pd.get_incident_key('key^host a.py'), 'aaa')
+    test.eq_(pd.get_incident_key('key^host b.py'), 'bbb')
+    test.assert_false(os.path.exists(legacy))
+    assert os.path.exists(legacy + '.migrated')
+    ### nothing left to migrate the second time around
+    test.eq_(pd.migrate_pickle(legacy), 0)
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_concurrent_writers():
+    path = store_path('incident_keys.db')
+    pd.set_datastore('sqlite', path)
+    pids = []
+    for writer in range(4):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(25):
+                    pd.add_incident_key('key^host %d-%d.py' % (writer, i), str(i))
+            except Exception:
+                os._exit(1)
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        test.eq_(os.waitpid(pid, 0)[1], 0)
+
+    for writer in range(4):
+        for i in range(25):
+            test.eq_(pd.get_incident_key('key^host %d-%d.py' % (writer, i)), str(i))
+
+
+class FakeRedis:
+    """
+    Just enough of a redis server, for the incident key layout; counts round trips.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def execute_command(self, name, *args):
+        self.round_trips += 1
+        return getattr(self, name)(*args)
+
+    def __getattr__(self, name):
+        if name.startswith('do_'):
+            raise AttributeError(name)
+        return lambda *args: self.execute_command('do_' + name, *args)
+
+    def do_get(self, key):
+        return self.data.get(key)
+
+    def do_set(self, key, value):
+        self.data[key] = value
+
+    def do_mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def do_delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def do_hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def do_hmget(self, key, fields):
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def do_hdel(self, key, *fields):
+        return len([self.data.get(key, {}).pop(field) for field in fields if field in self.data.get(key, {})])
+
+    def do_zadd(self, key, member, score):
+        self.data.setdefault(key, {})[member] = score
+
+    def do_zrem(self, key, *members):
+        return self.do_hdel(key, *members)
+
+    def do_zrangebyscore(self, key, low, high):
+        return sorted([member for member, score in self.data.get(key, {}).items() if score <= high])
+
+    def do_expire(self, key, ttl):
+        self.ttls[key] = ttl
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.redis, 'do_' + name), args))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [command(*args) for command, args in self.commands]
+
+
+def with_fake_redis(func):
+    def wrapper():
+        real = redispool.get_connection
+        conn = FakeRedis()
+        redispool.get_connection = lambda *args, **kwargs: conn
+        pd.REDIS_EXPIRED_AT.clear()
+        try:
+            pd.set_datastore('redis', {'reader': 'reader', 'reader_port': 6379, 'writer': 'writer',
+                                       'writer_port': 6379, 'db': 'db0', 'passwd': None})
+            pd.authenticate('key')
+            func(conn)
+        finally:
+            redispool.get_connection = real
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+@with_fake_redis
+def test_redis_store(conn):
+    test.eq_(pd.get_incident_key('key^host check.py'), None)
+    pd.add_incident_key('key^host check.py', 'abc123')
+    pd.add_incident_key('key^host other.py', 'def456')
+    test.eq_(conn.data['incident_keys:key'], {'host check.py': 'abc123', 'host other.py': 'def456'})
+    ### kept until resolved, however long that takes
+    test.eq_(conn.ttls, {})
+
+    conn.round_trips = 0
+    test.eq_(pd.get_incident_key('key^host check.py'), 'abc123')
+    test.eq_(conn.round_trips, 1)
+    pd.del_incident_key('key^host check.py')
+    test.eq_(conn.round_trips, 2)
+    test.eq_(pd.get_incident_key('key^host check.py'), None)
+    test.eq_(conn.data['incident_keys:key:seen'].keys(), ['host other.py'])
+
+
+@with_fake_redis
+def test_redis_bulk_lookup_and_legacy_keys(conn):
+    ### written by the old layout: one string key each
+    conn.data['key^host old.py'] = 'old123'
+    pd.add_incident_key('key^host check.py', 'abc123')
+    pd.add_incident_key('other^host check.py', 'def456')
+
+    conn.round_trips = 0
+    test.eq_(pd.get_incident_keys(['key^host check.py', 'other^host check.py', 'key^host old.py', 'key^host new.py']),
+             {'key^host check.py': 'abc123', 'other^host check.py': 'def456',
+              'key^host old.py': 'old123', 'key^host new.py': None})
+    test.eq_(conn.round_trips, 1)
+
+    ### moved to the hash when it's next written
+    pd.add_incident_key('key^host old.py', 'old456')
+    test.assert_false('key^host old.py' in conn.data)
+    test.eq_(pd.get_incident_key('key^host old.py'), 'old456')
+
+
+@with_fake_redis
+def test_redis_expires_orphans(conn):
+    pd.add_incident_key('key^host stale.py', 'abc123')
+    conn.data['incident_keys:key:seen']['host stale.py'] -= 3600
+    ### no TTL configured: nothing expires
+    test.eq_(pd.expire_incident_keys(), 0)
+
+    ### with one, writes expire stale keys along the way
+    pd.STORAGE_CONFIG['key_ttl'] = 1800
+    pd.add_incident_key('key^host fresh.py', 'def456')
+    test.eq_(conn.ttls['incident_keys:key'], 1800)
+    test.eq_(pd.get_incident_key('key^host stale.py'), None)
+    test.eq_(pd.get_incident_key('key^host fresh.py'), 'def456')
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_bulk_lookup():
+    pd.set_datastore('sqlite', store_path('incident_keys.db'))
+    for i in range(1000):
+        pd.add_incident_key('key^host %d.py' % i, str(i))
+    found = pd.get_incident_keys(['key^host %d.py' % i for i in range(1200)])
+    test.eq_(len(found), 1200)
+    test.eq_(found['key^host 999.py'], '999')
+    test.eq_(found['key^host 1000.py'], None)
+
+
+class FakePagerDuty:
+    """
+    Stands in for pd.send_to_pagerduty; fails while self.down is set.
+    """
+
+    def __init__(self):
+        self.down = False
+        self.sent = []
+
+    def __call__(self, message):
+        if self.down:
+            raise IOError('pagerduty is down')
+        self.sent.append(dict(message))
+        return json.dumps({'status': 'success', 'incident_key': message['incident_key'] or 'new-key'})
+
+
+def with_fake_pagerduty(func):
+    def wrapper():
+        real = pd.send_to_pagerduty
+        fake = pd.send_to_pagerduty = FakePagerDuty()
+        setup_tmp()
+        try:
+            pd.set_datastore('sqlite', store_path('incident_keys.db'))
+            pd.authenticate('service-key')
+            pd.set_spool(store_path('spool'))
+            func(fake)
+        finally:
+            pd.set_spool(None)
+            pd.DRAIN_WAKEUP.set()
+            pd.send_to_pagerduty = real
+            teardown_tmp()
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+@with_fake_pagerduty
+def test_spooled_events_are_delivered_in_order(fake):
+    test.eq_(pd.event('trigger', 'FAILURE: host check.py: broken'), None)
+    test.eq_(pd.event('resolve', 'OKAY: host check.py: fixed'), None)
+    ### delivered by the background drainer
+    assert pd.wait_for_drainer(5)
+    test.eq_([m['event_type'] for m in fake.sent], ['trigger', 'resolve'])
+    ### the trigger used its spool id as incident_key, and the resolve found it
+    assert fake.sent[0]['incident_key']
+    test.eq_(fake.sent[1]['incident_key'], fake.sent[0]['incident_key'])
+    test.eq_(pd.get_incident_key('service-key^ host check.py'), None)
+
+
+@with_fake_pagerduty
+def test_spool_retries_failed_delivery(fake):
+    pd.SPOOL.append({'id': 'abc', 'service_key': 'service-key', 'event_type': 'trigger',
+                     'desc': 'FAILURE: host check.py: broken', 'details': None})
+    fake.down = True
+    test.assert_raises(IOError, pd.drain_spool)
+    assert pd.SPOOL.pending()
+
+    fake.down = False
+    test.eq_(pd.drain_spool(), 1)
+    test.eq_(fake.sent[0]['incident_key'], 'abc')
+    test.eq_(pd.get_incident_key('service-key^ host check.py'), 'abc')
+
+
+def test_local_keys():
+    real = pd.send_to_pagerduty
+    fake = pd.send_to_pagerduty = FakePagerDuty()
+    try:
+        pd.set_datastore('local', None)
+        pd.authenticate('service-key')
+        pd.event('trigger', 'FAILURE: host check.py: broken')
+        pd.event('resolve', 'OKAY: host check.py: fixed')
+        pd.event('trigger', 'FAILURE: host other.py: broken')
+    finally:
+        pd.send_to_pagerduty = real
+
+    test.eq_([m['event_type'] for m in fake.sent], ['trigger', 'resolve', 'trigger'])
+    test.eq_(fake.sent[0]['incident_key'], pd.local_key('service-key^ host check.py'))
+    test.eq_(fake.sent[1]['incident_key'], fake.sent[0]['incident_key'])
+    assert fake.sent[2]['incident_key'] != fake.sent[0]['incident_key']
+    ### different service keys don't share incidents
+    assert pd.local_key('other-key^ host check.py') != pd.local_key('service-key^ host check.py')
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_connection_shared_by_threads():
+    import threading
+    import monitorlib.sqlitedb as sqlitedb
+
+    pd.set_datastore('sqlite', store_path('incident_keys.db'))
+    conns = []
+
+    def worker(n):
+        conns.append(pd.sqlite_conn())
+        for i in range(20):
+            pd.add_incident_key('key^host %d-%d.py' % (n, i), str(i))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ### every thread (like each sink's fan_out thread) got the same, already set up, connection
+    test.eq_(len(set(conns)), 1)
+    assert conns[0] is sqlitedb.connect(store_path('incident_keys.db'))
+    test.eq_(len(pd.get_incident_keys(['key^host %d-%d.py' % (n, i) for n in range(4) for i in range(20)])), 80)
+    test.eq_(pd.get_incident_key('key^host 3-19.py'), '19')
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_migration_failure_keeps_pickle():
+    legacy = store_path('incident_keys')
+    open(legacy, 'w').write('not a pickle')
+    pd.set_datastore('sqlite', legacy + '.db')
+    ### put back for the next try (or a human), not stranded in .migrating.<pid>
+    test.eq_(open(legacy).read(), 'not a pickle')
+    test.eq_([name for name in os.listdir(TMP_DIR) if '.migrating.' in name], [])
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_sqlite_migration_picks_up_crashed_migration():
+    legacy = store_path('incident_keys')
+    ### left by a process that died mid-migration
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    pickle.dump({'key^host a.py': 'aaa'}, open('%s.migrating.%d' % (legacy, pid), 'w'))
+
+    pd.set_datastore('sqlite', legacy + '.db')
+    test.eq_(pd.get_incident_key('key^host a.py'), 'aaa')
+    test.eq_(os.listdir(TMP_DIR).count('incident_keys.migrating.%d' % pid), 0)
+
+
+@with_fake_redis
+def test_events_look_up_keys_at_once(conn):
+    real = pd.send_to_pagerduty
+    fake = pd.send_to_pagerduty = FakePagerDuty()
+    try:
+        for i in range(3):
+            pd.add_incident_key('key^ host %d.py' % i, 'incident-%d' % i)
+        conn.round_trips = 0
+        pd.events([('resolve', 'OKAY: host %d.py: fixed' % i) for i in range(3)] +
+                  [('trigger', 'FAILURE: host 3.py: broken')])
+    finally:
+        pd.send_to_pagerduty = real
+
+    test.eq_([message['incident_key'] for message in fake.sent], ['incident-0', 'incident-1', 'incident-2', None])
+    ### one lookup, then one write per event
+    test.eq_(conn.round_trips, 5)
+    test.eq_(conn.data['incident_keys:key'], {' host 3.py': 'new-key'})
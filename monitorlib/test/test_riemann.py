@@ -0,0 +1,119 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.riemann
+"""
+
+
+import socket
+import struct
+import threading
+
+import nose.tools as test
+import bernhard
+
+import monitorlib.riemann as riemann
+
+
+class FakeRiemann(threading.Thread):
+    """
+    Accepts TCP connections, and acks every message, keeping what it received.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def recv_exactly(self, conn, size):
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self.connections += 1
+            while True:
+                header = self.recv_exactly(conn, 4)
+                if header is None:
+                    break
+                raw = self.recv_exactly(conn, struct.unpack('!I', header)[0])
+                self.messages.append(bernhard.Message(raw=raw))
+                ack = bernhard.Message()
+                ack.ok = True
+                conn.sendall(struct.pack('!I', len(ack.raw)) + ack.raw)
+            conn.close()
+
+
+def close_connections():
+    riemann.close_all()
+
+
+def event(service):
+    return {'host': 'testhost', 'service': service, 'state': 'ok', 'tags': ['test']}
+
+
+@test.with_setup(teardown=close_connections)
+def test_connection_is_reused():
+    server = FakeRiemann()
+    server.start()
+    for i in range(3):
+        conn = riemann.get_connection('127.0.0.1', server.port)
+        assert conn.send(event('check-%d.py' % i))
+    test.eq_(server.connections, 1)
+    test.eq_(len(server.messages), 3)
+    test.eq_(server.messages[0].events[0].service, 'check-0.py')
+
+
+@test.with_setup(teardown=close_connections)
+def test_send_many_is_one_message():
+    server = FakeRiemann()
+    server.start()
+    conn = riemann.get_connection('127.0.0.1', server.port)
+    assert conn.send_many([event('check-%d.py' % i) for i in range(10)])
+    test.eq_(len(server.messages), 1)
+    test.eq_([e.service for e in server.messages[0].events], ['check-%d.py' % i for i in range(10)])
+
+
+@test.with_setup(teardown=close_connections)
+def test_udp():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    conn = riemann.get_connection('127.0.0.1', sock.getsockname()[1], 'udp')
+    assert conn.send_many([event('a.py'), event('b.py')])
+    message = bernhard.Message(raw=sock.recv(65536))
+    test.eq_([e.service for e in message.events], ['a.py', 'b.py'])
+    sock.close()
+
+
+@test.with_setup(teardown=close_connections)
+def test_udp_split_by_size():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    conn = riemann.get_connection('127.0.0.1', sock.getsockname()[1], 'udp')
+    events = [dict(event('queue-%d/gauge-size' % i), metric_f=i, ttl=20.0) for i in range(500)]
+    assert conn.send_many(events)
+
+    services = []
+    while len(services) < 500:
+        raw = sock.recv(65536)
+        assert len(raw) <= riemann.MAX_UDP_MESSAGE
+        services.extend([e.service for e in bernhard.Message(raw=raw).events])
+    test.eq_(services, [e['service'] for e in events])
+    sock.close()
@@ -0,0 +1,79 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.runner
+"""
+
+
+import time
+
+import nose.tools as test
+
+import monitorlib.runner as runner
+
+
+def test_run():
+    result = runner.run('echo out; echo err >&2; exit 3')
+    test.eq_(result.stdout, 'out\n')
+    test.eq_(result.stderr, 'err\n')
+    test.eq_(result.returncode, 3)
+    test.assert_false(result.timed_out)
+
+
+def test_run_timeout_kills_group():
+    start = time.time()
+    ### the shell's child (sleep) keeps the pipes open, unless the whole group is killed
+    result = runner.run('echo started; sleep 5; echo never', timeout=0.2)
+    assert time.time() - start < 2
+    assert result.timed_out
+    test.eq_(result.stdout, 'started\n')
+
+
+def test_run_many():
+    start = time.time()
+    results = runner.run_many(['sleep 0.3; echo %d' % i for i in range(4)], workers=4)
+    assert time.time() - start < 1
+    test.eq_([r.stdout for r in results], ['0\n', '1\n', '2\n', '3\n'])
+
+
+def test_run_many_error():
+    ### a NUL byte can't be passed to exec: the other commands still run
+    results = runner.run_many(['echo one', 'echo \0', 'echo three'], workers=2)
+    test.eq_([r.stdout for r in results], ['one\n', '', 'three\n'])
+    test.eq_(results[1].returncode, None)
+    assert isinstance(results[1].error, TypeError)
+    test.eq_(results[0].error, None)
+
+
+def test_run_max_output():
+    result = runner.run('head -c 1000000 /dev/zero; echo done >&2', max_output=1000)
+    test.eq_(len(result.stdout), 1000)
+    test.eq_(result.stderr, 'done\n')
+    assert result.truncated
+    test.assert_false(runner.run('echo short', max_output=1000).truncated)
+
+
+def test_iter_lines():
+    test.eq_(list(runner.iter_lines('echo one; echo two >&2; echo three')), ['one\n', 'three\n'])
+
+
+def test_iter_lines_timeout():
+    lines = []
+    try:
+        for line in runner.iter_lines('echo started; sleep 5', timeout=0.2):
+            lines.append(line)
+    except runner.CommandTimeout:
+        pass
+    else:
+        raise AssertionError('expected CommandTimeout')
+    test.eq_(lines, ['started\n'])
+
+
+def test_iter_lines_stop_early():
+    start = time.time()
+    for line in runner.iter_lines('while true; do echo y; done'):
+        break
+    assert time.time() - start < 2
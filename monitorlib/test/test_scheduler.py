@@ -0,0 +1,115 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.scheduler
+"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import nose.tools as test
+
+os.environ.setdefault('COLLECTD_HOSTNAME', 'testhost.example.com')
+
+import monitorlib.collectd as collectd
+import monitorlib.scheduler as scheduler
+
+
+STATE_DIR = None
+
+
+def setup_module():
+    global STATE_DIR
+    STATE_DIR = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(STATE_DIR)
+
+
+def make_scheduler(**kwargs):
+    cd = collectd.Client()
+    cd.set_state_dir(STATE_DIR)
+    cd.set_state_store()
+    return cd, scheduler.Scheduler(cd, **kwargs)
+
+
+def test_checks_run_on_their_intervals_with_separate_state():
+    cd, sched = make_scheduler(workers=2)
+    seen = []
+
+    def fast(client):
+        seen.append(client.caller)
+        client.ok('fast is fine')
+
+    def slow(client):
+        seen.append(client.caller)
+        client.failure('slow is broken')
+
+    sched.register('fast', fast, interval=0.1)
+    sched.register('slow', slow, interval=0.5)
+    sched.run(duration=1.2)
+
+    assert seen.count('fast') >= 6
+    assert 1 <= seen.count('slow') <= 3
+    test.eq_(cd.for_check('fast').get_current_state().count('fast is fine'), 1)
+    test.eq_(cd.for_check('slow').get_current_state().count('slow is broken'), 1)
+    ### the shared client itself was left alone
+    test.eq_(cd.alert_message, None)
+
+
+def test_check_timeout():
+    cd, sched = make_scheduler(workers=1)
+    release = threading.Event()
+    ran = []
+
+    sched.register('hung', lambda client: release.wait(5), interval=0.1, timeout=0.2)
+    sched.register('other', lambda client: ran.append(1), interval=0.1)
+    sched.run(duration=1)
+    ### let the hung worker finish, so it isn't left running into other tests (or shutdown)
+    hung = sched.running['hung']
+    release.set()
+    hung.join(1)
+    test.assert_false(hung.is_alive())
+
+    assert 'timed out' in cd.for_check('hung').get_current_state()
+    ### the hung check's worker was replaced, so the other check kept running
+    assert len(ran) >= 3
+
+
+def test_timeout_alert_doesnt_block_the_loop():
+    cd, sched = make_scheduler(workers=2)
+    cd.url = 'http://localhost/'
+    cd.raise_sink_errors = False
+    cd._post_to_url = lambda message, url: time.sleep(4)
+    release = threading.Event()
+    ran = []
+
+    sched.register('hung_alerting', lambda client: release.wait(5), interval=0.1, timeout=0.2)
+    sched.register('quick', lambda client: ran.append(1), interval=0.1)
+    start = time.time()
+    sched.run(duration=1.5)
+    elapsed = time.time() - start
+    hung = sched.running['hung_alerting']
+    release.set()
+    hung.join(1)
+    for thread in sched.alert_threads:
+        thread.join(5)
+
+    assert elapsed < 2.5, elapsed
+    ### kept running while the slow timeout alert was being sent
+    assert len(ran) >= 8, len(ran)
+    assert 'timed out' in cd.for_check('hung_alerting').get_current_state()
+
+
+def test_register_twice():
+    cd, sched = make_scheduler()
+    sched.register('check', lambda client: None)
+    test.assert_raises(ValueError, sched.register, 'check', lambda client: None)
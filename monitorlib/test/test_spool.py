@@ -0,0 +1,64 @@
+### -*- coding: utf-8 -*-
+###
+### © 2014 Krux Digital, Inc. All rights reserved.
+###
+
+"""
+Tests for monitorlib.spool
+"""
+
+
+import shutil
+import tempfile
+
+import nose.tools as test
+
+import monitorlib.spool as spool
+
+
+TMP_DIR = None
+
+
+def setup_tmp():
+    global TMP_DIR
+    TMP_DIR = tempfile.mkdtemp()
+
+
+def teardown_tmp():
+    shutil.rmtree(TMP_DIR)
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_drain_resumes_after_failure():
+    s = spool.Spool(TMP_DIR + '/spool')
+    for i in range(5):
+        s.append({'n': i})
+    assert s.pending()
+
+    delivered = []
+
+    def flaky(record):
+        if record['n'] == 3 and 3 not in delivered:
+            delivered.append(3)
+            raise IOError('sink is down')
+        delivered.append(record['n'])
+
+    test.assert_raises(IOError, s.drain, flaky)
+    test.eq_(delivered, [0, 1, 2, 3])
+    s.append({'n': 5})
+    test.eq_(s.drain(flaky), 3)
+    test.eq_(delivered, [0, 1, 2, 3, 3, 4, 5])
+    test.assert_false(s.pending())
+    test.eq_(s.drain(flaky), 0)
+
+
+@test.with_setup(setup_tmp, teardown_tmp)
+def test_drain_skips_partial_records():
+    s = spool.Spool(TMP_DIR + '/spool')
+    s.append({'n': 0})
+    with open(s.current, 'a') as fh:
+        fh.write('{"n": 1')
+    delivered = []
+    test.eq_(s.drain(lambda record: delivered.append(record['n'])), 1)
+    test.eq_(delivered, [0])
+    test.assert_false(s.pending())